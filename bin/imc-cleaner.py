@@ -2,12 +2,16 @@
 """Periodic cleaning of infrastructure and the database"""
 
 from __future__ import print_function
-import configparser
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from functools import partial
 import logging
 from logging.handlers import RotatingFileHandler
 import re
 import os
+import signal
 import sys
+import threading
 import time
 
 from imc import config
@@ -23,15 +27,22 @@ from imc import utilities
 CONFIG = config.get_config()
 
 # Logging
-handler = RotatingFileHandler(filename=CONFIG.get('logs', 'filename').replace('.log', '-cleaner.log'),
-                              maxBytes=int(CONFIG.get('logs', 'max_bytes')),
-                              backupCount=int(CONFIG.get('logs', 'num')))
+handler = RotatingFileHandler(filename=CONFIG.logs.filename.replace('.log', '-cleaner.log'),
+                              maxBytes=CONFIG.logs.max_bytes,
+                              backupCount=CONFIG.logs.num)
 formatter = logging.Formatter('%(asctime)s %(levelname)s [%(name)s] %(message)s')
 handler.setFormatter(formatter)
 logger = logging.getLogger('imc')
 logger.addHandler(handler)
 logger.setLevel(logging.INFO)
 
+def handle_reload(signum, frame):
+    """
+    Reload configuration
+    """
+    logger.info('Received signal %d, reloading configuration...', signum)
+    config.reload_config()
+
 def find_invalid_im_infras(db):
     """
     """
@@ -59,7 +70,7 @@ def find_invalid_im_infras(db):
 
             # Create the IM auth & client
             im_auth = im_utils.create_im_auth(cloud, token, clouds_info_list)
-            client = imclient.IMClient(url=CONFIG.get('im', 'url'), data=im_auth)
+            client = imclient.IMClient(url=CONFIG.im.url, data=im_auth)
             (status, msg) = client.getauth()
             if status != 0:
                 logger.critical('Error reading IM auth file: %s', msg)
@@ -72,6 +83,30 @@ def find_invalid_im_infras(db):
                 logger.info('Infra with id %s on cloud %s is in the stopped state, so deleting...', infra['id'], cloud)
                 db.deployment_update_status(unique_id, 'deletion-requested')
 
+def get_im_infra_data(client, im_id):
+    """
+    Find the infra ID and cloud associated with IM infrastructure from its data, i.e. from
+    PROMINENCE_INFRASTRUCTURE_ID in the RADL and the cloud name
+    """
+    infra_id = None
+    cloud = None
+
+    (data, _) = client.getdata(im_id, 10)
+    if not data:
+        return (None, None)
+
+    match = re.search("PROMINENCE_INFRASTRUCTURE_ID=([0-9a-f]{8}-[0-9a-f]{4}-[4][0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12})", data['data'])
+    if match:
+        infra_id = match.group(1)
+        logger.info('From RADL found that IM id %s is associated with infra id %s', im_id, infra_id)
+
+    match = re.search(r'\\\\\\"id\\\\\\": \\\\\\"([\w\-]+)\\\\\\"', data['data'])
+    if match:
+        cloud = match.group(1)
+        logger.info('Found cloud %s from data of IM id %s', cloud, im_id)
+
+    return (infra_id, cloud)
+
 def find_unexpected_im_infras(db):
     """
     Find IM infrastructures which should not exist, typically deletion failed in some way 
@@ -80,7 +115,7 @@ def find_unexpected_im_infras(db):
     # Setup access to IM - we don't need to supply any cloud credentials initially because
     # we don't want to get updated statuses
     im_auth = im_utils.create_im_auth(None, None, None)
-    client = imclient.IMClient(url=CONFIG.get('im', 'url'), data=im_auth)
+    client = imclient.IMClient(url=CONFIG.im.url, data=im_auth)
     (status, msg) = client.getauth()
     if status != 0:
         logger.critical('Error reading IM auth file: %s', msg)
@@ -92,125 +127,228 @@ def find_unexpected_im_infras(db):
     if not ids:
         return True
 
-    im_infras_to_delete = {}
-    for uri in ids:
-        pieces = uri.split('/')
-        im_id = pieces[len(pieces) - 1]
+    im_ids = [uri.split('/')[-1] for uri in ids]
 
-        # Check if we know about the infrastructure
-        (infra_id, status, cloud) = db.get_infra_from_im_infra_id(im_id)
+    # Check which infrastructures we know about, and which are in the deployment log, all at once
+    known = db.get_known_im_infra_ids(im_ids)
+    logged = db.get_im_deployments_log(im_ids)
+    if known is None or logged is None:
+        return False
 
-        if infra_id:
+    unknown = {}
+    for im_id in im_ids:
+        if im_id in known:
             continue
-
         logger.info('Found unknown infrastructure with IM ID %s', im_id)
+        unknown[im_id] = logged.get(im_id, (None, None))
+        if unknown[im_id][0]:
+            logger.info('From log found that IM id %s is associated with infra id %s and cloud %s', im_id, unknown[im_id][0], unknown[im_id][1])
+
+    # Otherwise search the data for PROMINENCE_INFRASTRUCTURE_ID and/or the cloud name
+    search = [im_id for im_id in unknown if not unknown[im_id][0] or not unknown[im_id][1] or unknown[im_id][1] == 'none']
+    if search:
+        with ThreadPoolExecutor(CONFIG.cleanup.workers) as executor:
+            for (im_id, (infra_id, cloud)) in zip(search, executor.map(partial(get_im_infra_data, client), search)):
+                (infra_id_log, cloud_log) = unknown[im_id]
+                if not cloud_log or cloud_log == 'none':
+                    cloud_log = cloud
+                unknown[im_id] = (infra_id_log or infra_id, cloud_log)
+
+    infras = db.deployment_get_identities_statuses(set([infra_id for (infra_id, _) in unknown.values() if infra_id]))
+    if infras is None:
+        return False
 
-        # Check the deployment log, otherwise search the RADL for PROMINENCE_INFRASTRUCTURE_ID and/or the cloud name
-        infra_id, cloud = db.check_im_deployment(im_id)
-        cloud_from_data = None
-
-        if infra_id:
-            logger.info('From log found that IM id %s is associated with infra id %s and cloud %s', im_id, infra_id, cloud)
-
-
-        (data, _) = client.getdata(im_id, 10)
-        if not data:
-            continue
-
+    im_infras_to_delete = []
+    for (im_id, (infra_id, cloud)) in unknown.items():
         if not infra_id:
-            match = re.search("PROMINENCE_INFRASTRUCTURE_ID=([0-9a-f]{8}-[0-9a-f]{4}-[4][0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12})", data['data'])
-            if not match:
-                logger.info('- could not get my associated infrastructure id from PROMINENCE_INFRASTRUCTURE_ID in data')
-                continue
-
-            infra_id = match.group(1)
-            logger.info('From RADL found that IM id %s is associated with infra id %s', im_id, infra_id)
-
-        if not cloud:
-            match = re.search(r'\\\\\\"id\\\\\\": \\\\\\"([\w\-]+)\\\\\\"', data['data'])
-            if match:
-                cloud_from_data = match.group(1)
-                logger.info('found cloud %s from data', cloud_from_data)
+            logger.info('Could not find the infrastructure id associated with IM id %s', im_id)
+            continue
 
-        (_, my_infra_status, _, _, _) = db.deployment_get_im_infra_id(infra_id)
-        identity = db.deployment_get_identity(infra_id)
+        (my_infra_status, identity) = infras.get(infra_id, (None, None))
         logger.info('- this IM infrastructure is associated with my infrastructure id %s which has status %s identity %s', infra_id, my_infra_status, identity)
 
-        if (not cloud or cloud == 'none') and cloud_from_data:
-            cloud = cloud_from_data
-           
-        if not cloud or cloud == 'none' or identity == 'none':
+        if not cloud or cloud == 'none' or not identity or identity == 'none':
             logger.info(' - this IM infrastructure %s has no known cloud or identity associated with it', infra_id)
-        else:
-            if my_infra_status in ('deleted', 'deleting', 'deletion-failed', 'deletion-required', 'unable'):
-                im_infras_to_delete[infra_id] = {}
-                im_infras_to_delete[infra_id]['identity'] = identity
-                im_infras_to_delete[infra_id]['im_id'] = im_id
-                im_infras_to_delete[infra_id]['cloud'] = cloud
+        elif my_infra_status in ('deleted', 'deleting', 'deletion-failed', 'deletion-required', 'unable'):
+            im_infras_to_delete.append((im_id, infra_id, identity, cloud))
 
     # Delete any infras
-    if len(im_infras_to_delete) > 0:
+    if im_infras_to_delete:
         logger.info('Have %d infrastructures to delete', len(im_infras_to_delete))
+        delete_unexpected_im_infras(db, im_infras_to_delete)
 
-    for infra in im_infras_to_delete:
-        logger.info('Working on infra with my id=%s', infra)
-        if delete_from_im(im_infras_to_delete[infra]['im_id'], db, im_infras_to_delete[infra]['identity'], im_infras_to_delete[infra]['cloud']):
-            logger.info('- successfully deleted infrastructure with IM id %s for identity %s on cloud %s', im_infras_to_delete[infra]['im_id'], im_infras_to_delete[infra]['identity'], im_infras_to_delete[infra]['cloud'])
-        else:
-            logger.info('- unable to delete infrastructure with IM id %s for identity %s on cloud %s', im_infras_to_delete[infra]['im_id'], im_infras_to_delete[infra]['identity'], im_infras_to_delete[infra]['cloud'])
+    return True
+
+def delete_unexpected_im_infras(db, im_infras):
+    """
+    Delete IM infrastructures, given as (IM id, infra id, identity, cloud), concurrently.
+    Clients are created once for each identity & cloud, as this may require the DB.
+    """
+    clouds_lists = {}
+    clients = {}
+    with ThreadPoolExecutor(CONFIG.cleanup.deleters) as executor:
+        futures = {}
+        for (im_id, infra_id, identity, cloud) in im_infras:
+            logger.info('Working on infra with my id=%s', infra_id)
+            if (identity, cloud) not in clients:
+                clients[(identity, cloud)] = create_im_client(db, identity, cloud, clouds_lists)
+            if not clients[(identity, cloud)]:
+                continue
+            futures[executor.submit(delete_from_im, clients[(identity, cloud)], im_id)] = (im_id, identity, cloud)
 
+        for future in as_completed(futures):
+            (im_id, identity, cloud) = futures[future]
+            if future.result():
+                logger.info('- successfully deleted infrastructure with IM id %s for identity %s on cloud %s', im_id, identity, cloud)
+            else:
+                logger.info('- unable to delete infrastructure with IM id %s for identity %s on cloud %s', im_id, identity, cloud)
 
-def retry_incomplete_deletions(db, state):
+# DB connection of each worker thread, and all those opened
+LOCAL = threading.local()
+THREAD_DBS = []
+THREAD_DBS_LOCK = threading.Lock()
+
+def get_thread_db():
     """
-    Retry failed deletions
+    Return the DB connection of the current thread, connecting if necessary
     """
-    infras = db.deployment_get_infra_in_state_cloud(state) 
-    logger.info('Found %d infrastructures in state %s', len(infras), state)
-    for infra in infras:
-        if time.time() - infra['updated'] > int(CONFIG.get('cleanup', 'retry_failed_deletes_after')) or 1 == 1:
-            logger.info('Attempting to delete infra with ID %s', infra['id'])
-            if destroy.delete(infra['id']):
-                logger.info('Successfully deleted infrastructure with ID %s', infra['id'])
+    db = getattr(LOCAL, 'db', None)
+    if db is None:
+        db = database.get_db()
+        if not db.connect():
+            return None
+        LOCAL.db = db
+        with THREAD_DBS_LOCK:
+            THREAD_DBS.append(db)
+    return db
+
+def close_thread_dbs():
+    """
+    Close the DB connections of all worker threads
+    """
+    with THREAD_DBS_LOCK:
+        for db in THREAD_DBS:
+            db.close()
+        del THREAD_DBS[:]
 
-def remove_old_entries(db, state):
+def retry_deletion(infra_id, clients):
     """
-    Remove old entries from the DB
+    Retry deletion of an infrastructure using the DB connection of the current thread
     """
-    infras = db.deployment_get_infra_in_state_cloud(state)
-    logger.info('Found %d infrastructures in state %s', len(infras), state)
-    for infra in infras:
-        if time.time() - infra['updated'] > int(CONFIG.get('cleanup', 'remove_after')):
-            logger.info('Removing infrastructure %s from DB', infra['id'])
-            db.deployment_log_remove(infra['id'])
-            db.deployment_remove(infra['id'])
+    db = get_thread_db()
+    if not db:
+        logger.critical('Unable to connect to DB for deleting infrastructure %s', infra_id)
+        return False
+    try:
+        return destroy.delete(infra_id, db, clients)
+    except Exception as exc:
+        logger.critical('Got exception deleting infrastructure %s: %s', infra_id, exc)
+    return False
 
-def delete_stuck_infras(db, state):
+def retry_incomplete_deletions(db, states):
     """
-    Delete any infras stuck in the accepted or creating state
+    Retry failed deletions concurrently, with a limit on the number of deletions from each
+    cloud at once so that an unresponsive cloud cannot hold up the others
     """
-    infras = db.deployment_get_infra_in_state_cloud(state)
-    logger.info('Found %d infrastructures in state %s', len(infras), state)
-    for infra in infras:
-        if time.time() - infra['updated'] > int(CONFIG.get('cleanup', 'delete_stuck_infras_after')):
-            logger.info('Setting status of infrastructure %s to deleted', infra['id'])
-            db.deployment_update_status(unique_id, 'deletion-requested')
-            db.deployment_update_status_reason(unique_id, 'DeploymentFailed')
+    pending = {}
+    for state in states:
+        infras = db.deployment_get_infra_in_state_cloud(state)
+        logger.info('Found %d infrastructures in state %s', len(infras), state)
+        for infra in infras:
+            if time.time() - infra['updated'] > CONFIG.cleanup.retry_failed_deletes_after:
+                pending.setdefault(infra['cloud'], deque()).append(infra['id'])
+
+    # IM clients are shared by all deletions for the same identity & cloud
+    clients = utilities.LRUCache(CONFIG.pool.connections, CONFIG.cleanup.clients_max_age)
+    running = {}
+    with ThreadPoolExecutor(CONFIG.cleanup.deleters) as executor:
+        def submit(cloud):
+            infra_id = pending[cloud].popleft()
+            logger.info('Attempting to delete infra with ID %s', infra_id)
+            running[executor.submit(retry_deletion, infra_id, clients)] = (cloud, infra_id)
+
+        for cloud in pending:
+            for _ in range(min(CONFIG.cleanup.deleters_per_cloud, len(pending[cloud]))):
+                submit(cloud)
+
+        while running:
+            (done, _) = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                (cloud, infra_id) = running.pop(future)
+                if future.result():
+                    logger.info('Successfully deleted infrastructure with ID %s', infra_id)
+                if pending[cloud]:
+                    submit(cloud)
+
+    close_thread_dbs()
+
+def remove_old_entries(db, states):
+    """
+    Remove old entries from the DB, in batches so that locks are only held briefly
+    """
+    total = 0
+    while True:
+        removed = db.deployment_remove_old(states, time.time() - CONFIG.cleanup.remove_after, CONFIG.cleanup.batch_size)
+        if not removed:
+            break
+        total += removed
+        if removed < CONFIG.cleanup.batch_size:
+            break
+    logger.info('Removed %d infrastructures in states %s from DB', total, ','.join(states))
+
+def remove_old_changes(db):
+    """
+    Remove old changes from the change feed, in batches so that locks are only held briefly
+    """
+    total = 0
+    while True:
+        removed = db.deployment_remove_old_changes(time.time() - CONFIG.cleanup.remove_changes_after, CONFIG.cleanup.batch_size)
+        if not removed:
+            break
+        total += removed
+        if removed < CONFIG.cleanup.batch_size:
+            break
+    logger.info('Removed %d changes from DB', total)
 
-def delete_from_im(im_infrastructure_id, db, identity, cloud):
+def delete_stuck_infras(db, state):
     """
-    Delete infrastructure from IM
+    Delete any infras stuck in the accepted or creating state, in batches
+    """
+    total = 0
+    while True:
+        updated = db.deployment_request_deletion_stuck(state,
+                                                       time.time() - CONFIG.cleanup.delete_stuck_infras_after,
+                                                       'DeploymentFailed',
+                                                       CONFIG.cleanup.batch_size)
+        if not updated:
+            break
+        total += updated
+        if updated < CONFIG.cleanup.batch_size:
+            break
+    logger.info('Requested deletion of %d infrastructures stuck in state %s', total, state)
+
+def create_im_client(db, identity, cloud, clouds_lists):
+    """
+    Create an IM client with credentials for the specified identity & cloud, reusing the
+    list of clouds of each identity
     """
-    logger.info('Inside delete_from_im with identity=%s, cloud=%s', identity, cloud)
-    clouds_info_list = cloud_utils.create_clouds_list(db, identity)
+    logger.info('Creating IM client with identity=%s, cloud=%s', identity, cloud)
+    if identity not in clouds_lists:
+        clouds_lists[identity] = cloud_utils.create_clouds_list(db, identity)
+    clouds_info_list = clouds_lists[identity]
     token = tokens.get_token(cloud, identity, db, clouds_info_list)
     im_auth = im_utils.create_im_auth(cloud, token, clouds_info_list)
-    print('im_auth=', im_auth)
-    client = imclient.IMClient(url=CONFIG.get('im', 'url'), data=im_auth)
+    client = imclient.IMClient(url=CONFIG.im.url, data=im_auth)
     (status, msg) = client.getauth()
     if status != 0:
         logger.critical('Error reading IM auth file: %s', msg)
-        return False
+        return None
+    return client
 
+def delete_from_im(client, im_infrastructure_id):
+    """
+    Delete infrastructure from IM
+    """
     (status, msg) = client.destroy(im_infrastructure_id, 60)
     if status == 0:
         return True
@@ -219,6 +357,8 @@ def delete_from_im(im_infrastructure_id, db, identity, cloud):
     return False
 
 if __name__ == "__main__":
+    signal.signal(signal.SIGHUP, handle_reload)
+
     while True:
         logger.info('Connecting to the DB')
         db = database.get_db()
@@ -230,25 +370,23 @@ if __name__ == "__main__":
             #exit(0)
 
             logger.info('Removing any old entries from the DB')
-            remove_old_entries(db, 'deleted')
-            remove_old_entries(db, 'unable')
+            remove_old_entries(db, ('deleted', 'unable'))
+            remove_old_changes(db)
 
             logger.info('Checking for infrastructure stuck in the creating state')
             delete_stuck_infras(db, 'creating')
 
             logger.info('Removing old failures from database')
-            db.del_old_deployment_failures(24*60*60)
+            db.del_old_deployment_failures(CONFIG.ranking.history)
 
             logger.info('Checking for unexpected IM infrastructures')
             find_unexpected_im_infras(db)
 
             logger.info('Retrying any incomplete deletions')
-            retry_incomplete_deletions(db, 'deletion-failed')
-            retry_incomplete_deletions(db, 'deleting')
-            retry_incomplete_deletions(db, 'deletion-requested')
+            retry_incomplete_deletions(db, ('deletion-failed', 'deleting', 'deletion-requested'))
 
             db.close()
         else:
             logger.critical('Unable to connect to database')
 
-        time.sleep(int(CONFIG.get('polling', 'cleaning')))
+        time.sleep(CONFIG.polling.cleaning)
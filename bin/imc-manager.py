@@ -21,9 +21,9 @@ from imc import cloud_updates
 CONFIG = config.get_config()
 
 # Logging
-handler = RotatingFileHandler(filename=CONFIG.get('logs', 'filename').replace('.log', '-manager.log'),
-                              maxBytes=int(CONFIG.get('logs', 'max_bytes')),
-                              backupCount=int(CONFIG.get('logs', 'num')))
+handler = RotatingFileHandler(filename=CONFIG.logs.filename.replace('.log', '-manager.log'),
+                              maxBytes=CONFIG.logs.max_bytes,
+                              backupCount=CONFIG.logs.num)
 formatter = logging.Formatter('%(asctime)s %(levelname)s [%(threadName)s %(name)s] %(message)s')
 handler.setFormatter(formatter)
 logger = logging.getLogger('imc')
@@ -44,6 +44,13 @@ def handle_signal(signum, frame):
     EXIT_NOW = True
     logger.info('Received signal %d, shutting down...', signum)
 
+def handle_reload(signum, frame):
+    """
+    Reload configuration
+    """
+    logger.info('Received signal %d, reloading configuration...', signum)
+    config.reload_config()
+
 def find_new_infra_for_creation(db, executor):
     """
     Find infrastructure to be deployed
@@ -56,7 +63,7 @@ def find_new_infra_for_creation(db, executor):
     infras_waiting = db.deployment_get_infra_in_state_cloud('waiting', order=True)
 
     for infra in infras_waiting:
-        if time.time() - infra['updated'] > int(CONFIG.get('updates', 'waiting')) + random.randint(-200, 200):
+        if time.time() - infra['updated'] > CONFIG.updates.waiting + random.randint(-200, 200):
             infras.append(infra)
             
     current_deployers = 0
@@ -66,7 +73,7 @@ def find_new_infra_for_creation(db, executor):
         logger.info('Found %d infrastructures to deploy', len(infras))
 
     for infra in infras:
-        if current_deployers + 1 < int(CONFIG.get('pool', 'deployers')):
+        if current_deployers + 1 < CONFIG.pool.deployers:
             logger.info('Running deploying for infra %s', infra['id'])
             db.deployment_update_status(infra['id'], 'creating')
             executor.submit(deployer.deployer, infra['id'])
@@ -89,7 +96,7 @@ def find_new_infra_for_deletion(db, executor):
         logger.info('Found %d infrastructures to delete', len(infras))
 
     for infra in infras:
-        if current_destroyers + 1 < int(CONFIG.get('pool', 'deleters')):
+        if current_destroyers + 1 < CONFIG.pool.deleters:
             logger.info('Running destroyer for infra %s', infra['id'])
             db.deployment_update_status(infra['id'], 'deleting')
             executor.submit(destroyer.destroyer, infra['id'])
@@ -102,16 +109,31 @@ def find_new_infra_for_deletion(db, executor):
 
 if __name__ == "__main__":
     signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGHUP, handle_reload)
 
-    executor_deployers = ThreadPoolExecutor(int(CONFIG.get('pool', 'deployers')))
-    executor_deleters = ThreadPoolExecutor(int(CONFIG.get('pool', 'deleters')))
+    pool_deployers = CONFIG.pool.deployers
+    pool_deleters = CONFIG.pool.deleters
+    executor_deployers = ThreadPoolExecutor(pool_deployers)
+    executor_deleters = ThreadPoolExecutor(pool_deleters)
 
     logger.info('Entering main polling loop')
     while True:
         if EXIT_NOW:
             logger.info('Exiting')
             sys.exit(0)
- 
+
+        # Resize pools if the configuration has changed, running workers are left to complete
+        if CONFIG.pool.deployers != pool_deployers:
+            logger.info('Changing number of deployers from %d to %d', pool_deployers, CONFIG.pool.deployers)
+            pool_deployers = CONFIG.pool.deployers
+            executor_deployers.shutdown(wait=False)
+            executor_deployers = ThreadPoolExecutor(pool_deployers)
+        if CONFIG.pool.deleters != pool_deleters:
+            logger.info('Changing number of deleters from %d to %d', pool_deleters, CONFIG.pool.deleters)
+            pool_deleters = CONFIG.pool.deleters
+            executor_deleters.shutdown(wait=False)
+            executor_deleters = ThreadPoolExecutor(pool_deleters)
+
         db = database.get_db()
         if db.connect():
             find_new_infra_for_deletion(db, executor_deployers)
@@ -120,5 +142,5 @@ if __name__ == "__main__":
         else:
             logger.critical('Unable to connect to database')
 
-        time.sleep(int(CONFIG.get('polling', 'manager')))
+        time.sleep(CONFIG.polling.manager)
 
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""Export deployment history and evaluate the cloud ranking model offline by replaying it"""
+
+from __future__ import print_function
+import argparse
+import json
+import sys
+import time
+
+from imc import config
+from imc import database
+from imc import ranking
+
+# Configuration
+CONFIG = config.get_config()
+
+def export_history(filename, since):
+    """
+    Export the outcomes of deployments from the DB to a JSON file
+    """
+    db = database.get_db()
+    if not db.connect():
+        print('ERROR: Unable to connect to the DB')
+        return 1
+
+    history = db.get_deployment_history(time.time() - since)
+    db.close()
+
+    with open(filename, 'w') as fd:
+        json.dump(history, fd)
+
+    print('Exported %d deployment outcomes to %s' % (len(history), filename))
+    return 0
+
+def replay_history(filename):
+    """
+    Replay exported deployment history, printing how well outcomes were predicted
+    """
+    with open(filename) as fd:
+        history = sorted(json.load(fd), key=lambda row: row['time'])
+
+    metrics = ranking.replay(history)
+    print(json.dumps(metrics, indent=2, sort_keys=True))
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='command')
+
+    parser_export = subparsers.add_parser('export', help='export deployment history from the DB')
+    parser_export.add_argument('filename')
+    parser_export.add_argument('--since', type=int, default=CONFIG.ranking.history,
+                               help='export outcomes from this many seconds ago')
+
+    parser_replay = subparsers.add_parser('replay', help='replay exported deployment history')
+    parser_replay.add_argument('filename')
+
+    args = parser.parse_args()
+    if args.command == 'export':
+        sys.exit(export_history(args.filename, args.since))
+    elif args.command == 'replay':
+        sys.exit(replay_history(args.filename))
+
+    parser.print_help()
+    sys.exit(1)
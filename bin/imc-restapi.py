@@ -3,12 +3,30 @@
 
 from __future__ import print_function
 from functools import wraps
+import json
 import uuid
 import logging
 from logging.handlers import RotatingFileHandler
-from flask import Flask, request, jsonify
 
 from imc import config
+
+# Configuration
+CONFIG = config.get_config()
+
+# In gevent mode sockets, including those used by the DB driver, yield to other requests
+# while waiting, so slow back ends do not tie up workers. This must be done before
+# anything else creates sockets or imports ssl.
+if CONFIG.api.mode == 'gevent':
+    try:
+        from gevent import monkey
+        monkey.patch_all()
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    except ImportError as err:
+        print('WARNING: gevent mode requires gevent and psycogreen, using threads: %s' % err)
+
+from flask import Flask, Response, request, jsonify
+
 from imc import database
 from imc import imclient
 from imc import logger as custom_logger
@@ -17,14 +35,12 @@ from imc import tokens
 from imc import cloud_utils
 from imc import utilities
 from imc import health
-
-# Configuration
-CONFIG = config.get_config()
+from imc import listener
 
 # Setup handlers for the root logger
-handler = RotatingFileHandler(CONFIG.get('logs', 'filename').replace('.log', '-restapi.log'),
-                              maxBytes=int(CONFIG.get('logs', 'max_bytes')),
-                              backupCount=int(CONFIG.get('logs', 'num')))
+handler = RotatingFileHandler(CONFIG.logs.filename.replace('.log', '-restapi.log'),
+                              maxBytes=CONFIG.logs.max_bytes,
+                              backupCount=CONFIG.logs.num)
 formatter = logging.Formatter('%(asctime)s %(levelname)s [%(name)s] %(message)s')
 handler.setFormatter(formatter)
 logger = logging.getLogger()
@@ -48,7 +64,7 @@ def valid_credentials(username, password):
     """
     Check if the supplied credentials are valid
     """
-    return username == CONFIG.get('auth', 'username') and password == CONFIG.get('auth', 'password')
+    return username == CONFIG.auth.username and password == CONFIG.auth.password
 
 def requires_auth(function):
     @wraps(function)
@@ -61,6 +77,14 @@ def requires_auth(function):
         return function(*args, **kwargs)
     return wrapper
 
+def not_modified(etag):
+    """
+    Sends a 304 response
+    """
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
 @app.route('/infrastructures', methods=['POST'])
 @requires_auth
 def create_infrastructure():
@@ -91,9 +115,11 @@ def create_infrastructure():
 
     if 'dryrun' in request.get_json():
         sites = return_sites.return_sites(request.get_json())
+        if sites is None:
+            return jsonify({'error':'unable to find suitable resources'}), 400
         return jsonify({'sites':sites}), 200
 
-    db = database.get_db()
+    db = database.get_pooled_db()
     if db.connect():
         check = db.deployment_check_infra_id(uid)
         if check == 1:
@@ -112,6 +138,50 @@ def create_infrastructure():
     logger.critical('Infrastructure creation request failed, possibly a database issue')
     return jsonify({'id':uid}), 400
 
+@app.route('/infrastructures/batch', methods=['POST'])
+@requires_auth
+def create_infrastructures():
+    """
+    Create many infrastructures in a single transaction
+    """
+    data = request.get_json(silent=True)
+    if not data or not isinstance(data.get('infrastructures'), list):
+        return jsonify({'error':'json data not valid'}), 400
+    items = data['infrastructures']
+    if len(items) > CONFIG.api.batch_max:
+        return jsonify({'error':'too many infrastructures, maximum is %d' % CONFIG.api.batch_max}), 400
+
+    deployments = []
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get('description'), dict):
+            return jsonify({'error':'json data not valid'}), 400
+        uid = item.get('idempotency_key')
+        if not uid or not utilities.valid_uuid(uid):
+            uid = str(uuid.uuid4())
+        description = item['description']
+        deployments.append((uid, description, description.get('identity'), description.get('identifier')))
+
+    db = database.get_pooled_db()
+    if not db.connect():
+        logger.critical('Infrastructure batch creation request failed, unable to connect to the database')
+        return jsonify({'error':'unable to connect to the database'}), 400
+    created = db.deployment_create_batch(deployments)
+    db.close()
+
+    if created is None:
+        logger.critical('Infrastructure batch creation request failed, possibly a database issue')
+        return jsonify({'error':'unable to create infrastructures'}), 400
+
+    # Only the first use of an ID in the batch can have created the infrastructure
+    results = []
+    for (uid, _, _, _) in deployments:
+        results.append({'id':uid, 'status':'created' if uid in created else 'duplicate'})
+        created.discard(uid)
+    logger.info('Infrastructure batch creation request successfully initiated %d infrastructures',
+                len([result for result in results if result['status'] == 'created']))
+
+    return jsonify({'infrastructures':results}), 201
+
 @app.route('/infrastructures/', methods=['GET'])
 @requires_auth
 def get_infrastructures():
@@ -122,21 +192,28 @@ def get_infrastructures():
         cloud = None
         if 'cloud' in request.args:
             cloud = request.args.get('cloud')
-        db = database.get_db()
+        db = database.get_pooled_db()
         if db.connect():
+            version = db.deployment_get_infra_in_state_cloud_version(request.args.get('status'), cloud)
+            if version and request.if_none_match.contains(version):
+                db.close()
+                return not_modified(version)
             infra = db.deployment_get_infra_in_state_cloud(request.args.get('status'), cloud)
             db.close()
-            return jsonify(infra), 200
+            response = jsonify(infra)
+            if version:
+                response.set_etag(version)
+            return response
     elif 'type' in request.args and 'cloud' in request.args:
         if request.args.get('type') == 'im':
             cloud = request.args.get('cloud')
-            db = database.get_db()
+            db = database.get_pooled_db()
             if db.connect():
                 clouds_info_list = cloud_utils.create_clouds_list(db, identity)
                 token = tokens.get_token(cloud, None, db, clouds_info_list)
                 db.close()
                 im_auth = utilities.create_im_auth(cloud, token, clouds_info_list)
-                client = imclient.IMClient(url=CONFIG.get('im', 'url'), data=im_auth)
+                client = imclient.IMClient(url=CONFIG.im.url, data=im_auth)
                 (status, msg) = client.getauth()
                 if status != 0:
                     logger.critical('Error reading IM auth file: %s', msg)
@@ -152,16 +229,199 @@ def get_infrastructures():
         
     return jsonify({}), 400
 
+def stream_statuses(db, statuses, limit):
+    """
+    Generate a JSON document containing the status of infrastructures, and the ID to get
+    the next page after if the page is full or an error if not all could be read, closing
+    the DB connection at the end
+    """
+    yield '{"infrastructures": ['
+    count = 0
+    last = None
+    error = None
+    try:
+        for status in statuses:
+            if count:
+                yield ', '
+            yield json.dumps(status)
+            count += 1
+            last = status['id']
+    except Exception:
+        error = 'unable to get the status of all infrastructures'
+    finally:
+        db.close()
+    if error:
+        # The status code has already been sent, so the error can only be reported here
+        yield '], "next": null, "error": %s}' % json.dumps(error)
+    else:
+        yield '], "next": %s}' % json.dumps(last if count == limit else None)
+
+@app.route('/infrastructures/status', methods=['GET', 'POST'])
+@requires_auth
+def get_infrastructures_status():
+    """
+    Get current status of many infrastructures, either those with IDs given in the
+    request body or those with the specified identity and/or status
+    """
+    ids = None
+    if request.method == 'POST':
+        data = request.get_json(silent=True)
+        if not data or not isinstance(data.get('ids'), list):
+            return jsonify({'error':'json data not valid'}), 400
+        if not all(isinstance(infra_id, str) for infra_id in data['ids']):
+            return jsonify({'error':'ids must be strings'}), 400
+        ids = data['ids']
+        if len(ids) > CONFIG.api.page_size_max:
+            return jsonify({'error':'too many ids, maximum is %d' % CONFIG.api.page_size_max}), 400
+
+    try:
+        limit = int(request.args.get('limit', CONFIG.api.page_size))
+    except ValueError:
+        return jsonify({'error':'limit must be an integer'}), 400
+    limit = max(1, min(limit, CONFIG.api.page_size_max))
+
+    db = database.get_pooled_db()
+    if not db.connect():
+        return jsonify({'error':'unable to connect to the database'}), 400
+
+    statuses = db.deployment_get_statuses(ids,
+                                          request.args.get('identity'),
+                                          request.args.get('status'),
+                                          request.args.get('after'),
+                                          limit)
+    if statuses is None:
+        db.close()
+        return jsonify({'error':'unable to get the status of infrastructures'}), 500
+
+    response = Response(stream_statuses(db, statuses, limit), mimetype='application/json')
+    response.call_on_close(db.close)
+    return response
+
+def get_int_arg(name, default):
+    """
+    Return an integer query parameter, or None if it is not an integer
+    """
+    try:
+        return int(request.args.get(name, default))
+    except (TypeError, ValueError):
+        return None
+
+@app.route('/infrastructures/changes', methods=['GET'])
+@requires_auth
+def get_infrastructures_changes():
+    """
+    Get infrastructures which changed after the specified change sequence number, waiting
+    up to the specified timeout for changes if there are none yet
+    """
+    since = get_int_arg('since', 0)
+    timeout = get_int_arg('timeout', 0)
+    limit = get_int_arg('limit', CONFIG.api.page_size)
+    if since is None or timeout is None or limit is None:
+        return jsonify({'error':'since, timeout and limit must be integers'}), 400
+    timeout = max(0, min(timeout, CONFIG.api.poll_timeout_max))
+    limit = max(1, min(limit, CONFIG.api.page_size_max))
+
+    # Take the generation before querying so that no change made in between is missed
+    generation = listener.get_generation()
+    (changes, resync) = get_changes(since, limit)
+    if changes == [] and resync is None and timeout and listener.wait_for_change(generation, timeout):
+        (changes, resync) = get_changes(since, limit)
+
+    if changes is None:
+        return jsonify({'error':'unable to get changes'}), 400
+
+    if resync is not None:
+        return jsonify({'error':'changes after since have been removed, get the status of all infrastructures again',
+                        'next':resync}), 410
+
+    return jsonify({'changes':changes, 'next':changes[-1]['seq'] if changes else since}), 200
+
+def get_changes(since, limit):
+    """
+    Return changes after the specified change sequence number, holding a connection from
+    the pool only while querying. If changes after it have been removed, also return the
+    latest change sequence number, from which to continue after getting all statuses again.
+    """
+    db = database.get_pooled_db()
+    if not db.connect():
+        return (None, None)
+
+    changes = db.deployment_get_changes(since, limit)
+    resync = None
+    # Check after getting the changes so that any removed in between are noticed
+    if changes is not None:
+        start = db.deployment_get_changes_start()
+        if start is None:
+            changes = None
+        elif since < start:
+            resync = db.deployment_get_latest_change()
+            if resync is None:
+                changes = None
+    db.close()
+
+    return (changes, resync)
+
+def stream_changes(since):
+    """
+    Generate server-sent events for changes to infrastructures after the specified change
+    sequence number, with a comment sent periodically to keep the connection open
+    """
+    while True:
+        generation = listener.get_generation()
+        (changes, resync) = get_changes(since, CONFIG.api.page_size)
+        if changes is None:
+            break
+        if resync is not None:
+            since = resync
+            yield 'id: %d\nevent: reset\ndata: %s\n\n' % (since, json.dumps({'next': since}))
+            continue
+        for change in changes:
+            since = change['seq']
+            yield 'id: %d\nevent: change\ndata: %s\n\n' % (since, json.dumps(change))
+        if not changes and not listener.wait_for_change(generation, CONFIG.api.stream_keepalive):
+            yield ': keepalive\n\n'
+
+@app.route('/infrastructures/changes/stream', methods=['GET'])
+@requires_auth
+def get_infrastructures_changes_stream():
+    """
+    Stream changes to infrastructures as server-sent events, starting after the last event
+    received by the client if reconnecting, otherwise from now
+    """
+    since = request.headers.get('Last-Event-ID', request.args.get('since'))
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return jsonify({'error':'since must be an integer'}), 400
+
+    if since is None:
+        db = database.get_pooled_db()
+        if not db.connect():
+            return jsonify({'error':'unable to connect to the database'}), 400
+        since = db.deployment_get_latest_change()
+        db.close()
+        if since is None:
+            return jsonify({'error':'unable to get changes'}), 400
+
+    return Response(stream_changes(since),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/health', methods=['GET'])
 def get_health():
     """
-    Get the current health
+    Get the current health, as last checked in the background. The report is only
+    returned on success to clients which ask for JSON, as others expect no content.
     """
-    (status, msg) = health.health()
-    if not status:
-        return jsonify({'error': msg}), 409
+    (healthy, report) = health.cached_health()
+    if not healthy:
+        return jsonify(report), 409
+
+    if 'application/json' not in request.accept_mimetypes.values():
+        return jsonify({}), 204
 
-    return jsonify({}), 204
+    return jsonify(report), 200
 
 @app.route('/infrastructures/<string:infra_id>', methods=['GET'])
 @requires_auth
@@ -172,19 +432,25 @@ def get_infrastructure(infra_id):
     logger = custom_logger.CustomAdapter(logging.getLogger(__name__), {'id': infra_id})
     logger.info('Infrastructure status request')
 
-    im_infra_id = None
     status = None
-    status_reason = None
-    cloud = None
 
-    db = database.get_db()
+    db = database.get_pooled_db()
     if db.connect():
-        (im_infra_id, status, cloud, _, _) = db.deployment_get_im_infra_id(infra_id)
-        if status in ('unable', 'failed', 'waiting'):
-            status_reason = db.deployment_get_status_reason(infra_id)
+        # Only the version is needed if the client already has the current status
+        if request.if_none_match:
+            version = db.deployment_get_version(infra_id)
+            if version is not None and request.if_none_match.contains(str(version)):
+                db.close()
+                return not_modified(str(version))
+        status = db.deployment_get_status(infra_id)
     db.close()
     if status:
-        return jsonify({'status':status, 'status_reason':status_reason, 'cloud':cloud, 'infra_id':im_infra_id}), 200
+        response = jsonify({'status':status['status'],
+                            'status_reason':status['status_reason'],
+                            'cloud':status['cloud'],
+                            'infra_id':status['infra_id']})
+        response.set_etag(str(status['seq']))
+        return response
     return jsonify({'status':'invalid'}), 404
 
 @app.route('/infrastructures/<string:infra_id>', methods=['DELETE'])
@@ -196,7 +462,7 @@ def delete_infrastructure(infra_id):
     logger = custom_logger.CustomAdapter(logging.getLogger(__name__), {'id': infra_id})
 
     if 'type' not in request.args:
-        db = database.get_db()
+        db = database.get_pooled_db()
         if db.connect():
             # Get current status of infrastructure
             (_, status, _, _, _) = db.deployment_get_im_infra_id(infra_id)
@@ -212,21 +478,21 @@ def delete_infrastructure(infra_id):
                 return jsonify({}), 200
 
             success = db.deployment_update_status(infra_id, 'deletion-requested')
+            db.close()
             if success:
-                db.close()
                 logger.info('Infrastructure deletion request successfully initiated')
                 return jsonify({}), 200
         logger.critical('Infrastructure deletion request failed, possibly a database issue')
         return jsonify({}), 400
     elif request.args.get('type') == 'im':
         cloud = request.args.get('cloud')
-        db = database.get_db()
+        db = database.get_pooled_db()
         if db.connect():
-            clouds_info_list = utilities.create_clouds_list(CONFIG.get('clouds', 'path'))
+            clouds_info_list = utilities.create_clouds_list(CONFIG.clouds.path)
             token = tokens.get_token(cloud, None, db, clouds_info_list)
             db.close()
             im_auth = utilities.create_im_auth(cloud, token, clouds_info_list)
-            client = imclient.IMClient(url=CONFIG.get('im', 'url'), data=im_auth)
+            client = imclient.IMClient(url=CONFIG.im.url, data=im_auth)
             (status, msg) = client.getauth()
             if status != 0:
                 logger.critical('Error reading IM auth file: %s', msg)
@@ -253,7 +519,7 @@ def create_user_credentials():
     if not username or not refresh_token:
         return jsonify({'error':'json data not valid'}), 400
 
-    db = database.get_db()
+    db = database.get_pooled_db()
     if db.connect():
         status = db.set_user_credentials(username, refresh_token)
         db.close()
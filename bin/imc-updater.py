@@ -16,14 +16,15 @@ from imc import deployer
 from imc import destroyer
 from imc import cloud_updates
 from imc import cloud_utils
+from imc import cloud_quotas
 
 # Configuration
 CONFIG = config.get_config()
 
 # Logging
-handler = RotatingFileHandler(filename=CONFIG.get('logs', 'filename').replace('.log', '-updater.log'),
-                              maxBytes=int(CONFIG.get('logs', 'max_bytes')),
-                              backupCount=int(CONFIG.get('logs', 'num')))
+handler = RotatingFileHandler(filename=CONFIG.logs.filename.replace('.log', '-updater.log'),
+                              maxBytes=CONFIG.logs.max_bytes,
+                              backupCount=CONFIG.logs.num)
 formatter = logging.Formatter('%(asctime)s %(levelname)s [%(threadName)s %(name)s] %(message)s')
 handler.setFormatter(formatter)
 logger = logging.getLogger('imc')
@@ -44,6 +45,13 @@ def handle_signal(signum, frame):
     EXIT_NOW = True
     logger.info('Received signal %d, shutting down...', signum)
 
+def handle_reload(signum, frame):
+    """
+    Reload configuration
+    """
+    logger.info('Received signal %d, reloading configuration...', signum)
+    config.reload_config()
+
 def updater(db, executors, last_fast_update_time):
     """
     Find identities which need checking
@@ -61,7 +69,7 @@ def updater(db, executors, last_fast_update_time):
             identities.append(infra['identity'])
 
     for infra in infras_waiting:
-        if time.time() - infra['updated'] > int(CONFIG.get('updates', 'waiting')):
+        if time.time() - infra['updated'] > CONFIG.updates.waiting:
             infras.append(infra)
 
     # Check if we should run a fast check, per identity
@@ -82,8 +90,8 @@ def updater(db, executors, last_fast_update_time):
         if not last_update_start:
             logger.info('Submitting updater for identity %s as it has not run before', identity)
             executors.submit(cloud_updates.update, identity, 0, False)
-        elif time.time() - last_update > int(CONFIG.get('updates', 'discover')) and \
-            time.time() - last_update_start > int(CONFIG.get('updates', 'deadline')):
+        elif time.time() - last_update > CONFIG.updates.discover and \
+            time.time() - last_update_start > CONFIG.updates.deadline:
             logger.info('Submitting updater for identity %s', identity)
             executors.submit(cloud_updates.update, identity, 0, False)
 
@@ -95,12 +103,18 @@ def updater(db, executors, last_fast_update_time):
             logger.info('Submitting updater for static resources')
             executors.submit(cloud_updates.update, 'static', 0, True)
             checked_static = True
-        elif time.time() - last_update > int(CONFIG.get('updates', 'discover')) and \
-            time.time() - last_update_start > int(CONFIG.get('updates', 'deadline')):
+        elif time.time() - last_update > CONFIG.updates.discover and \
+            time.time() - last_update_start > CONFIG.updates.deadline:
             logger.info('Submitting updater for static resources')
             executors.submit(cloud_updates.update, 'static', 0, True)
             checked_static = True
 
+    # Refresh quotas in the background, this is throttled & coalesced per identity
+    for identity in identities:
+        cloud_quotas.request_update(identity)
+    if len(identities) > 0:
+        cloud_quotas.request_update('static', True)
+
     # Check for any new static or user-defined resources
     if cloud_utils.check_for_new_clouds(db, 'static') and not checked_static:
         logger.info('Running updates due to new clouds')
@@ -110,9 +124,11 @@ def updater(db, executors, last_fast_update_time):
 
 if __name__ == "__main__":
     signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGHUP, handle_reload)
 
     logger.info('Creating thread pool')
-    executors = ThreadPoolExecutor(int(CONFIG.get('pool', 'updaters')))
+    pool_updaters = CONFIG.pool.updaters
+    executors = ThreadPoolExecutor(pool_updaters)
 
     logger.info('Entering main polling loop')
     last_fast_update_time = 0
@@ -121,7 +137,14 @@ if __name__ == "__main__":
         if EXIT_NOW:
             logger.info('Exiting')
             sys.exit(0)
- 
+
+        # Resize pool if the configuration has changed, running updaters are left to complete
+        if CONFIG.pool.updaters != pool_updaters:
+            logger.info('Changing number of updaters from %d to %d', pool_updaters, CONFIG.pool.updaters)
+            pool_updaters = CONFIG.pool.updaters
+            executors.shutdown(wait=False)
+            executors = ThreadPoolExecutor(pool_updaters)
+
         db = database.get_db()
         if db.connect():
             last_fast_update_time = updater(db, executors, last_fast_update_time)
@@ -129,5 +152,5 @@ if __name__ == "__main__":
         else:
             logger.critical('Unable to connect to database')
 
-        time.sleep(int(CONFIG.get('polling', 'updater')))
+        time.sleep(CONFIG.polling.updater)
 
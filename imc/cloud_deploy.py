@@ -7,7 +7,7 @@ from string import Template
 import time
 import random
 import logging
-import configparser
+import threading
 
 from imc import config
 from imc import database
@@ -37,15 +37,58 @@ def update_im_client(client, cloud, identity, db, clouds_info_list):
     if status != 0:
         logger.critical('Error reading IM auth file in update_im_client: %s', msg)
 
-def deploy(radl, cloud, time_begin, unique_id, identity, db, num_nodes=1, used_cpus=1, used_memory=1):
+class HedgeGroup(object):
     """
-    Deploy infrastructure from a specified RADL file
+    Deployments of the same infrastructure on several clouds at once, where the first to
+    be configured is kept and the others are cancelled
+    """
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self.winner = None
+        self._lock = threading.Lock()
+
+    def claim(self, cloud):
+        """
+        Claim the infrastructure for a cloud, returning False if another cloud already has
+        """
+        with self._lock:
+            if self.winner:
+                return False
+            self.winner = cloud
+            self.cancelled.set()
+            return True
+
+def pause(hedge, duration):
+    """
+    Sleep, returning True early if the hedge group has been cancelled
+    """
+    if hedge:
+        return hedge.cancelled.wait(duration)
+    time.sleep(duration)
+    return False
+
+def poll_delay(delay, elapsed, expected):
+    """
+    Return the delay before next polling the state of infrastructure. The delay grows
+    from the previous one up to [polling] duration, except that if a state transition is
+    expected in future the next poll is made just after it.
+    """
+    delay = min(delay*CONFIG.polling.factor, CONFIG.polling.duration)
+    if expected and expected > elapsed:
+        delay = min(max(expected - elapsed, CONFIG.polling.minimum), CONFIG.polling.duration)
+    return delay
+
+def deploy(radl, cloud, time_begin, unique_id, identity, db, num_nodes=1, used_cpus=1, used_memory=1, hedge=None, flavour_class=''):
+    """
+    Deploy infrastructure from a specified RADL file. When part of a hedge group the
+    cloud, IM infrastructure ID & resources are not stored, as only the deployment which
+    claims the infrastructure should do so.
     """
     # Get full list of cloud info
     clouds_info_list = cloud_utils.create_clouds_list(db, identity)
 
     # Setup Infrastructure Manager client
-    client = imclient.IMClient(url=CONFIG.get('im', 'url'))
+    client = imclient.IMClient(url=CONFIG.im.url)
 
     # Set availability zone in RADL if necessary TODO: remove OPA
     #cloud_info = opa_client.get_cloud(cloud)
@@ -56,15 +99,18 @@ def deploy(radl, cloud, time_begin, unique_id, identity, db, num_nodes=1, used_c
     #        logger.info('Using availability zone %s', availability_zones[0])
     #        radl_base = utilities.set_availability_zone(radl_base, availability_zones[0])
 
-    retries_per_cloud = int(CONFIG.get('deployment', 'retries'))
+    retries_per_cloud = CONFIG.deployment.retries
     retry = 0
     success = False
     time_begin_this_cloud = time.time()
 
     # Retry loop
     while retry < retries_per_cloud + 1 and not success:
-        if retry > 0:
-            time.sleep(int(CONFIG.get('polling', 'duration')))
+        if retry > 0 and pause(hedge, CONFIG.polling.duration):
+            logger.info('Infrastructure deployed on cloud %s, not retrying on cloud %s', hedge.winner, cloud)
+            return (None, None)
+        if hedge and hedge.cancelled.is_set():
+            return (None, None)
         logger.info('Deployment attempt %d of %d', retry+1, retries_per_cloud+1)
         retry += 1
 
@@ -76,48 +122,68 @@ def deploy(radl, cloud, time_begin, unique_id, identity, db, num_nodes=1, used_c
 
         # Create infrastructure
         update_im_client(client, cloud, identity, db, clouds_info_list)
-        (infrastructure_id, msg) = client.create(radl, int(CONFIG.get('timeouts', 'creation')))
+        (infrastructure_id, msg) = client.create(radl, CONFIG.timeouts.creation)
 
         if infrastructure_id:
             logger.info('Created infrastructure on cloud %s with IM id %s and waiting for it to be configured', cloud, infrastructure_id)
             if not db.create_im_deployment(unique_id, infrastructure_id):
                 logger.critical('Unable to add IM infrastructure ID %s for infra with id %s to deployments log', infrastructure_id, unique_id)
 
-            # Set the cloud & IM infrastructure ID
-            db.deployment_update_status(unique_id, None, cloud, infrastructure_id)
+            if not hedge:
+                # Set the cloud & IM infrastructure ID
+                db.deployment_update_status(unique_id, None, cloud, infrastructure_id)
 
-            # Set the resources used by this infrastructure
-            db.deployment_update_resources(unique_id, num_nodes, used_cpus, used_memory)
+                # Set the resources used by this infrastructure
+                db.deployment_update_resources(unique_id, num_nodes, used_cpus, used_memory)
 
-            # Change the status
-            db.deployment_update_status(unique_id, 'creating')
+                # Change the status
+                db.deployment_update_status(unique_id, 'creating')
 
             time_created = time.time()
             count_unconfigured = 0
             state_previous = None
+            time_running = -1
+
+            # Poll often at first & after state changes, and just after the times other
+            # deployments on this cloud took to enter the running & configured states
+            (expected_running, expected_configured) = db.get_deployment_durations(cloud, CONFIG.polling.history)
+            delay = CONFIG.polling.minimum
 
             # Wait for infrastructure to enter the configured state
             while True:
-                # Sleep
-                time.sleep(int(CONFIG.get('polling', 'duration')))
+                # Sleep, stopping if infrastructure has been deployed on another cloud
+                if pause(hedge, delay):
+                    logger.info('Infrastructure deployed on cloud %s, so destroying infrastructure with IM id %s on cloud %s', hedge.winner, infrastructure_id, cloud)
+                    update_im_client(client, cloud, identity, db, clouds_info_list)
+                    destroy.destroy(client, infrastructure_id)
+                    return (None, None)
+
+                expected = expected_configured if state_previous == 'running' else expected_running
+                delay = poll_delay(delay, time.time() - time_begin_this_cloud, expected)
 
                 # Check if we should stop
                 (im_infra_id_new, infra_status_new, cloud_new, _, _) = db.deployment_get_im_infra_id(unique_id)
                 if infra_status_new in ('deletion-requested', 'deleted', 'deletion-failed', 'deleting'):
                     logger.info('Deletion requested of infrastructure so aborting deployment')
+                    # Hedged deployments are not recorded in the deployments table, so the
+                    # destroyer does not know about this IM infrastructure
+                    if hedge:
+                        logger.info('Destroying infrastructure with IM id %s on cloud %s', infrastructure_id, cloud)
+                        update_im_client(client, cloud, identity, db, clouds_info_list)
+                        destroy.destroy(client, infrastructure_id)
                     return (None, None)
 
                 # Don't spend too long trying to create infrastructure, give up eventually
-                if time.time() - time_begin > int(CONFIG.get('timeouts', 'total')):
+                if time.time() - time_begin > CONFIG.timeouts.total:
                     logger.info('Giving up, total time waiting is too long, so will destroy infrastructure with IM id %s', infrastructure_id)
-                    db.set_deployment_failure(cloud, identity, 5, time.time()-time_begin)
+                    db.set_deployment_failure(cloud, identity, 5, time.time()-time_begin, flavour_class=flavour_class, instances=num_nodes)
                     update_im_client(client, cloud, identity, db, clouds_info_list)
                     destroy.destroy(client, infrastructure_id)
                     return (None, None)
 
                 # Get the current overall state & states of all VMs in the infrastructure
                 update_im_client(client, cloud, identity, db, clouds_info_list)
-                (states, msg) = client.getstates(infrastructure_id, int(CONFIG.get('timeouts', 'status')))
+                (states, msg) = client.getstates(infrastructure_id, CONFIG.timeouts.status)
                 logger.info('InfraID=%s IM_ID=%s has state: %s', unique_id, infrastructure_id, msg)
 
                 # If state is not known, wait
@@ -143,27 +209,35 @@ def deploy(radl, cloud, time_begin, unique_id, identity, db, num_nodes=1, used_c
                 if state != state_previous:
                     logger.info('Infrastructure with IM id %s is in state %s', infrastructure_id, state)
                     state_previous = state
+                    delay = CONFIG.polling.minimum
+                    if state == 'running' and time_running == -1:
+                        time_running = time.time() - time_begin_this_cloud
 
                 # Handle difference situation when state is configured
                 if state == 'configured':
                     # The final configured state
                     logger.info('Successfully configured infrastructure on cloud %s, took %d secs', cloud, time.time() - time_begin_this_cloud)
-                    db.set_deployment_failure(cloud, identity, 0, time.time()-time_begin_this_cloud)
+                    db.set_deployment_failure(cloud, identity, 0, time.time()-time_begin_this_cloud, time_running, flavour_class, num_nodes)
+                    if hedge and not hedge.claim(cloud):
+                        logger.info('Infrastructure already deployed on cloud %s, so destroying infrastructure with IM id %s on cloud %s', hedge.winner, infrastructure_id, cloud)
+                        update_im_client(client, cloud, identity, db, clouds_info_list)
+                        destroy.destroy(client, infrastructure_id)
+                        return (None, None)
                     success = True
                     return (infrastructure_id, None)
 
                 # Destroy infrastructure which is taking too long to enter the configured state
-                if time.time() - time_created > int(CONFIG.get('timeouts', 'configured')):
+                if time.time() - time_created > CONFIG.timeouts.configured:
                     logger.warning('Waiting too long for infrastructure to be configured, so destroying')
-                    db.set_deployment_failure(cloud, identity, 3, time.time()-time_created)
+                    db.set_deployment_failure(cloud, identity, 3, time.time()-time_created, flavour_class=flavour_class, instances=num_nodes)
                     update_im_client(client, cloud, identity, db, clouds_info_list)
                     destroy.destroy(client, infrastructure_id)
                     break
 
                 # Destroy infrastructure which is taking too long to enter the running state
-                if time.time() - time_created > int(CONFIG.get('timeouts', 'notrunning')) and state != 'running' and state != 'unconfigured':
+                if time.time() - time_created > CONFIG.timeouts.notrunning and state != 'running' and state != 'unconfigured':
                     logger.warning('Waiting too long for infrastructure to enter the running state, so destroying')
-                    db.set_deployment_failure(cloud, identity, 2, time.time()-time_created)
+                    db.set_deployment_failure(cloud, identity, 2, time.time()-time_created, flavour_class=flavour_class, instances=num_nodes)
                     update_im_client(client, cloud, identity, db, clouds_info_list)
                     destroy.destroy(client, infrastructure_id)
                     break
@@ -174,22 +248,27 @@ def deploy(radl, cloud, time_begin, unique_id, identity, db, num_nodes=1, used_c
 
                     # Get the full data about the infrastructure from IM, as we can use it to determine what
                     # caused some failures
-                    (_, msg) = client.getdata(infrastructure_id, int(CONFIG.get('timeouts', 'status')))
+                    (_, msg) = client.getdata(infrastructure_id, CONFIG.timeouts.status)
                     fatal_failure = False
                     reason = None
 
                     if '403 Forbidden Quota' in msg:
                         logger.info('Infrastructure creation failed due to quota exceeded on cloud %s, our id=%s, IM id=%s', cloud, unique_id, infrastructure_id)
-                        db.set_deployment_failure(cloud, identity, 6, time.time()-time_created)
+                        db.set_deployment_failure(cloud, identity, 6, time.time()-time_created, flavour_class=flavour_class, instances=num_nodes)
                         fatal_failure = True
                         reason = 'QuotaExceeded'
                     elif 'No image found with ID' in msg:
                         logger.info('Infrastructure creation failed due to image not found on cloud %s, our id=%s, IM id=%s', cloud, unique_id, infrastructure_id)
-                        db.set_deployment_failure(cloud, identity, 7, time.time()-time_created)
+                        db.set_deployment_failure(cloud, identity, 7, time.time()-time_created, flavour_class=flavour_class, instances=num_nodes)
                         fatal_failure = True
                         reason = 'ImageNotFound'
+                    elif 'No valid host' in msg:
+                        logger.info('Infrastructure creation failed due to no valid host on cloud %s, our id=%s, IM id=%s', cloud, unique_id, infrastructure_id)
+                        db.set_deployment_failure(cloud, identity, 8, time.time()-time_created, flavour_class=flavour_class, instances=num_nodes)
+                        fatal_failure = True
+                        reason = 'NoValidHost'
                     else:
-                        db.set_deployment_failure(cloud, identity, 1, time.time()-time_created)
+                        db.set_deployment_failure(cloud, identity, 1, time.time()-time_created, flavour_class=flavour_class, instances=num_nodes)
 
                     update_im_client(client, cloud, identity, db, clouds_info_list)
                     destroy.destroy(client, infrastructure_id)
@@ -203,9 +282,9 @@ def deploy(radl, cloud, time_begin, unique_id, identity, db, num_nodes=1, used_c
                 # Handle unconfigured infrastructure
                 if state == 'unconfigured':
                     count_unconfigured += 1
-                    file_unconf = '%s/contmsg-%s-%d.txt' % (CONFIG.get('logs', 'contmsg'), unique_id, time.time())
-                    contmsg = client.getcontmsg(infrastructure_id, int(CONFIG.get('timeouts', 'deletion')))
-                    if count_unconfigured < int(CONFIG.get('deployment', 'reconfigures')) + 1:
+                    file_unconf = '%s/contmsg-%s-%d.txt' % (CONFIG.logs.contmsg, unique_id, time.time())
+                    contmsg = client.getcontmsg(infrastructure_id, CONFIG.timeouts.deletion)
+                    if count_unconfigured < CONFIG.deployment.reconfigures + 1:
                         logger.warning('Infrastructure on cloud %s is unconfigured, will try reconfiguring after writing contmsg to a file', cloud)
                         try:
                             with open(file_unconf, 'w') as unconf:
@@ -213,10 +292,10 @@ def deploy(radl, cloud, time_begin, unique_id, identity, db, num_nodes=1, used_c
                         except Exception as error:
                             logger.warning('Unable to write contmsg to file')
                         update_im_client(client, cloud, identity, db, clouds_info_list)
-                        client.reconfigure(infrastructure_id, int(CONFIG.get('timeouts', 'reconfigure')))
+                        client.reconfigure(infrastructure_id, CONFIG.timeouts.reconfigure)
                     else:
                         logger.warning('Infrastructure has been unconfigured too many times, so destroying after writing contmsg to a file')
-                        db.set_deployment_failure(cloud, identity, 4, time.time()-time_created)
+                        db.set_deployment_failure(cloud, identity, 4, time.time()-time_created, flavour_class=flavour_class, instances=num_nodes)
                         try:
                             with open(file_unconf, 'w') as unconf:
                                 unconf.write(contmsg)
@@ -229,10 +308,10 @@ def deploy(radl, cloud, time_begin, unique_id, identity, db, num_nodes=1, used_c
             logger.warning('Deployment failure on cloud %s with id %s with msg="%s"', cloud, infrastructure_id, msg)
             if msg == 'timedout':
                 logger.warning('Infrastructure creation failed due to a timeout')
-                db.set_deployment_failure(cloud, identity, 4, time.time()-time_created)
+                db.set_deployment_failure(cloud, identity, 4, time.time()-time_created, flavour_class=flavour_class, instances=num_nodes)
             else:
-                file_failed = '%s/failed-%s-%d.txt' % (CONFIG.get('logs', 'contmsg'), unique_id, time.time())
-                db.set_deployment_failure(cloud, identity, 4, time.time()-time_created)
+                file_failed = '%s/failed-%s-%d.txt' % (CONFIG.logs.contmsg, unique_id, time.time())
+                db.set_deployment_failure(cloud, identity, 4, time.time()-time_created, flavour_class=flavour_class, instances=num_nodes)
                 logger.warning('Infrastructure creation failed, writing stdout/err to file "%s"', file_failed)
                 try:
                     with open(file_failed, 'w') as failed:
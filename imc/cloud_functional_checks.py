@@ -1,12 +1,15 @@
 """Check if clouds are functional"""
 from __future__ import print_function
+from concurrent.futures import ThreadPoolExecutor, wait
 import logging
+import time
 
 from imc import appdbclient
 from imc import config
 from imc import tokens
 from imc import utilities
 from imc import cloud_utils
+from imc import providers
 
 # Configuration
 CONFIG = config.get_config()
@@ -14,12 +17,17 @@ CONFIG = config.get_config()
 # Logging
 logger = logging.getLogger(__name__)
 
+# Circuit breaker states. A cloud is only marked as up when its breaker is closed.
+BREAKER_CLOSED = 0
+BREAKER_OPEN = 1
+BREAKER_HALF_OPEN = 2
+
 def update_appdb_status(db, identity):
     """
     Update status from AppDB
     """
     sites_status = {}
-    if CONFIG.get('features', 'enable_appdb'):
+    if CONFIG.features.enable_appdb:
         logger.info('Getting cloud status from AppDB')
         sites_status = appdbclient.get_cloud_status_appdb()
 
@@ -47,14 +55,27 @@ def update_appdb_status(db, identity):
 
 def update_clouds_status(db, identity, config):
     """
-    Update status of each cloud
+    Update status of each cloud, checking clouds concurrently
     """
+    breakers = {}
+    probes = {}
+
     for cloud_info in config:
         name = cloud_info['name']
 
         if cloud_info['type'] != 'cloud':
             continue
 
+        # Clouds with an open circuit breaker are not checked until their backoff has expired
+        (state, failures, retry) = db.get_cloud_breaker(name, identity)
+        if state == BREAKER_OPEN:
+            if time.time() < retry:
+                logger.info('Circuit breaker for cloud %s is open, not checking for another %d secs', name, retry - time.time())
+                continue
+            logger.info('Circuit breaker for cloud %s is half-open, checking again', name)
+            state = BREAKER_HALF_OPEN
+            db.set_cloud_breaker(name, identity, 1, state, failures, retry)
+
         logger.info('Checking cloud %s', name)
 
         # Check if a token is necessary
@@ -71,53 +92,62 @@ def update_clouds_status(db, identity, config):
             logger.error('Unable to get token so cannot check if cloud %s is functional', name)
             continue
 
-        retryme = False
-        try:
-            status = check_cloud(name, cloud_info, token)
-        except:
-            logger.info('Setting status of cloud %s to down due to timeout', name)
-            db.set_cloud_status(name, identity, 1)
-        else:
-            if not status:
-                logger.info('Setting status of cloud %s to down, will retry', name)
-                retryme = True
-                db.set_cloud_status(name, identity, 1)
-            else:
-                logger.info('Cloud %s is functional', name)
-                db.set_cloud_status(name, identity, 0)
-          
-        if retryme:
+        breakers[name] = (state, failures)
+        probes[name] = (cloud_info, token)
+
+    if not probes:
+        return
+
+    executor = ThreadPoolExecutor(CONFIG.checks.workers)
+    futures = {}
+    for name in probes:
+        (cloud_info, token) = probes[name]
+        futures[executor.submit(check_cloud, name, cloud_info, token)] = name
+
+    (done, _) = wait(futures, timeout=CONFIG.timeouts.probe)
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    for future in futures:
+        name = futures[future]
+        functional = False
+        if future in done:
             try:
-                status = check_cloud(name, cloud_info, token)
-            except:
-                logger.info('Setting status of cloud %s to down due to timeout', name)
-                db.set_cloud_status(name, identity, 1)
-            else:
-                if not status:
-                    logger.info('Setting status of cloud %s to down SECOND ATTEMPT', name)
-                    db.set_cloud_status(name, identity, 1)
-                else:
-                    db.set_cloud_status(name, identity, 0)
+                functional = future.result()
+            except Exception as err:
+                logger.warning('Got exception checking cloud %s: %s', name, err)
+        else:
+            logger.info('Check of cloud %s timed out', name)
 
-def check_cloud(cloud, config, token):
+        (state, failures) = breakers[name]
+        update_breaker(db, name, identity, state, failures, functional)
+
+def update_breaker(db, name, identity, state, failures, functional):
     """
-    Check if a cloud is functional by listing locations
+    Update the status & circuit breaker of a cloud following a check
     """
-    # Connect to the cloud
-    conn = cloud_utils.connect_to_cloud(cloud, config, token)
-    if not conn:
-        return False
+    if functional:
+        logger.info('Cloud %s is functional', name)
+        db.set_cloud_breaker(name, identity, 0, BREAKER_CLOSED, 0, 0)
+        return
 
-    # List locations (it's quick!)
-    images = None
-    try:
-        images = conn.list_images()
-    except Exception as ex:
-        logger.warning('Unable to list locations on cloud %s due to %s', cloud, ex)
-        return False
+    failures += 1
+    threshold = CONFIG.checks.failures
 
-    if not images:
-        logger.warning('Unable to list images on cloud %s', cloud)
+    if state == BREAKER_HALF_OPEN or failures >= threshold:
+        backoff = min(CONFIG.checks.backoff*2**min(max(failures - threshold, 0), 16),
+                      CONFIG.checks.backoff_max)
+        logger.info('Setting status of cloud %s to down and opening its circuit breaker for %d secs', name, backoff)
+        db.set_cloud_breaker(name, identity, 1, BREAKER_OPEN, failures, time.time() + backoff)
+    else:
+        logger.info('Setting status of cloud %s to down', name)
+        db.set_cloud_breaker(name, identity, 1, BREAKER_CLOSED, failures, 0)
 
-    return True
+def check_cloud(cloud, config, token):
+    """
+    Check if a cloud is functional by making a lightweight authenticated request
+    """
+    provider = providers.get_provider(config['credentials']['type'])
+    if not provider:
+        return False
 
+    return provider.health_probe(cloud, config, token)
@@ -1,19 +1,16 @@
 """Get images & flavours available on a cloud"""
 
+import hashlib
 import json
 import logging
 import os
 import re
 import sys
 import time
-import configparser
-
-from libcloud.compute.types import Provider
-from libcloud.compute.providers import get_driver
 
 from imc import config
 from imc import tokens
-from imc import cloud_utils
+from imc import providers
 from imc import utilities
 
 # Configuration
@@ -22,6 +19,9 @@ CONFIG = config.get_config()
 # Logging
 logger = logging.getLogger(__name__)
 
+# Compiled image template matchers, keyed by the template names
+MATCHERS = utilities.LRUCache(256)
+
 def add_defaults(data, config):
     """
     Add any default images/flavours if they do not already exist in data retrieved from the cloud
@@ -44,46 +44,56 @@ def add_defaults(data, config):
 
 def update_images(db, cloud, identity, images):
     """
-    Update images in the database
+    Update images in the database, returning True if all were written
     """
+    success = True
     for image_name in images:
         image = images[image_name]
         logger.info('Setting image in DB: name=%s, im=%s', image_name, image['im_name'])
-        db.set_image(identity,
-                     cloud,
-                     image_name,
-                     image['im_name'],
-                     image['type'],
-                     image['architecture'],
-                     image['distribution'],
-                     image['version'])
+        if not db.set_image(identity,
+                            cloud,
+                            image_name,
+                            image['im_name'],
+                            image['type'],
+                            image['architecture'],
+                            image['distribution'],
+                            image['version']):
+            success = False
+    return success
 
 def delete_images(db, cloud, identity, old, new):
     """
-    Delete images which no longer exist from the database
+    Delete images which no longer exist from the database, returning True if all were
+    deleted
     """
+    success = True
     for image_old in old:
         name_old = old[image_old]['name']
         found = False
         for image_new in new:
             name_new = new[image_new]['name']
             if name_old == name_new:
-                return True
-        if not found:
-            db.delete_image(identity, cloud, name_old)
+                found = True
+                break
+        if not found and not db.delete_image(identity, cloud, name_old):
+            success = False
+    return success
 
 def update_flavours(db, cloud, identity, flavours):
     """
-    Update flavours in database
+    Update flavours in database, returning True if all were written
     """
+    success = True
     for flavour_name in flavours:
         flavour = flavours[flavour_name]
-        db.set_flavour(identity,
-                       cloud,
-                       flavour['name'],
-                       flavour['cpus'],
-                       flavour['memory'],
-                       flavour['disk'])
+        if not db.set_flavour(identity,
+                              cloud,
+                              flavour['name'],
+                              flavour['cpus'],
+                              flavour['memory'],
+                              flavour['disk']):
+            success = False
+    return success
 
 def is_power2(num):
     """
@@ -120,6 +130,25 @@ def compare_dicts(cloud1, cloud2):
             return False
     return True
 
+def snapshot_hash(images, flavours):
+    """
+    Generate a stable content hash of the images & flavours available on a cloud
+    """
+    content = json.dumps({'images': images, 'flavours': flavours}, sort_keys=True)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def template_matcher(templates):
+    """
+    Return a function checking if an image name contains any of the image template names,
+    using a single precompiled regular expression rather than a test for each template
+    """
+    key = tuple(sorted(templates))
+    matcher = MATCHERS.get(key)
+    if not matcher:
+        matcher = re.compile('|'.join(re.escape(name) for name in key)).search
+        MATCHERS.put(key, matcher)
+    return matcher
+
 def generate_images_and_flavours(config, cloud, token):
     """
     Create a list of images and flavours available on the specified cloud
@@ -128,37 +157,42 @@ def generate_images_and_flavours(config, cloud, token):
     output['images'] = None
     output['flavours'] = None
 
-    # Connect to the cloud
-    conn = cloud_utils.connect_to_cloud(cloud, config, token)
-    if not conn:
+    provider = providers.get_provider(config['credentials']['type'])
+    if not provider:
+        logger.warning('Unable to list images and flavours on cloud %s of type %s', cloud, config['credentials']['type'])
         return output
 
-    # List images
-    try:
-        images = conn.list_images()
-    except Exception as ex:
-        logger.critical('Unable to get list of images from cloud %s due to "%s"', cloud, ex)
-        return output
+    # List images matching any of the templates, with the provider filtering images as
+    # they are received so that the full list is never held in memory
+    if config['image_templates']:
+        try:
+            images = provider.list_images(cloud, config, token, template_matcher(config['image_templates']))
+        except Exception as ex:
+            logger.critical('Unable to get list of images from cloud %s due to "%s"', cloud, ex)
+            return output
+    else:
+        images = []
 
     output_images = {}
     for image in images:
-        for image_t in config['image_templates']:
-            if image_t in image.name:
-                image_identifier = image.name
-                if config['credentials']['type'] == 'OpenStack':
-                    image_identifier = image.id
+        # If the name contains more than one template name the last template is used
+        image_t = [name for name in config['image_templates'] if name in image['name']][-1]
 
-                data = config['image_templates'][image_t]
-                data['im_name'] = '%s/%s' % (config['image_prefix'], image_identifier)
-                data['name'] = image.name
-                output_images[image.name] = data
+        image_identifier = image['name']
+        if config['credentials']['type'] == 'OpenStack':
+            image_identifier = image['id']
+
+        data = dict(config['image_templates'][image_t])
+        data['im_name'] = '%s/%s' % (config['image_prefix'], image_identifier)
+        data['name'] = image['name']
+        output_images[image['name']] = data
 
     output['images'] = output_images
     logger.info('Got %d images from cloud %s', len(output['images']), cloud)
 
     # List flavours
     try:
-        flavours = conn.list_sizes()
+        flavours = provider.list_flavours(cloud, config, token)
     except Exception as ex:
         logger.critical('Unable to get list of flavours from cloud %s due to "%s"', cloud, ex)
         return output
@@ -168,18 +202,14 @@ def generate_images_and_flavours(config, cloud, token):
         match_obj_name = False
         use = True
         if 'blacklist' in config['flavour_filters']:
-            match_obj_name = re.match(r'%s' % config['flavour_filters']['blacklist'], flavour.name)
+            match_obj_name = re.match(r'%s' % config['flavour_filters']['blacklist'], flavour['name'])
             use = False
 
-        if not match_obj_name or use:
-            try:
-                data = {"name":flavour.name,
-                        "cpus":flavour.vcpus,
-                        "memory":memory_convert(flavour.ram),
-                        "disk":flavour.disk}
-                output_flavours[flavour.name] = data
-            except:
-                pass
+        if (not match_obj_name or use) and flavour['cpus'] is not None:
+            output_flavours[flavour['name']] = {"name":flavour['name'],
+                                                "cpus":flavour['cpus'],
+                                                "memory":memory_convert(flavour['ram']),
+                                                "disk":flavour['disk']}
 
     output['flavours'] = output_flavours
     logger.info('Got %d flavours from cloud %s', len(output['flavours']), cloud)
@@ -218,25 +248,31 @@ def update(db, identity, config):
             logger.info('Not continuing with considering updating details for cloud %s as there is no data', name)
             continue
 
-        # Check if we need to update
+        # Nothing needs to be read from or written to the database if the content hash is
+        # unchanged, unless the stored details have not been checked recently
+        new_hash = snapshot_hash(new_data['images'], new_data['flavours'])
+        (old_hash, last_update) = db.get_cloud_images_hash(name, identity)
         requires_update = False
-        last_update = db.get_cloud_updated_images(name, identity)
-        if time.time() - last_update > int(CONFIG.get('updates', 'vms')):
+        if time.time() - last_update > CONFIG.updates.vms:
             logger.info('Images and flavours for cloud %s have not been updated recently', name)
             requires_update = True
+        elif new_hash == old_hash:
+            logger.info('Images and flavours for cloud %s have not changed, not updating', name)
+            continue
 
         # Get existing images & flavours
         images_old = db.get_images(identity, name)
         flavours_old = db.get_all_flavours(identity, name)
 
         updated = False
+        written = True
 
         # Update cloud VM images if necessary
         if (not images_old or requires_update or not compare_dicts(images_old, new_data['images'])) and new_data['images']:
             if not compare_dicts(images_old, new_data['images']):
                 logger.info('Updating images in DB for cloud %s', name)
-                delete_images(db, name, identity, images_old, new_data['images'])
-                update_images(db, name, identity, new_data['images'])
+                written = delete_images(db, name, identity, images_old, new_data['images']) and written
+                written = update_images(db, name, identity, new_data['images']) and written
                 updated = True
             else:
                 logger.info('Images for cloud %s have not changed, not updating', name)
@@ -245,12 +281,16 @@ def update(db, identity, config):
         if (not flavours_old or requires_update or not compare_dicts(flavours_old, new_data['flavours'])) and new_data['flavours']:
             if not compare_dicts(flavours_old, new_data['flavours']):
                 logger.info('Updating flavours in DB for cloud %s', name)
-                update_flavours(db, name, identity, new_data['flavours'])
+                written = update_flavours(db, name, identity, new_data['flavours']) and written
                 updated = True
             else:
                 logger.info('Flavours for cloud %s have not changed, not updating', name)
 
-        if updated:
-            db.set_cloud_updated_images(name, identity)
+        # Only record the new hash once the DB matches it, so that failed writes are retried
+        if not written:
+            logger.error('Unable to update all images and flavours in DB for cloud %s, will retry', name)
+            continue
+
+        db.set_cloud_images_hash(name, identity, new_hash, updated or requires_update)
 
     return True
@@ -39,7 +39,7 @@ def update(identity, level=0, static=False):
         time.sleep(random.randint(1,5))
 
         # Update list of clouds if necessary
-        if CONFIG.get('egi', 'enabled').lower() == 'true' and not static:
+        if CONFIG.egi.enabled and not static:
             egi_discover.egi_clouds_update(identity, db)
 
     # Get full list of cloud info
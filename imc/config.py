@@ -1,16 +1,249 @@
-import os
+"""Configuration, parsed & validated once and shared by all modules"""
 import configparser
+import logging
+import os
+import threading
+
+# Logging
+logger = logging.getLogger(__name__)
+
+def to_bool(value):
+    """
+    Convert a configuration value to a bool
+    """
+    if value.strip().lower() in ('true', 'yes', 'on', '1'):
+        return True
+    if value.strip().lower() in ('false', 'no', 'off', '0', ''):
+        return False
+    raise ValueError('invalid boolean value "%s"' % value)
+
+def to_list(value):
+    """
+    Convert a comma-separated configuration value to a list
+    """
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+# Type and default value of each option. Options with no default must be present.
+REQUIRED = object()
+SCHEMA = {
+    'timeouts': {'creation': (int, REQUIRED),
+                 'configured': (int, REQUIRED),
+                 'notrunning': (int, REQUIRED),
+                 'deletion': (int, REQUIRED),
+                 'reconfigure': (int, REQUIRED),
+                 'total': (int, REQUIRED),
+                 'status': (int, REQUIRED),
+                 'cloud': (int, 600),
+                 'probe': (int, 60)},
+    'checks': {'workers': (int, 8),
+               'failures': (int, 1),
+               'backoff': (int, 300),
+               'backoff_max': (int, 3600)},
+    'deletion': {'retries': (int, REQUIRED),
+                 'factor': (float, REQUIRED)},
+    'polling': {'duration': (int, REQUIRED),
+                'minimum': (int, 10),
+                'factor': (float, 1.5),
+                'history': (int, 24*60*60),
+                'cleaning': (int, REQUIRED),
+                'manager': (int, REQUIRED),
+                'updater': (int, REQUIRED)},
+    'updates': {'quotas': (int, REQUIRED),
+                'vms': (int, REQUIRED),
+                'waiting': (int, REQUIRED),
+                'discover': (int, REQUIRED),
+                'deadline': (int, REQUIRED),
+                'images_page_size': (int, 500)},
+    'logs': {'filename': (str, REQUIRED),
+             'max_bytes': (int, REQUIRED),
+             'num': (int, REQUIRED),
+             'contmsg': (str, REQUIRED)},
+    'im': {'url': (str, REQUIRED),
+           'username': (str, REQUIRED),
+           'password': (str, REQUIRED)},
+    'pool': {'deployers': (int, REQUIRED),
+             'deleters': (int, REQUIRED),
+             'updaters': (int, REQUIRED),
+             'connections': (int, 100),
+             'connections_max_age': (int, 3600),
+             'quotas': (int, 4),
+             'quotas_clouds': (int, 8),
+             'descriptions': (int, 1000)},
+    'deployment': {'retries': (int, REQUIRED),
+                   'reconfigures': (int, REQUIRED),
+                   'hedge': (int, 1),
+                   'hedge_max': (int, 3),
+                   'hedge_extra_cpus': (int, 32)},
+    'flavours': {'classes': (to_list, ''),
+                 'capacity_backoff': (int, 30*60)},
+    'ranking': {'history': (int, 7*24*60*60),
+                'half_life': (int, 6*60*60),
+                'min_weight': (float, 3),
+                'time_success': (int, 600),
+                'time_failure': (int, 1200),
+                'preference_bonus': (float, 0.5),
+                'explore': (to_bool, 'True')},
+    'dryrun': {'catalogues': (int, 1000),
+               'catalogue_ttl': (int, 60),
+               'results': (int, 10000)},
+    'api': {'mode': (str, 'threads'),
+            'health_interval': (int, 30),
+            'health_timeout': (int, 5),
+            'health_max_age': (int, 90),
+            'page_size': (int, 1000),
+            'page_size_max': (int, 10000),
+            'poll_timeout_max': (int, 60),
+            'stream_keepalive': (int, 15),
+            'batch_max': (int, 1000)},
+    'db': {'host': (str, REQUIRED),
+           'port': (int, REQUIRED),
+           'db': (str, REQUIRED),
+           'username': (str, REQUIRED),
+           'password': (str, REQUIRED),
+           'pool_min': (int, 1),
+           'pool_max': (int, 20),
+           'pool_timeout': (int, 30),
+           'keepalives_idle': (int, 60),
+           'keepalives_interval': (int, 10),
+           'keepalives_count': (int, 3)},
+    'auth': {'username': (str, REQUIRED),
+             'password': (str, REQUIRED)},
+    'clouds': {'path': (str, REQUIRED)},
+    'cleanup': {'remove_after': (int, REQUIRED),
+                'remove_changes_after': (int, 86400),
+                'retry_failed_deletes_after': (int, REQUIRED),
+                'delete_stuck_infras_after': (int, REQUIRED),
+                'workers': (int, 8),
+                'deleters': (int, 4),
+                'deleters_per_cloud': (int, 2),
+                'clients_max_age': (int, 600),
+                'batch_size': (int, 1000)},
+    'credentials': {'host-cert': (str, ''),
+                    'host-key': (str, '')},
+    'features': {'enable_appdb': (to_bool, 'True'),
+                 'vos': (to_list, '')},
+    'egi': {'enabled': (to_bool, REQUIRED),
+            'region': (str, REQUIRED),
+            'goc_url': (str, REQUIRED),
+            'blacklist': (to_list, '')},
+    'egi.credentials': {'client_id': (str, REQUIRED),
+                        'client_secret': (str, REQUIRED),
+                        'url': (str, REQUIRED),
+                        'scope': (str, REQUIRED)},
+    'egi.image': {'name': (str, REQUIRED),
+                  'image': (str, REQUIRED),
+                  'architecture': (str, REQUIRED),
+                  'distribution': (str, REQUIRED),
+                  'type': (str, REQUIRED),
+                  'version': (str, REQUIRED)}
+}
+
+class ConfigError(Exception):
+    """
+    Invalid configuration
+    """
+
+class Section(object):
+    """
+    Options in a configuration section, available as attributes
+    """
+    def __init__(self, options):
+        self.__dict__.update(options)
+
+def attribute_name(name):
+    """
+    Convert a section or option name to an attribute name
+    """
+    return name.replace('.', '_').replace('-', '_')
+
+def parse(filename):
+    """
+    Read, convert & validate the configuration file, returning a dict of sections
+    """
+    parser = configparser.ConfigParser()
+    try:
+        if not parser.read(filename):
+            raise ConfigError('unable to read %s' % filename)
+    except configparser.Error as err:
+        raise ConfigError('unable to parse %s: %s' % (filename, err))
+
+    sections = {}
+    for section in set(SCHEMA).union(parser.sections()):
+        options = {}
+        if parser.has_section(section):
+            for option in parser.options(section):
+                options[attribute_name(option)] = parser.get(section, option)
+
+        for option in SCHEMA.get(section, {}):
+            (convert, default) = SCHEMA[section][option]
+            if parser.has_option(section, option):
+                value = parser.get(section, option)
+            elif default is REQUIRED:
+                raise ConfigError('option %s in section [%s] is missing' % (option, section))
+            else:
+                value = default
+            try:
+                options[attribute_name(option)] = convert(value)
+            except ValueError as err:
+                raise ConfigError('option %s in section [%s] is invalid: %s' % (option, section, err))
+
+        sections[attribute_name(section)] = Section(options)
+
+    return sections
+
+class Config(object):
+    """
+    Configuration with typed values, e.g. CONFIG.timeouts.creation. Reloading replaces
+    all sections at once, so a lookup never sees a mixture of old and new values.
+    """
+    def __init__(self, filename):
+        self._filename = filename
+        self._sections = parse(filename)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._sections[name]
+        except KeyError:
+            raise AttributeError('configuration has no section %s' % name)
+
+    def reload(self):
+        """
+        Re-read the configuration file
+        """
+        self._sections = parse(self._filename)
+
+CONFIG = None
+CONFIG_LOCK = threading.Lock()
 
 def get_config():
     """
     Get configuration
     """
-    config = configparser.ConfigParser()
+    global CONFIG
+    with CONFIG_LOCK:
+        if CONFIG is None:
+            if 'PROMINENCE_IMC_CONFIG_DIR' not in os.environ:
+                print('ERROR: Environment variable PROMINENCE_IMC_CONFIG_DIR has not been defined')
+                exit(1)
+            try:
+                CONFIG = Config('%s/imc.ini' % os.environ['PROMINENCE_IMC_CONFIG_DIR'])
+            except ConfigError as err:
+                print('ERROR: Invalid configuration: %s' % err)
+                exit(1)
+
+    return CONFIG
 
-    if 'PROMINENCE_IMC_CONFIG_DIR' in os.environ:
-        config.read('%s/imc.ini' % os.environ['PROMINENCE_IMC_CONFIG_DIR'])
-    else:
-        print('ERROR: Environment variable PROMINENCE_IMC_CONFIG_DIR has not been defined')
-        exit(1)
+def reload_config():
+    """
+    Reload configuration, keeping the current configuration if the new one is invalid
+    """
+    try:
+        get_config().reload()
+    except ConfigError as err:
+        logger.error('Unable to reload configuration, keeping current configuration: %s', err)
+        return False
 
-    return config
+    logger.info('Reloaded configuration')
+    return True
@@ -1,8 +1,11 @@
 from __future__ import print_function
 import logging
+import os
+import threading
 import time
 import psycopg2
 from psycopg2.extras import Json
+from psycopg2.pool import PoolError, ThreadedConnectionPool
 
 from imc import config
 from imc import utilities
@@ -21,11 +24,76 @@ def get_db():
     """
     Database helper function
     """
-    db = Database(CONFIG.get('db', 'host'),
-                  CONFIG.get('db', 'port'),
-                  CONFIG.get('db', 'db'),
-                  CONFIG.get('db', 'username'),
-                  CONFIG.get('db', 'password'))
+    db = Database(CONFIG.db.host,
+                  CONFIG.db.port,
+                  CONFIG.db.db,
+                  CONFIG.db.username,
+                  CONFIG.db.password)
+    return db
+
+def keepalives():
+    """
+    Return the TCP keepalive options used by all connections to the DB
+    """
+    return {'keepalives': 1,
+            'keepalives_idle': CONFIG.db.keepalives_idle,
+            'keepalives_interval': CONFIG.db.keepalives_interval,
+            'keepalives_count': CONFIG.db.keepalives_count}
+
+class ConnectionPool(ThreadedConnectionPool):
+    """
+    Thread-safe pool of connections, waiting for a connection to become free rather than
+    failing when all are in use
+    """
+    def __init__(self, minconn, maxconn, timeout, *args, **kwargs):
+        ThreadedConnectionPool.__init__(self, minconn, maxconn, *args, **kwargs)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._timeout = timeout
+
+    def getconn(self, key=None):
+        if not self._slots.acquire(timeout=self._timeout):
+            raise PoolError('timed out waiting for a free connection')
+        try:
+            return ThreadedConnectionPool.getconn(self, key)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn, key=None, close=False):
+        try:
+            ThreadedConnectionPool.putconn(self, conn, key, close)
+        finally:
+            self._slots.release()
+
+POOL = None
+POOL_PID = None
+# Pools inherited from the parent process, kept so that they are never garbage collected
+# in the child, which would close connections the parent is still using
+INHERITED_POOLS = []
+POOL_LOCK = threading.Lock()
+
+def get_pooled_db():
+    """
+    Database helper function, using connections from a pool shared by the process. A pool
+    created before a fork is not used by the child, as its connections belong to the parent.
+    """
+    global POOL, POOL_PID
+    with POOL_LOCK:
+        if POOL is None or POOL_PID != os.getpid():
+            if POOL is not None:
+                INHERITED_POOLS.append(POOL)
+            POOL_PID = os.getpid()
+            POOL = ConnectionPool(CONFIG.db.pool_min,
+                                  CONFIG.db.pool_max,
+                                  CONFIG.db.pool_timeout,
+                                  user=CONFIG.db.username,
+                                  password=CONFIG.db.password,
+                                  host=CONFIG.db.host,
+                                  port=CONFIG.db.port,
+                                  database=CONFIG.db.db,
+                                  **keepalives())
+    db = get_db()
+    db._pool = POOL
     return db
 
 class Database(object):
@@ -39,6 +107,8 @@ class Database(object):
 
     from .images import set_cloud_updated_images, \
                         get_cloud_updated_images, \
+                        set_cloud_images_hash, \
+                        get_cloud_images_hash, \
                         get_images, \
                         get_image, \
                         set_image, \
@@ -51,16 +121,26 @@ class Database(object):
                         get_token, delete_token
 
     from .deployment import deployment_get_infra_in_state_cloud, \
+                            deployment_get_infra_in_state_cloud_version, \
                             deployment_check_infra_id, \
                             deployment_get_resource_type, \
                             deployment_get_status_reason, \
+                            deployment_get_version, \
+                            deployment_get_status, \
+                            deployment_get_statuses, \
                             deployment_get_identity, \
+                            deployment_get_identities_statuses, \
+                            get_known_im_infra_ids, \
+                            get_im_deployments_log, \
                             deployment_get_identities, \
                             deployment_get_json, \
                             get_infra_from_im_infra_id, \
                             deployment_get_im_infra_id, \
                             deployment_create_with_retries, \
                             deployment_create, \
+                            deployment_create_batch, \
+                            deployment_remove_old, \
+                            deployment_request_deletion_stuck, \
                             deployment_remove, \
                             deployment_log_remove, \
                             check_im_deployment, \
@@ -70,8 +150,17 @@ class Database(object):
                             create_im_deployment, \
                             get_im_deployments, \
                             deployment_update_resources, \
+                            deployment_reserve_resources, \
+                            deployment_release_resources, \
                             get_used_resources
 
+    from .changes import listen_changes, \
+                         wait_for_changes, \
+                         deployment_get_changes, \
+                         deployment_get_latest_change, \
+                         deployment_get_changes_start, \
+                         deployment_remove_old_changes
+
     from .egi import set_egi_cloud, \
                      get_egi_clouds, \
                      disable_egi_clouds
@@ -82,12 +171,18 @@ class Database(object):
                         get_cloud_updated_quotas
 
     from .clouds import get_cloud_info, \
+                        get_catalogue_version, \
                         set_cloud_updated_quotas, \
                         set_cloud_mon_status, \
                         set_cloud_status, \
+                        get_cloud_breaker, \
+                        set_cloud_breaker, \
                         init_cloud_info, \
                         get_deployment_failures, \
                         del_old_deployment_failures, \
+                        get_deployment_durations, \
+                        get_deployment_history, \
+                        get_capacity_failures, \
                         set_resources_update, \
                         get_resources_update, \
                         set_resources_update_start
@@ -99,6 +194,8 @@ class Database(object):
         self._username = username
         self._password = password
         self._connection = None
+        self._pool = None
+        self._listening = False
 
     def init(self):
         """
@@ -151,19 +248,38 @@ class Database(object):
             cursor.execute('''CREATE TABLE IF NOT EXISTS
                               deployment_log(im_infra_id TEXT NOT NULL PRIMARY KEY,
                                              id TEXT NOT NULL,
+                                             cloud TEXT,
                                              created INT NOT NULL,
                                              CONSTRAINT fk_infra
                                              FOREIGN KEY(id)
                                              REFERENCES deployments(id)
                                              )''')
 
+            # Create table of resources held on each cloud by deployments which are being
+            # attempted on several clouds at once
+            cursor.execute('''CREATE TABLE IF NOT EXISTS
+                              deployment_reservations(id TEXT NOT NULL,
+                                                      cloud TEXT NOT NULL,
+                                                      used_cpus INT NOT NULL,
+                                                      used_memory INT NOT NULL,
+                                                      used_instances INT NOT NULL,
+                                                      PRIMARY KEY(id, cloud),
+                                                      CONSTRAINT fk_infra
+                                                      FOREIGN KEY(id)
+                                                      REFERENCES deployments(id)
+                                                      ON DELETE CASCADE
+                                                      )''')
+
             # Create cloud failures table
             cursor.execute('''CREATE TABLE IF NOT EXISTS
                               deployment_failures(cloud TEXT NOT NULL,
                                                   identity TEXT NOT NULL,
                                                   reason INT NOT NULL,
                                                   time INT NOT NULL,
-                                                  duration INT DEFAULT -1
+                                                  duration INT DEFAULT -1,
+                                                  time_running INT DEFAULT -1,
+                                                  flavour_class TEXT NOT NULL DEFAULT '',
+                                                  instances INT NOT NULL DEFAULT -1
                                                   )''')
 
             # Create cloud updates table
@@ -201,6 +317,10 @@ class Database(object):
                                           remaining_instances INT NOT NULL DEFAULT -1,
                                           updated_quotas INT NOT NULL DEFAULT -1,
                                           updated_images INT NOT NULL DEFAULT -1,
+                                          images_hash TEXT NOT NULL DEFAULT '',
+                                          breaker_state INT NOT NULL DEFAULT 0,
+                                          breaker_failures INT NOT NULL DEFAULT 0,
+                                          breaker_retry INT NOT NULL DEFAULT 0,
                                           PRIMARY KEY (name, identity)
                                           )''')
 
@@ -227,7 +347,91 @@ class Database(object):
                                            identity TEXT NOT NULL,
                                            PRIMARY KEY (name, cloud, identity)
                                            )''')
-                                          
+
+            # Add any columns missing from tables created by older versions
+            cursor.execute("ALTER TABLE clouds_info ADD COLUMN IF NOT EXISTS images_hash TEXT NOT NULL DEFAULT ''")
+            cursor.execute("ALTER TABLE clouds_info ADD COLUMN IF NOT EXISTS breaker_state INT NOT NULL DEFAULT 0")
+            cursor.execute("ALTER TABLE clouds_info ADD COLUMN IF NOT EXISTS breaker_failures INT NOT NULL DEFAULT 0")
+            cursor.execute("ALTER TABLE clouds_info ADD COLUMN IF NOT EXISTS breaker_retry INT NOT NULL DEFAULT 0")
+            cursor.execute("ALTER TABLE deployment_failures ADD COLUMN IF NOT EXISTS time_running INT DEFAULT -1")
+            cursor.execute("ALTER TABLE deployment_failures ADD COLUMN IF NOT EXISTS flavour_class TEXT NOT NULL DEFAULT ''")
+            cursor.execute("ALTER TABLE deployment_failures ADD COLUMN IF NOT EXISTS instances INT NOT NULL DEFAULT -1")
+            cursor.execute("ALTER TABLE deployment_log ADD COLUMN IF NOT EXISTS cloud TEXT")
+
+            # Indexes for getting the status of many infrastructures at once
+            cursor.execute("CREATE INDEX IF NOT EXISTS deployments_identity_id ON deployments (identity, id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS deployments_status_id ON deployments (status, id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS deployments_im_infra_id ON deployments (im_infra_id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS deployments_status_updated ON deployments (status, updated)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS deployment_log_id ON deployment_log (id)")
+
+            # Each infrastructure has the sequence number of its latest change, used as its
+            # version. These are taken before commit so are not in commit order.
+            cursor.execute("CREATE SEQUENCE IF NOT EXISTS deployments_change_seq")
+            cursor.execute("ALTER TABLE deployments ADD COLUMN IF NOT EXISTS change_seq BIGINT NOT NULL DEFAULT nextval('deployments_change_seq')")
+            cursor.execute("CREATE INDEX IF NOT EXISTS deployments_change_seq_idx ON deployments (change_seq)")
+            # Covers the version of the list of infrastructures in a state, so that it is got
+            # from an index-only scan rather than by reading every row in the state
+            cursor.execute("CREATE INDEX IF NOT EXISTS deployments_status_cloud_version ON deployments (status, cloud) INCLUDE (change_seq, updated)")
+            cursor.execute('''CREATE OR REPLACE FUNCTION deployments_change() RETURNS trigger AS $$
+                              BEGIN
+                                  NEW.change_seq := nextval('deployments_change_seq');
+                                  RETURN NEW;
+                              END;
+                              $$ LANGUAGE plpgsql''')
+            cursor.execute("DROP TRIGGER IF EXISTS deployments_change_insert ON deployments")
+            cursor.execute('''CREATE TRIGGER deployments_change_insert
+                              BEFORE INSERT ON deployments
+                              FOR EACH ROW EXECUTE PROCEDURE deployments_change()''')
+            cursor.execute("DROP TRIGGER IF EXISTS deployments_change_update ON deployments")
+            cursor.execute('''CREATE TRIGGER deployments_change_update
+                              BEFORE UPDATE OF status, status_reason, cloud, im_infra_id ON deployments
+                              FOR EACH ROW
+                              WHEN (OLD.status IS DISTINCT FROM NEW.status OR
+                                    OLD.status_reason IS DISTINCT FROM NEW.status_reason OR
+                                    OLD.cloud IS DISTINCT FROM NEW.cloud OR
+                                    OLD.im_infra_id IS DISTINCT FROM NEW.im_infra_id)
+                              EXECUTE PROCEDURE deployments_change()''')
+
+            # Change feed: changes are logged by deferred triggers which run as transactions
+            # commit. Holding a lock from taking a sequence number until commit means that
+            # changes become visible in sequence order, so readers never skip any.
+            cursor.execute("CREATE SEQUENCE IF NOT EXISTS deployment_changes_seq")
+            cursor.execute('''CREATE TABLE IF NOT EXISTS
+                              deployment_changes(seq BIGINT NOT NULL PRIMARY KEY,
+                                                 id TEXT NOT NULL,
+                                                 status TEXT,
+                                                 status_reason TEXT,
+                                                 cloud TEXT,
+                                                 im_infra_id TEXT,
+                                                 created INT NOT NULL
+                                                 )''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS deployment_changes_created ON deployment_changes (created)")
+            cursor.execute('''CREATE OR REPLACE FUNCTION deployments_log_change() RETURNS trigger AS $$
+                              BEGIN
+                                  PERFORM pg_advisory_xact_lock(hashtext('deployment_changes'));
+                                  INSERT INTO deployment_changes (seq, id, status, status_reason, cloud, im_infra_id, created)
+                                  VALUES (nextval('deployment_changes_seq'), NEW.id, NEW.status, NEW.status_reason, NEW.cloud, NEW.im_infra_id, extract(epoch FROM now())::int);
+                                  PERFORM pg_notify('deployments_changes', '');
+                                  RETURN NULL;
+                              END;
+                              $$ LANGUAGE plpgsql''')
+            cursor.execute("DROP TRIGGER IF EXISTS deployments_log_change_insert ON deployments")
+            cursor.execute('''CREATE CONSTRAINT TRIGGER deployments_log_change_insert
+                              AFTER INSERT ON deployments
+                              DEFERRABLE INITIALLY DEFERRED
+                              FOR EACH ROW EXECUTE PROCEDURE deployments_log_change()''')
+            cursor.execute("DROP TRIGGER IF EXISTS deployments_log_change_update ON deployments")
+            cursor.execute('''CREATE CONSTRAINT TRIGGER deployments_log_change_update
+                              AFTER UPDATE OF status, status_reason, cloud, im_infra_id ON deployments
+                              DEFERRABLE INITIALLY DEFERRED
+                              FOR EACH ROW
+                              WHEN (OLD.status IS DISTINCT FROM NEW.status OR
+                                    OLD.status_reason IS DISTINCT FROM NEW.status_reason OR
+                                    OLD.cloud IS DISTINCT FROM NEW.cloud OR
+                                    OLD.im_infra_id IS DISTINCT FROM NEW.im_infra_id)
+                              EXECUTE PROCEDURE deployments_log_change()''')
+
             self._connection.commit()
             cursor.close()
         except Exception as error:
@@ -236,21 +440,34 @@ class Database(object):
         # Close the DB connection
         self.close()
 
-    def connect(self, retry_counter=0):
+    def connect(self, retry_counter=0, timeout=None):
         """
-        Connect to the DB
+        Connect to the DB. If a timeout is given, connecting is not retried and both
+        connecting and each query fail if they take longer. Pooled connections have no timeout.
         """
+        if not self._connection and self._pool:
+            try:
+                self._connection = self._pool.getconn()
+            except (Exception, psycopg2.Error) as error:
+                logger.critical('Unable to get a connection to the database from the pool due to: %s', error)
+                return False
+
         if not self._connection:
+            options = keepalives()
+            if timeout:
+                options['connect_timeout'] = timeout
+                options['options'] = '-c statement_timeout=%d' % (timeout*1000)
             try:
                 self._connection = psycopg2.connect(user=self._username,
                                                     password=self._password,
                                                     host=self._host,
                                                     port=self._port,
-                                                    database=self._db)
+                                                    database=self._db,
+                                                    **options)
                 retry_counter = 0
                 return True
             except psycopg2.OperationalError as error:
-                if retry_counter >= DATABASE_CONNECTION_MAX_RETRIES:
+                if timeout or retry_counter >= DATABASE_CONNECTION_MAX_RETRIES:
                     logger.critical('Unable to connect to the database due to: %s', error)
                 else:
                     retry_counter += 1
@@ -268,9 +485,32 @@ class Database(object):
         """
         Close the connection to the DB
         """
-        if self._connection:
+        if self._connection and self._pool:
+            self.release()
+        elif self._connection:
             self._connection.close()
         self._connection = None
+        self._listening = False
+
+    def release(self):
+        """
+        Return the connection to the pool, ending any transaction and notifications so that
+        it can be reused, or discarding it if it is broken
+        """
+        discard = bool(self._connection.closed)
+        if not discard:
+            try:
+                self._connection.rollback()
+                if self._listening:
+                    cursor = self._connection.cursor()
+                    cursor.execute('UNLISTEN *')
+                    self._connection.commit()
+                    cursor.close()
+                del self._connection.notifies[:]
+            except (Exception, psycopg2.Error) as error:
+                logger.warning('Discarding pooled database connection due to: %s', error)
+                discard = True
+        self._pool.putconn(self._connection, close=discard)
 
     def reset(self):
         """
@@ -279,6 +519,21 @@ class Database(object):
         self.close()
         return self.connect()
     
+    def ping(self):
+        """
+        Check that the DB is responding
+        """
+        try:
+            cursor = self._connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+            cursor.close()
+            self._connection.commit()
+        except (Exception, psycopg2.Error) as error:
+            logger.critical('Unable to execute query "SELECT 1" due to "%s"', error)
+            return False
+        return True
+
     def execute(self, query, data=None, retry_counter=0):
         """
         Execute a query
@@ -0,0 +1,126 @@
+import logging
+import select
+
+# Logging
+logger = logging.getLogger(__name__)
+
+# Channel notified by the change log trigger whenever a change to an infrastructure commits
+CHANNEL = 'deployments_changes'
+
+# Next change sequence number, used when all changes have been removed
+NEXT_SEQ = "(SELECT CASE WHEN is_called THEN last_value + 1 ELSE last_value END FROM deployment_changes_seq)"
+
+def listen_changes(self):
+    """
+    Start listening for notifications of changes to infrastructures
+    """
+    try:
+        cursor = self._connection.cursor()
+        cursor.execute('LISTEN %s' % CHANNEL)
+        self._connection.commit()
+        cursor.close()
+        self._listening = True
+    except Exception as error:
+        logger.critical('[listen_changes] Unable to execute LISTEN due to: %s', error)
+        return False
+
+    return True
+
+def wait_for_changes(self, timeout):
+    """
+    Wait until infrastructures change or the timeout expires, returning True if notified
+    of changes, False on timeout or None on error. listen_changes must have been called
+    first.
+    """
+    try:
+        if not self._connection.notifies:
+            if select.select([self._connection], [], [], timeout) == ([], [], []):
+                return False
+            self._connection.poll()
+        notified = bool(self._connection.notifies)
+        del self._connection.notifies[:]
+    except Exception as error:
+        logger.critical('[wait_for_changes] Unable to wait for notifications due to: %s', error)
+        return None
+
+    return notified
+
+def deployment_get_changes(self, since, limit=1000):
+    """
+    Return changes to infrastructures after the specified change sequence number, in the
+    order they were committed
+    """
+    changes = []
+    try:
+        cursor = self._connection.cursor()
+        cursor.execute("SELECT seq, id, status, CASE WHEN status IN ('unable', 'failed', 'waiting') THEN status_reason END, cloud, im_infra_id FROM deployment_changes WHERE seq > %s ORDER BY seq ASC LIMIT %s", (since, limit))
+        for row in cursor:
+            changes.append({'seq': row[0],
+                            'id': row[1],
+                            'status': row[2],
+                            'status_reason': row[3],
+                            'cloud': row[4],
+                            'infra_id': row[5]})
+        cursor.close()
+        # End the transaction so that notifications are delivered while waiting
+        self._connection.commit()
+    except Exception as error:
+        logger.critical('[deployment_get_changes] Unable to execute query due to: %s', error)
+        return None
+
+    return changes
+
+def deployment_get_latest_change(self):
+    """
+    Return the most recent change sequence number
+    """
+    latest = None
+    try:
+        cursor = self._connection.cursor()
+        cursor.execute("SELECT COALESCE((SELECT MAX(seq) FROM deployment_changes), %s - 1)" % NEXT_SEQ)
+        for row in cursor:
+            latest = row[0]
+        cursor.close()
+        self._connection.commit()
+    except Exception as error:
+        logger.critical('[deployment_get_latest_change] Unable to execute query due to: %s', error)
+        return None
+
+    return latest
+
+def deployment_get_changes_start(self):
+    """
+    Return the change sequence number after which no changes have been removed, so that
+    clients which have seen changes up to an earlier number have missed some
+    """
+    start = None
+    try:
+        cursor = self._connection.cursor()
+        cursor.execute("SELECT COALESCE((SELECT MIN(seq) FROM deployment_changes), %s) - 1" % NEXT_SEQ)
+        for row in cursor:
+            start = row[0]
+        cursor.close()
+        self._connection.commit()
+    except Exception as error:
+        logger.critical('[deployment_get_changes_start] Unable to execute query due to: %s', error)
+        return None
+
+    return start
+
+def deployment_remove_old_changes(self, before, limit):
+    """
+    Remove up to the specified number of changes made before the specified time. Returns
+    the number removed, or None on error.
+    """
+    try:
+        cursor = self._connection.cursor()
+        cursor.execute("DELETE FROM deployment_changes WHERE seq IN (SELECT seq FROM deployment_changes WHERE created < %s ORDER BY seq ASC LIMIT %s)", (before, limit))
+        removed = cursor.rowcount
+        self._connection.commit()
+        cursor.close()
+    except Exception as error:
+        logger.critical('[deployment_remove_old_changes] Unable to execute query due to: %s', error)
+        if not self._connection.closed:
+            self._connection.rollback()
+        return None
+    return removed
@@ -35,6 +35,27 @@ def get_cloud_info(self, cloud, identity):
 
     return (status, mon_status, limit_cpus, limit_memory, limit_instances, remaining_cpus, remaining_memory, remaining_instances)
 
+def get_catalogue_version(self, identity):
+    """
+    Return a hash of the status, static quotas, images & flavours of all clouds available
+    to an identity, which changes whenever any of them change
+    """
+    version = None
+
+    try:
+        cursor = self._connection.cursor()
+        cursor.execute("""SELECT md5(COALESCE((SELECT string_agg(concat_ws(':', name, identity, status, mon_status, limit_cpus, limit_memory, limit_instances, images_hash), ',' ORDER BY name, identity)
+                                               FROM clouds_info WHERE identity=%s OR identity='static'), '') || '|' ||
+                                     COALESCE((SELECT string_agg(concat_ws(':', cloud, name, identity, cpus, memory, disk), ',' ORDER BY cloud, name, identity)
+                                               FROM cloud_flavours WHERE identity=%s OR identity='static'), ''))""", (identity, identity))
+        for row in cursor:
+            version = row[0]
+        cursor.close()
+    except Exception as error:
+        logger.critical('[get_catalogue_version] Unable to execute SELECT query due to: %s', error)
+
+    return version
+
 def set_cloud_updated_quotas(self, cloud, identity):
     """
     Set time that quotas where updated
@@ -53,6 +74,34 @@ def set_cloud_status(self, cloud, identity, status):
     """
     return self.execute("UPDATE clouds_info SET status=%s WHERE identity='%s' AND name='%s'" % (status, identity, cloud))
 
+def get_cloud_breaker(self, cloud, identity):
+    """
+    Get the circuit breaker state, number of consecutive failed checks and the time after
+    which the cloud can be checked again
+    """
+    state = 0
+    failures = 0
+    retry = 0
+
+    try:
+        cursor = self._connection.cursor()
+        cursor.execute("SELECT breaker_state, breaker_failures, breaker_retry FROM clouds_info WHERE identity=%s AND name=%s", (identity, cloud))
+        for row in cursor:
+            state = row[0]
+            failures = row[1]
+            retry = row[2]
+        cursor.close()
+    except Exception as error:
+        logger.critical('[get_cloud_breaker] Unable to execute SELECT query due to: %s', error)
+
+    return (state, failures, retry)
+
+def set_cloud_breaker(self, cloud, identity, status, state, failures, retry):
+    """
+    Set cloud status together with its circuit breaker state
+    """
+    return self.execute("UPDATE clouds_info SET status=%s,breaker_state=%s,breaker_failures=%s,breaker_retry=%s WHERE identity=%s AND name=%s", (status, state, failures, int(retry), identity, cloud))
+
 def init_cloud_info(self, cloud, identity):
     """
     Initialise a cloud name and user
@@ -80,6 +129,72 @@ def get_deployment_failures(self, identity, interval, successes=False):
 
     return output
 
+def get_deployment_durations(self, cloud, interval):
+    """
+    Get the median times taken by recent successful deployments on a cloud to enter the
+    running & configured states
+    """
+    time_running = None
+    duration = None
+
+    try:
+        cursor = self._connection.cursor()
+        cursor.execute("SELECT PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY NULLIF(time_running, -1)), PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY NULLIF(duration, -1)) FROM deployment_failures WHERE cloud=%s AND reason=0 AND time > %s", (cloud, time.time() - interval))
+        for row in cursor:
+            time_running = row[0]
+            duration = row[1]
+        cursor.close()
+    except Exception as error:
+        logger.critical('[get_deployment_durations] Unable to execute SELECT query due to: %s', error)
+
+    return (time_running, duration)
+
+def get_deployment_history(self, since=0, identity=None):
+    """
+    Get the outcomes of deployments since the specified time, optionally only for a
+    single identity, in time order
+    """
+    where = ''
+    params = [since]
+    if identity:
+        where = 'AND identity=%s'
+        params.append(identity)
+
+    history = []
+    try:
+        cursor = self._connection.cursor()
+        cursor.execute("SELECT cloud, identity, reason, time, duration, time_running, flavour_class, instances FROM deployment_failures WHERE time >= %%s %s ORDER BY time ASC" % where, params)
+        for row in cursor:
+            history.append({'cloud': row[0],
+                            'identity': row[1],
+                            'reason': row[2],
+                            'time': row[3],
+                            'duration': row[4],
+                            'time_running': row[5],
+                            'flavour_class': row[6],
+                            'instances': row[7]})
+        cursor.close()
+    except Exception as error:
+        logger.critical('[get_deployment_history] Unable to execute SELECT query due to: %s', error)
+
+    return history
+
+def get_capacity_failures(self, cloud, reasons, interval):
+    """
+    Get the flavour classes which recently failed on a cloud for the specified reasons
+    """
+    classes = set()
+    try:
+        cursor = self._connection.cursor()
+        cursor.execute("SELECT DISTINCT flavour_class FROM deployment_failures WHERE cloud=%s AND reason IN %s AND time > %s AND flavour_class != ''", (cloud, tuple(reasons), time.time() - interval))
+        for row in cursor:
+            classes.add(row[0])
+        cursor.close()
+    except Exception as error:
+        logger.critical('[get_capacity_failures] Unable to execute SELECT query due to: %s', error)
+
+    return classes
+
 def del_old_deployment_failures(self, interval):
     """
     Delete old deployment failures
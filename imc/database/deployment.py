@@ -1,13 +1,17 @@
 import logging
 import time
-from psycopg2.extras import Json
+from psycopg2.extras import Json, execute_values
 
 # Logging
 logger = logging.getLogger(__name__)
 
+# Number of rows fetched at a time when streaming the status of infrastructures
+STATUSES_BATCH = 500
+
 def deployment_get_infra_in_state_cloud(self, state, cloud=None, order=False):
     """
-    Return a list of all infrastructure IDs for infrastructure in the specified state and cloud
+    Return a list of all infrastructure IDs, together with their times created & updated,
+    identity & cloud, for infrastructure in the specified state and cloud
     """
     query = ""
     if cloud:
@@ -17,9 +21,9 @@ def deployment_get_infra_in_state_cloud(self, state, cloud=None, order=False):
     infra = []
     try:
         cursor = self._connection.cursor()
-        cursor.execute("SELECT id,creation,updated,identity FROM deployments WHERE status='%s' %s" % (state, query))
+        cursor.execute("SELECT id,creation,updated,identity,cloud FROM deployments WHERE status='%s' %s" % (state, query))
         for row in cursor:
-            infra.append({"id":row[0], "created":row[1], "updated":row[2], "identity":row[3]})
+            infra.append({"id":row[0], "created":row[1], "updated":row[2], "identity":row[3], "cloud":row[4]})
         cursor.close()
     except Exception as error:
         logger.critical('[deployment_get_infra_in_state_cloud] Unable to execute query due to: %s', error)
@@ -77,6 +81,127 @@ def deployment_get_status_reason(self, infra_id):
         logger.critical('[deployment_get_status_reason] Unable to execute query due to: %s', error)
     return status_reason
 
+def deployment_get_version(self, infra_id):
+    """
+    Return the change sequence number of an infrastructure, which changes whenever its
+    status, status reason, cloud or IM infrastructure ID changes
+    """
+    version = None
+
+    try:
+        cursor = self._connection.cursor()
+        cursor.execute("SELECT change_seq FROM deployments WHERE id=%s", (infra_id,))
+        for row in cursor:
+            version = row[0]
+        cursor.close()
+    except Exception as error:
+        logger.critical('[deployment_get_version] Unable to execute query due to: %s', error)
+    return version
+
+def deployment_get_status(self, infra_id):
+    """
+    Return the status of an infrastructure, including the reason if it is not running,
+    its cloud, IM infrastructure ID & change sequence number
+    """
+    status = None
+
+    try:
+        cursor = self._connection.cursor()
+        cursor.execute("SELECT status, CASE WHEN status IN ('unable', 'failed', 'waiting') THEN status_reason END, cloud, im_infra_id, change_seq FROM deployments WHERE id=%s", (infra_id,))
+        for row in cursor:
+            status = {'status': row[0],
+                      'status_reason': row[1],
+                      'cloud': row[2],
+                      'infra_id': row[3],
+                      'seq': row[4]}
+        cursor.close()
+    except Exception as error:
+        logger.critical('[deployment_get_status] Unable to execute query due to: %s', error)
+    return status
+
+def deployment_get_infra_in_state_cloud_version(self, state, cloud=None):
+    """
+    Return a version of the list of infrastructures in the specified state and cloud, which
+    changes whenever an infrastructure is added to or removed from the list or updated.
+    This is an index-only scan of deployments_status_cloud_version, so still reads an index
+    entry per infrastructure in the state.
+    """
+    query = "SELECT count(*), COALESCE(sum(change_seq), 0), COALESCE(max(updated), 0) FROM deployments WHERE status=%s"
+    params = [state]
+    if cloud:
+        query += " AND cloud=%s"
+        params.append(cloud)
+
+    version = None
+    try:
+        cursor = self._connection.cursor()
+        cursor.execute(query, params)
+        for row in cursor:
+            version = '%d-%d-%d' % (row[0], row[1], row[2])
+        cursor.close()
+    except Exception as error:
+        logger.critical('[deployment_get_infra_in_state_cloud_version] Unable to execute query due to: %s', error)
+    return version
+
+def deployment_get_statuses(self, ids=None, identity=None, status=None, after=None, limit=1000):
+    """
+    Return a generator of the status of infrastructures in a list of IDs and/or with the
+    specified identity & status, in order of ID starting after the specified ID, or None
+    if the query failed. Rows are streamed from the DB using a server-side cursor.
+    """
+    conditions = []
+    params = []
+    if ids is not None:
+        conditions.append('id = ANY(%s)')
+        params.append(list(ids))
+    if identity:
+        conditions.append('identity = %s')
+        params.append(identity)
+    if status:
+        conditions.append('status = %s')
+        params.append(status)
+    if after:
+        conditions.append('id > %s')
+        params.append(after)
+    params.append(limit)
+
+    where = ''
+    if conditions:
+        where = 'WHERE %s' % ' AND '.join(conditions)
+
+    # The query is run & the first rows fetched here, so that errors are known before any
+    # results are returned
+    try:
+        cursor = self._connection.cursor(name='deployment_get_statuses')
+        cursor.execute("SELECT id, status, CASE WHEN status IN ('unable', 'failed', 'waiting') THEN status_reason END, cloud, im_infra_id FROM deployments %s ORDER BY id ASC LIMIT %%s" % where, params)
+        rows = cursor.fetchmany(STATUSES_BATCH)
+    except Exception as error:
+        logger.critical('[deployment_get_statuses] Unable to execute query due to: %s', error)
+        return None
+
+    return generate_statuses(self._connection, cursor, rows)
+
+def generate_statuses(connection, cursor, rows):
+    """
+    Generate the status of infrastructures from the rows already fetched and then the rest
+    of the rows of the cursor. Errors are raised to the caller, as results have already
+    been returned.
+    """
+    try:
+        while rows:
+            for row in rows:
+                yield {'id': row[0],
+                       'status': row[1],
+                       'status_reason': row[2],
+                       'cloud': row[3],
+                       'infra_id': row[4]}
+            rows = cursor.fetchmany(STATUSES_BATCH)
+        cursor.close()
+        connection.commit()
+    except Exception as error:
+        logger.critical('[deployment_get_statuses] Unable to fetch results due to: %s', error)
+        raise
+
 def deployment_get_identity(self, infra_id):
     """
     Return the identity associated with the infrastructure
@@ -93,6 +218,23 @@ def deployment_get_identity(self, infra_id):
         logger.critical('[deployment_get_identity] Unable to execute query due to: %s', error)
     return identity
 
+def deployment_get_identities_statuses(self, infra_ids):
+    """
+    Return the status & identity of each of the given infrastructures which exist
+    """
+    infras = {}
+
+    try:
+        cursor = self._connection.cursor()
+        cursor.execute("SELECT id, status, identity FROM deployments WHERE id = ANY(%s)", (list(infra_ids),))
+        for row in cursor:
+            infras[row[0]] = (row[1], row[2])
+        cursor.close()
+    except Exception as error:
+        logger.critical('[deployment_get_identities_statuses] Unable to execute query due to: %s', error)
+        return None
+    return infras
+
 def deployment_get_identities(self):
     """
     Get list of recent identities
@@ -128,7 +270,7 @@ def deployment_get_json(self, infra_id):
         cursor.close()
     except Exception as error:
         logger.critical('[deployment_get_json] Unable to execute query due to: %s', error)
-        return None, None
+        return None, None, None
 
     return (description, identity, identifier)
 
@@ -152,6 +294,24 @@ def get_infra_from_im_infra_id(self, im_infra_id):
         logger.critical('[deployment_infra_from_im_infra_id] Unable to execute query due to: %s', error)
     return (infra_id, status, cloud)
 
+def get_known_im_infra_ids(self, im_infra_ids):
+    """
+    Return which of the given IM infra IDs are the current IM infrastructure of known
+    infrastructure
+    """
+    known = set()
+
+    try:
+        cursor = self._connection.cursor()
+        cursor.execute("SELECT im_infra_id FROM deployments WHERE im_infra_id = ANY(%s)", (list(im_infra_ids),))
+        for row in cursor:
+            known.add(row[0])
+        cursor.close()
+    except Exception as error:
+        logger.critical('[get_known_im_infra_ids] Unable to execute query due to: %s', error)
+        return None
+    return known
+
 def deployment_get_im_infra_id(self, infra_id):
     """
     Return the IM infrastructure ID, our status and cloud name
@@ -243,18 +403,101 @@ def check_im_deployment(self, im_infra_id):
 
     return infra, cloud
 
+def get_im_deployments_log(self, im_infra_ids):
+    """
+    Return the infra ID & cloud logged for each of the given IM infra IDs which were logged
+    """
+    infras = {}
+
+    try:
+        cursor = self._connection.cursor()
+        cursor.execute("SELECT im_infra_id, id, cloud FROM deployment_log WHERE im_infra_id = ANY(%s)", (list(im_infra_ids),))
+        for row in cursor:
+            infras[row[0]] = (row[1], row[2])
+        cursor.close()
+    except Exception as error:
+        logger.critical('[get_im_deployments_log] Unable to execute query due to: %s', error)
+        return None
+    return infras
+
 def deployment_create(self, infra_id, description, identity, identifier):
     """
     Create deployment
     """
     return self.execute("INSERT INTO deployments (id,description,status,identity,identifier,creation,updated) VALUES (%s,%s,'accepted',%s,%s,%s,%s)", (infra_id, Json(description), identity, identifier, time.time(), time.time()))
 
+def deployment_create_batch(self, deployments):
+    """
+    Create many deployments, given as (id, description, identity, identifier), in a single
+    transaction. Returns the IDs created, excluding any which already existed, or None if
+    the deployments could not be created.
+    """
+    now = time.time()
+    rows = [(infra_id, Json(description), 'accepted', identity, identifier, now, now)
+            for (infra_id, description, identity, identifier) in deployments]
+    try:
+        cursor = self._connection.cursor()
+        created = execute_values(cursor,
+                                 "INSERT INTO deployments (id,description,status,identity,identifier,creation,updated) VALUES %s ON CONFLICT (id) DO NOTHING RETURNING id",
+                                 rows,
+                                 page_size=max(len(rows), 1),
+                                 fetch=True)
+        self._connection.commit()
+        cursor.close()
+    except Exception as error:
+        logger.critical('[deployment_create_batch] Unable to execute query due to: %s', error)
+        return None
+
+    return set(row[0] for row in created)
+
 def deployment_remove(self, infra_id):
     """
     Remove an infrastructure from the DB
     """
     return self.execute("DELETE FROM deployments WHERE id='%s'" % infra_id)
 
+def deployment_remove_old(self, states, before, limit):
+    """
+    Remove up to the specified number of infrastructures in the given states last updated
+    before the specified time, together with their IM deployments, in a single transaction.
+    Returns the number removed, or None on error.
+    """
+    try:
+        cursor = self._connection.cursor()
+        cursor.execute("""WITH old AS (SELECT id FROM deployments WHERE status = ANY(%s) AND updated < %s LIMIT %s FOR UPDATE SKIP LOCKED),
+                               log AS (DELETE FROM deployment_log WHERE id IN (SELECT id FROM old))
+                          DELETE FROM deployments WHERE id IN (SELECT id FROM old)""", (list(states), before, limit))
+        removed = cursor.rowcount
+        self._connection.commit()
+        cursor.close()
+    except Exception as error:
+        logger.critical('[deployment_remove_old] Unable to execute query due to: %s', error)
+        if not self._connection.closed:
+            self._connection.rollback()
+        return None
+    return removed
+
+def deployment_request_deletion_stuck(self, state, before, status_reason, limit):
+    """
+    Request deletion of up to the specified number of infrastructures in the given state
+    last updated before the specified time, setting the status reason, in a single
+    transaction. Returns the number updated, or None on error.
+    """
+    try:
+        cursor = self._connection.cursor()
+        cursor.execute("""UPDATE deployments SET status='deletion-requested', status_reason=%s, updated=%s
+                          WHERE id IN (SELECT id FROM deployments WHERE status=%s AND updated < %s LIMIT %s FOR UPDATE SKIP LOCKED)""",
+                       (status_reason, time.time(), state, before, limit))
+        updated = cursor.rowcount
+        self._connection.commit()
+        cursor.close()
+    except Exception as error:
+        logger.critical('[deployment_request_deletion_stuck] Unable to execute query due to: %s', error)
+        if not self._connection.closed:
+            self._connection.rollback()
+        return None
+    return updated
+
 def deployment_log_remove(self, infra_id):
     """
     Remove an infrastructure from the DB
@@ -290,9 +533,25 @@ def deployment_update_resources(self, infra_id, used_instances, used_cpus, used_
     """
     return self.execute("UPDATE deployments SET used_instances=%s, used_cpus=%s, used_memory=%s WHERE id='%s'" % (used_instances, used_cpus, used_memory, infra_id))
 
+def deployment_reserve_resources(self, infra_id, cloud, used_instances, used_cpus, used_memory):
+    """
+    Record the resources being used on a cloud by one of several attempts to deploy an
+    infrastructure at once
+    """
+    return self.execute("""INSERT INTO deployment_reservations (id, cloud, used_instances, used_cpus, used_memory) VALUES (%s, %s, %s, %s, %s)
+                           ON CONFLICT (id, cloud) DO UPDATE SET used_instances=EXCLUDED.used_instances, used_cpus=EXCLUDED.used_cpus, used_memory=EXCLUDED.used_memory""",
+                        (infra_id, cloud, used_instances, used_cpus, used_memory))
+
+def deployment_release_resources(self, infra_id, cloud):
+    """
+    Remove the resources recorded for an attempt to deploy an infrastructure on a cloud
+    """
+    return self.execute("DELETE FROM deployment_reservations WHERE id=%s AND cloud=%s", (infra_id, cloud))
+
 def get_used_resources(self, identity, cloud, creating=None):
     """
-    Get the total resources used on a particular cloud
+    Get the total resources used on a particular cloud, including resources held by
+    attempts to deploy on several clouds at once if infrastructure being created is included
     """
     used_instances = 0
     used_cpus = 0
@@ -300,12 +559,19 @@ def get_used_resources(self, identity, cloud, creating=None):
 
     if creating:
         states = "'configured', 'creating'"
+        reserved = """UNION ALL
+                      SELECT r.used_instances, r.used_cpus, r.used_memory FROM deployment_reservations r
+                      JOIN deployments d ON d.id = r.id
+                      WHERE d.status NOT IN ('deleted', 'unable') AND d.identity='%s' AND r.cloud='%s'""" % (identity, cloud)
     else:
         states = "'configured'"
+        reserved = ""
 
     try:
         cursor = self._connection.cursor()
-        cursor.execute("SELECT SUM(used_instances), SUM(used_cpus), SUM(used_memory) FROM deployments WHERE status IN (%s) AND identity='%s' AND cloud='%s'" % (states, identity, cloud))
+        cursor.execute("""SELECT SUM(used_instances), SUM(used_cpus), SUM(used_memory) FROM
+                          (SELECT used_instances, used_cpus, used_memory FROM deployments WHERE status IN (%s) AND identity='%s' AND cloud='%s'
+                           %s) AS used""" % (states, identity, cloud, reserved))
         for row in cursor:
             if row[0] and row[1] and row[2]:
                 used_instances = int(row[0])
@@ -316,8 +582,8 @@ def get_used_resources(self, identity, cloud, creating=None):
         logger.critical('[get_used_resources] Unable to execute query due to: %s', error)
     return (used_instances, used_cpus, used_memory)
 
-def set_deployment_failure(self, cloud, identity, reason, duration=-1):
+def set_deployment_failure(self, cloud, identity, reason, duration=-1, time_running=-1, flavour_class='', instances=-1):
     """
     Set deployment failure reason
     """
-    return self.execute("INSERT INTO deployment_failures (cloud, identity, reason, time, duration) VALUES (%s,%s,%s,%s,%s)", (cloud, identity, reason, time.time(), duration))
+    return self.execute("INSERT INTO deployment_failures (cloud, identity, reason, time, duration, time_running, flavour_class, instances) VALUES (%s,%s,%s,%s,%s,%s,%s,%s)", (cloud, identity, reason, time.time(), duration, time_running, flavour_class, instances))
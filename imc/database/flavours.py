@@ -29,7 +29,7 @@ def get_flavours(self, identity, cloud, cpus, memory, disk):
     Return all flavours which can provide the specified resources
     """
     flavours = []
-    use_identity = "identity='%s'"
+    use_identity = "identity='%s'" % identity
     if identity != 'static':
         use_identity = "(identity='%s' OR identity='static')" % identity
 
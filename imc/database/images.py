@@ -26,6 +26,34 @@ def get_cloud_updated_images(self, cloud, identity):
 
     return updated
 
+def set_cloud_images_hash(self, cloud, identity, images_hash, updated=True):
+    """
+    Set the content hash of the images & flavours stored for a cloud, optionally also
+    setting the time when images were updated
+    """
+    if updated:
+        return self.execute("UPDATE clouds_info SET images_hash=%s,updated_images=%s WHERE identity=%s AND name=%s", (images_hash, int(time.time()), identity, cloud))
+    return self.execute("UPDATE clouds_info SET images_hash=%s WHERE identity=%s AND name=%s", (images_hash, identity, cloud))
+
+def get_cloud_images_hash(self, cloud, identity):
+    """
+    Get the content hash of the images & flavours stored for a cloud and the time when
+    images were last updated
+    """
+    images_hash = None
+    updated = 0
+    try:
+        cursor = self._connection.cursor()
+        cursor.execute("SELECT images_hash, updated_images FROM clouds_info WHERE identity=%s AND name=%s", (identity, cloud))
+        for row in cursor:
+            images_hash = row[0]
+            updated = row[1]
+        cursor.close()
+    except Exception as error:
+        logger.critical('[get_cloud_images_hash] Unable to execute SELECT query due to: %s', error)
+
+    return (images_hash, updated)
+
 def get_images(self, identity, cloud):
     """
     Return all images associated with the specified cloud
@@ -55,9 +83,9 @@ def get_image(self, identity, cloud, os_type, os_arch, os_dist, os_vers):
     """
     name = None
     im_name = None
-    use_identity = "identity='%s'"
+    use_identity = "identity='%s'" % identity
     if identity != 'static':
-        use_identity = "(identity='%s' OR identity='static')"
+        use_identity = "(identity='%s' OR identity='static')" % identity
 
     try:
         cursor = self._connection.cursor()
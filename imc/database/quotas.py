@@ -24,7 +24,7 @@ def get_cloud_updated_quotas(self, cloud, identity):
     except Exception as error:
         logger.critical('[get_cloud_updated_quotas] Unable to execute SELECT query due to: %s', error)
 
-    return 0
+    return updated
 
 def set_cloud_static_quotas(self, cloud, identity, limit_cpus, limit_memory, limit_instances):
     """
@@ -4,7 +4,6 @@ from __future__ import print_function
 import re
 import time
 import logging
-import configparser
 
 from imc import config
 from imc import cloud_utils
@@ -26,11 +25,11 @@ def destroy(client, infrastructure_id):
     Destroy the specified infrastructure, including retries since clouds can be unreliable
     """
     count = 0
-    delay_factor = float(CONFIG.get('deletion', 'factor'))
+    delay_factor = CONFIG.deletion.factor
     delay = delay_factor
     destroyed = False
-    while not destroyed and count < int(CONFIG.get('deletion', 'retries')):
-        (return_code, msg) = client.destroy(infrastructure_id, int(CONFIG.get('timeouts', 'deletion')))
+    while not destroyed and count < CONFIG.deletion.retries:
+        (return_code, msg) = client.destroy(infrastructure_id, CONFIG.timeouts.deletion)
         if return_code == 0:
             destroyed = True
         elif 'Invalid infrastructure ID or access not granted' in msg:
@@ -47,18 +46,65 @@ def destroy(client, infrastructure_id):
 
     return destroyed
 
-def delete(unique_id):
+def get_client(db, identity, cloud, clients=None):
     """
-    Delete the infrastructure with the specified id
+    Return an IM client with credentials for the specified identity & cloud, reusing one
+    from the cache of clients if given
     """
-    logger.info('Deleting infrastructure with id %s', unique_id)
+    key = (identity, cloud)
+    if clients is not None:
+        client = clients.get(key)
+        if client:
+            return client
+
+    # Get cloud details
+    clouds_info_list = cloud_utils.create_clouds_list(db, identity)
+
+    # Check & get auth token if necessary
+    token = tokens.get_token(cloud, identity, db, clouds_info_list)
+
+    # Setup Infrastructure Manager client
+    im_auth = im_utils.create_im_auth(cloud, token, clouds_info_list)
+    if not im_auth:
+        logger.critical('Not IM auth for cloud %s', cloud)
+        return None
+    client = imclient.IMClient(url=CONFIG.im.url, data=im_auth)
+    (status, msg) = client.getauth()
+    if status != 0:
+        logger.critical('Error reading IM auth file: %s', msg)
+        return None
+
+    if clients is not None:
+        clients.put(key, client)
+    return client
+
+def delete(unique_id, db=None, clients=None):
+    """
+    Delete the infrastructure with the specified id, using the given DB connection and
+    cache of IM clients if provided
+    """
+    if db:
+        return delete_infra(db, unique_id, clients)
 
     db = database.get_db()
-    db.connect()
+    if not db.connect():
+        logger.critical('Unable to connect to DB for deleting infrastructure %s', unique_id)
+        return False
+    try:
+        return delete_infra(db, unique_id, clients)
+    finally:
+        db.close()
+
+def delete_infra(db, unique_id, clients=None):
+    """
+    Delete the infrastructure with the specified id
+    """
+    logger.info('Deleting infrastructure with id %s', unique_id)
 
     (im_infra_id, infra_status, cloud, _, _) = db.deployment_get_im_infra_id(unique_id)
     logger.info('Obtained IM id %s and cloud %s and status %s', im_infra_id, cloud, infra_status)
 
+    client = None
     resource_type = 'cloud'
     if im_infra_id and cloud:
         if resource_type == 'cloud':
@@ -69,23 +115,8 @@ def delete(unique_id):
                 # Get the identity of the user who created the infrastructure
                 identity = db.deployment_get_identity(unique_id)
 
-                # Get cloud details
-                clouds_info_list = cloud_utils.create_clouds_list(db, identity)
-     
-                # Check & get auth token if necessary
-                token = tokens.get_token(cloud, identity, db, clouds_info_list)
-
-                # Setup Infrastructure Manager client
-                im_auth = im_utils.create_im_auth(cloud, token, clouds_info_list)
-                client = imclient.IMClient(url=CONFIG.get('im', 'url'), data=im_auth)
-                if not im_auth:
-                    logger.critical('Not IM auth for cloud %s', cloud)
-                    db.close()
-                    return False
-                (status, msg) = client.getauth()
-                if status != 0:
-                    logger.critical('Error reading IM auth file: %s', msg)
-                    db.close()
+                client = get_client(db, identity, cloud, clients)
+                if not client:
                     return False
 
                 destroyed = destroy(client, im_infra_id)
@@ -105,12 +136,11 @@ def delete(unique_id):
         db.deployment_update_status(unique_id, 'deleted')
 
     # Check for any remaining infrastructures in IM
-    logger.info('Checking any remaining infrastructures in IM...')
-    for infra in db.get_im_deployments(unique_id):
-        if infra['id'] != im_infra_id and im_infra_id:
-            logger.info('- will try to destroy %s', infra['id'])
-            destroy(client, infra['id'])
+    if client:
+        logger.info('Checking any remaining infrastructures in IM...')
+        for infra in db.get_im_deployments(unique_id):
+            if infra['id'] != im_infra_id:
+                logger.info('- will try to destroy %s', infra['id'])
+                destroy(client, infra['id'])
 
-    db.close()
     return True
-
@@ -58,7 +58,7 @@ def find_endpoint(service_type, production=True, monitored=True, site=None):
         sites = [site]
     else:
         sites = get_sites()
-    url = "?".join([CONFIG.get('egi', 'goc_url'), parse.urlencode(q)])
+    url = "?".join([CONFIG.egi.goc_url, parse.urlencode(q)])
     r = requests.get(url)
     endpoints = []
     if r.status_code == 200:
@@ -159,7 +159,7 @@ def get_sites():
     Get list of sites from the GOC DB
     """
     q = {"method": "get_site_list", "certification_status": "Certified"}
-    url = "?".join([CONFIG.get('egi', 'goc_url'), parse.urlencode(q)])
+    url = "?".join([CONFIG.egi.goc_url, parse.urlencode(q)])
     r = requests.get(url)
     sites = []
     if r.status_code == 200:
@@ -250,7 +250,7 @@ def egi_clouds_update_do(identity, db):
     # Add clouds to database
     count = 0
     for cloud in clouds:
-        if cloud['site'] in CONFIG.get('egi', 'blacklist').split(','):
+        if cloud['site'] in CONFIG.egi.blacklist:
             logger.info('Ignoring cloud %s as it is in the blacklist', cloud['site'])
         else:
             status = db.set_egi_cloud(identity,
@@ -0,0 +1,128 @@
+"""Choose which flavours to try deploying with, and in which order"""
+import logging
+import re
+import threading
+
+from imc import config
+
+# Configuration
+CONFIG = config.get_config()
+
+# Logging
+logger = logging.getLogger(__name__)
+
+# Deployment failure reasons which indicate a cloud has no capacity for a flavour
+CAPACITY_FAILURES = (2, 8)
+
+# Compiled class rules, keyed by the rules in the configuration
+RULES = {}
+RULES_LOCK = threading.Lock()
+
+def parse_rule(rule):
+    """
+    Parse a class rule, either <class>=prefix:<regex> matching flavour names or
+    <class>=ratio:<min>-<max> matching memory (GB) per CPU
+    """
+    (name, definition) = rule.split('=', 1)
+    (kind, argument) = definition.split(':', 1)
+    if kind == 'prefix':
+        regex = re.compile(argument)
+        return (name.strip(), lambda flavour: bool(regex.match(flavour[0])))
+    if kind == 'ratio':
+        (minimum, maximum) = [float(value) for value in argument.split('-', 1)]
+        return (name.strip(), lambda flavour: flavour[1] > 0 and minimum <= flavour[2]/float(flavour[1]) < maximum)
+    raise ValueError('unknown flavour class rule type %s' % kind)
+
+def get_rules():
+    """
+    Return the compiled class rules from the configuration
+    """
+    key = tuple(CONFIG.flavours.classes)
+    with RULES_LOCK:
+        if key not in RULES:
+            rules = []
+            for rule in key:
+                try:
+                    rules.append(parse_rule(rule))
+                except ValueError as err:
+                    logger.error('Ignoring invalid flavour class rule "%s": %s', rule, err)
+            RULES.clear()
+            RULES[key] = rules
+        return RULES[key]
+
+def flavour_class(flavour):
+    """
+    Return the hardware class of a flavour (name, cpus, memory, disk) given by the first
+    matching rule, or by the first character of its name if no rule matches
+    """
+    for (name, matches) in get_rules():
+        if matches(flavour):
+            return name
+    return flavour[0][:1]
+
+def fit(flavour, requirements):
+    """
+    Return how much a flavour exceeds the required resources, relative to them
+    """
+    resources = requirements.get('resources', {})
+    cores = resources.get('cores', 0)
+    memory = resources.get('memory', 0)
+    return (flavour[1] - cores)/float(max(cores, 1)) + (flavour[2] - memory)/float(max(memory, 1))
+
+def cost(flavour, cloud_config):
+    """
+    Return the cost of a flavour if known from the cloud's configuration
+    """
+    if cloud_config and flavour[0] in cloud_config.get('flavours', {}):
+        return cloud_config['flavours'][flavour[0]].get('cost', 0)
+    return 0
+
+def constrained(requirements):
+    """
+    Check if maximum resources are specified
+    """
+    resources = requirements.get('resources', {})
+    return 'coresMax' in resources and 'memoryMax' in resources and 'diskMax' in resources
+
+def order(flavours, requirements, cloud_config=None, failed_classes=()):
+    """
+    Return the flavours to try, best first. Flavours are ordered by fit & cost and only the
+    best of each class is kept, as if one flavour cannot be deployed others of the same
+    class probably cannot either. Classes which recently failed due to lack of capacity
+    are skipped. When maximum resources are specified all flavours are considered in the
+    order given, largest first.
+    """
+    all_flavours = constrained(requirements)
+    if all_flavours:
+        ordered = flavours
+    else:
+        ordered = sorted(flavours, key=lambda flavour: (fit(flavour, requirements), cost(flavour, cloud_config)))
+
+    planned = []
+    classes = set()
+    for flavour in ordered:
+        name = flavour_class(flavour)
+        if name in failed_classes:
+            continue
+        if not all_flavours and name in classes:
+            continue
+        classes.add(name)
+        planned.append(flavour)
+
+    return planned
+
+def plan(flavours, requirements, cloud_config=None, failed_classes=()):
+    """
+    Return the flavours to try, best first, as given by order, logging the plan
+    """
+    if constrained(requirements):
+        logger.info('Fully constrained resources specified, will consider all matching flavours')
+
+    planned = order(flavours, requirements, cloud_config, failed_classes)
+
+    skipped = set(failed_classes).intersection([flavour_class(flavour) for flavour in flavours])
+    if skipped:
+        logger.info('Skipping flavour classes with recent capacity failures: %s', ','.join(sorted(skipped)))
+    logger.info('Flavours to try in order: %s', ','.join([flavour[0] for flavour in planned]))
+
+    return planned
@@ -1,31 +1,137 @@
+"""Check the health of the components IMC depends on in the background"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import threading
+import time
+
+import requests
+
 from imc import config
 from imc import database
 from imc import imclient
-from imc import im_utils
 
 # Configuration
 CONFIG = config.get_config()
 
-def health():
-    status = True
-    msg = ''
+# Logging
+logger = logging.getLogger(__name__)
 
-    # Check Infrastructure Manager
-    client = imclient.IMClient(url=CONFIG.get('im', 'url'))
-    im_auth = im_utils.create_im_auth(None, None, None)
-    (status, msg) = client.getauth(im_auth)
-    if status != 0:
-        return (False, 'Unable to create IM auth')
+# Result of the most recent probe of each component
+RESULTS = {}
+RESULTS_LOCK = threading.Lock()
 
-    (status, _) = client.list_infra_ids(10)
-    if not status or status == 'timedout':
-        return (False, 'Unable to connect to Infrastructure Manager')
+MONITOR = None
+MONITOR_PID = None
+MONITOR_LOCK = threading.Lock()
 
-    # Check database
+def probe_database():
+    """
+    Check that the DB accepts connections and responds. A new connection is used rather
+    than one from the pool, which could take up to [db] pool_timeout when all are in use.
+    """
     db = database.get_db()
-    if db.connect():
-        db.close()
-    else:
-        return (False, 'Unable to connect to database')
+    if not db.connect(timeout=CONFIG.api.health_timeout):
+        return 'Unable to connect to database'
+    status = db.ping()
+    db.close()
+    if not status:
+        return 'Unable to query database'
+    return None
+
+def probe_im():
+    """
+    Check that Infrastructure Manager responds, without listing infrastructures
+    """
+    client = imclient.IMClient(url=CONFIG.im.url)
+    (status, _) = client.version(CONFIG.api.health_timeout)
+    if status is not True:
+        return 'Unable to connect to Infrastructure Manager'
+    return None
+
+def probe_token():
+    """
+    Check that the token endpoint's OpenID Connect provider responds
+    """
+    url = '%s/.well-known/openid-configuration' % CONFIG.egi_credentials.url.rstrip('/')
+    try:
+        response = requests.get(url, timeout=CONFIG.api.health_timeout)
+    except requests.exceptions.RequestException:
+        return 'Unable to connect to token endpoint'
+    if response.status_code != 200:
+        return 'Token endpoint returned status code %d' % response.status_code
+    return None
+
+def get_probes():
+    """
+    Return the probes to run, by component
+    """
+    probes = {'database': probe_database, 'im': probe_im}
+    if CONFIG.egi.enabled:
+        probes['token'] = probe_token
+    return probes
+
+def run_probe(name, probe):
+    """
+    Run a probe, recording its result & latency
+    """
+    start = time.time()
+    try:
+        error = probe()
+    except Exception as err:
+        error = 'Probe failed: %s' % err
+    end = time.time()
+
+    if error:
+        logger.warning('Health check of %s failed: %s', name, error)
+    with RESULTS_LOCK:
+        RESULTS[name] = {'status': 'error' if error else 'ok',
+                         'error': error,
+                         'latency': round(end - start, 3),
+                         'checked': end}
+
+def monitor():
+    """
+    Probe all components periodically, each at most once at a time
+    """
+    with ThreadPoolExecutor(len(get_probes())) as executor:
+        while True:
+            futures = [executor.submit(run_probe, name, probe) for (name, probe) in get_probes().items()]
+            for future in futures:
+                future.result()
+            time.sleep(CONFIG.api.health_interval)
+
+def start_monitor():
+    """
+    Start checking health in the background if not already checking in this process.
+    Threads do not survive a fork, so each worker process starts its own.
+    """
+    global MONITOR, MONITOR_PID
+    with MONITOR_LOCK:
+        if MONITOR is None or MONITOR_PID != os.getpid() or not MONITOR.is_alive():
+            MONITOR = threading.Thread(target=monitor, name='health', daemon=True)
+            MONITOR_PID = os.getpid()
+            MONITOR.start()
+
+def cached_health():
+    """
+    Return whether all components are healthy together with the most recent result of
+    each, without waiting for them. Results which are too old count as unhealthy.
+    """
+    start_monitor()
+    now = time.time()
+    with RESULTS_LOCK:
+        results = dict((name, dict(result)) for (name, result) in RESULTS.items())
+
+    components = {}
+    healthy = True
+    for name in get_probes():
+        result = results.get(name, {'status': 'unknown', 'error': 'Not checked yet', 'latency': None, 'checked': None})
+        checked = result.pop('checked')
+        result['age'] = round(now - checked, 3) if checked is not None else None
+        if checked is not None and result['age'] > CONFIG.api.health_max_age:
+            result['status'] = 'stale'
+        healthy = healthy and result['status'] == 'ok'
+        components[name] = result
 
-    return (status, msg)
+    return (healthy, {'status': 'ok' if healthy else 'unhealthy', 'components': components})
@@ -1,10 +1,13 @@
 """Functions for preparing for Infrastructure Manager"""
 from __future__ import print_function
 import base64
+import hashlib
 import logging
 import re
+from string import Template
 
 from imc import config
+from imc import utilities
 
 # Configuration
 CONFIG = config.get_config()
@@ -12,18 +15,77 @@ CONFIG = config.get_config()
 # Logging
 logger = logging.getLogger(__name__)
 
+# Regular expressions for parsing RADL
+INSTANCES_REGEX = re.compile(r'deploy.*\s(\d+)')
+
+# Parsed RADL, keyed by a hash of its content, so that retries & re-deployments of the
+# same infrastructure do not parse it again
+PARSED_RADL = utilities.LRUCache(256)
+
+class ParsedRadl(object):
+    """
+    RADL template parsed once, with the literal text split around its placeholders so that
+    rendering it for each cloud & flavour is a join, together with the number of
+    instances
+    """
+    def __init__(self, radl):
+        self.radl = radl
+        (self._chunks, self._placeholders) = parse_template(radl)
+        self.instances = get_num_instances(radl)
+
+    def render(self, **values):
+        """
+        Substitute values for the placeholders, in the same way as Template.substitute
+        """
+        chunks = list(self._chunks)
+        for (index, name) in self._placeholders:
+            chunks[index] = '%s' % (values[name],)
+        return ''.join(chunks)
+
+def parse_template(radl):
+    """
+    Split RADL into literal chunks and placeholders, returning the chunks with None at
+    the position of each placeholder, and a list of (position, name) of placeholders
+    """
+    chunks = []
+    placeholders = []
+    position = 0
+    for match in Template.pattern.finditer(radl):
+        chunks.append(radl[position:match.start()])
+        if match.group('escaped') is not None:
+            chunks.append(Template.delimiter)
+        elif match.group('named') is not None or match.group('braced') is not None:
+            placeholders.append((len(chunks), match.group('named') or match.group('braced')))
+            chunks.append(None)
+        else:
+            raise ValueError('Invalid placeholder in RADL at position %d' % match.start('invalid'))
+        position = match.end()
+    chunks.append(radl[position:])
+    return (chunks, placeholders)
+
+def parse_radl(radl):
+    """
+    Return parsed RADL, reusing a previous result for the same RADL
+    """
+    key = hashlib.sha256(radl.encode('utf-8')).hexdigest()
+    parsed = PARSED_RADL.get(key)
+    if not parsed:
+        parsed = ParsedRadl(radl)
+        PARSED_RADL.put(key, parsed)
+    return parsed
+
 def set_availability_zone(radl, zone):
     """
     Modify RADL to set availability zone
     """
-    radl_new = ''
+    lines = []
 
     for line in radl.split('\n'):
         if line.startswith('system'):
             line = line + "\navailability_zone = '%s' and" % zone
-        radl_new = radl_new + line + '\n'
+        lines.append(line)
 
-    return radl_new
+    return '\n'.join(lines) + '\n'
 
 def create_basic_radl(radl):
     """
@@ -31,14 +93,14 @@ def create_basic_radl(radl):
     """
     ignore = False
     skip_next_line = False
-    radl_new = ''
+    lines = []
 
     for line in radl.split('\n'):
         if line.startswith('configure ') or line.startswith('contextualize'):
             ignore = True
 
         if not ignore and not skip_next_line:
-            radl_new += '%s\n' % line
+            lines.append('%s\n' % line)
 
         if skip_next_line:
             skip_next_line = False
@@ -47,7 +109,7 @@ def create_basic_radl(radl):
             ignore = False
             skip_next_line = True
 
-    return radl_new
+    return ''.join(lines)
 
 def create_im_line(name, block, token):
     """
@@ -95,8 +157,8 @@ def create_im_auth(cloud, token, config):
     """
     # Create IM credentials
     credentials_im = {}
-    credentials_im['username'] = CONFIG.get('im', 'username')
-    credentials_im['password'] = CONFIG.get('im', 'password')
+    credentials_im['username'] = CONFIG.im.username
+    credentials_im['password'] = CONFIG.im.password
     credentials_im['type'] = 'InfrastructureManager'
 
     # Return only IM credentials if needed
@@ -139,7 +201,7 @@ def get_num_instances(radl):
     """
     instances = 0
     for line in radl.split('\n'):
-        m = re.search(r'deploy.*\s(\d+)', line)
+        m = INSTANCES_REGEX.search(line)
         if m:
             instances += int(m.group(1))
     return instances
@@ -34,6 +34,24 @@ class IMClient(object):
         """
         return self._headers
 
+    def version(self, timeout):
+        """
+        Get the version of IM, which requires no authentication
+        """
+        url = '%s/version' % self._url
+
+        try:
+            response = requests.get(url, timeout=timeout)
+        except requests.exceptions.Timeout:
+            return ('timedout', None)
+        except requests.exceptions.RequestException:
+            return ('timedout', None)
+
+        if response.status_code != 200:
+            return (None, response.text)
+
+        return (True, response.text)
+
     def list_infra_ids(self, timeout):
         """
         List infrastructure IDs
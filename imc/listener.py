@@ -0,0 +1,86 @@
+"""Wait for changes to infrastructures using a single LISTEN connection per process"""
+import logging
+import os
+import threading
+import time
+
+from imc import config
+from imc import database
+
+# Configuration
+CONFIG = config.get_config()
+
+# Logging
+logger = logging.getLogger(__name__)
+
+# Time to wait before reconnecting after losing the connection to the DB
+RECONNECT_DELAY = 5
+
+# Incremented whenever changes may have been made, so that waiters know to look again
+GENERATION = 0
+CHANGED = threading.Condition()
+
+LISTENER = None
+LISTENER_PID = None
+LISTENER_LOCK = threading.Lock()
+
+def notify_changed():
+    """
+    Wake everything waiting for changes
+    """
+    global GENERATION
+    with CHANGED:
+        GENERATION += 1
+        CHANGED.notify_all()
+
+def listen():
+    """
+    Listen for notifications of changes, reconnecting if the connection is lost
+    """
+    while True:
+        db = database.get_db()
+        if db.connect() and db.listen_changes():
+            # Changes may have been made while not listening
+            notify_changed()
+            while True:
+                notified = db.wait_for_changes(CONFIG.api.stream_keepalive)
+                if notified is None:
+                    break
+                if notified:
+                    notify_changed()
+                # A connection which has silently gone away never reports notifications or
+                # errors, so check it is still working when there have been no changes
+                elif not db.ping():
+                    break
+        db.close()
+        logger.warning('Lost connection used to listen for changes, reconnecting')
+        notify_changed()
+        time.sleep(RECONNECT_DELAY)
+
+def start_listener():
+    """
+    Start listening for changes in the background if not already listening in this process
+    """
+    global LISTENER, LISTENER_PID
+    with LISTENER_LOCK:
+        if LISTENER is None or LISTENER_PID != os.getpid() or not LISTENER.is_alive():
+            LISTENER = threading.Thread(target=listen, name='listener', daemon=True)
+            LISTENER_PID = os.getpid()
+            LISTENER.start()
+
+def get_generation():
+    """
+    Return the current generation, to be taken before looking for changes and then passed
+    to wait_for_change so that none made in between are missed
+    """
+    start_listener()
+    with CHANGED:
+        return GENERATION
+
+def wait_for_change(generation, timeout):
+    """
+    Wait until changes may have been made since the specified generation or the timeout
+    expires, returning True if there may be changes
+    """
+    with CHANGED:
+        return CHANGED.wait_for(lambda: GENERATION != generation, timeout)
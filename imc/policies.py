@@ -1,5 +1,13 @@
 """Determine which resources a job is allowed to run on"""
 import logging
+import time
+
+from imc import config
+from imc import flavour_planner
+from imc import ranking
+
+# Configuration
+CONFIG = config.get_config()
 
 # Logging
 logger = logging.getLogger(__name__)
@@ -222,6 +230,7 @@ class PolicyEngine():
         """
         clouds_out = self._clouds.copy()
 
+        # Clouds with an open or half-open circuit breaker are always marked as down
         for cloud in self._clouds:
             (status, mon_status, _, _, _, _, _, _) = self._db.get_cloud_info(cloud, self._identity)
             if status == 1 or mon_status == 1:
@@ -285,54 +294,24 @@ class PolicyEngine():
         """
         Returns ranked list of clouds
         """
-        if not self._preferences:
-            return clouds
-
-        ranking_sites = {}
-        ranking_regions = {}
+        history = self._db.get_deployment_history(time.time() - CONFIG.ranking.history, self._identity)
 
+        # Outcomes depend on the class of flavour which would be used first on each cloud
+        flavour_classes = {}
         for cloud in clouds:
-            ranking_sites[cloud] = 0
-            ranking_regions[cloud] = 0
-
-        if 'regions' in self._preferences:
-            for count in range(0, len(self._preferences['regions'])):
-                for cloud in clouds:
-                    if self._config[cloud]['region'] == self._preferences['regions'][count]:
-                        ranking_regions[cloud] = len(self._preferences['regions']) - count
-
-        if 'sites' in self._preferences:
-            for count in range(0, len(self._preferences['sites'])):
-                for cloud in clouds:
-                    if cloud == self._preferences['sites'][count]:
-                        ranking_sites[cloud] = len(self._preferences['sites']) - count
-
-        # Get list of clouds with numbers of successful and failed deployments
-        failures = self._db.get_deployment_failures(self._identity, 2*60*60)
-        successes = self._db.get_deployment_failures(self._identity, 2*60*60, True)
-
-        ratios = {}
-        for cloud in set(successes).intersection(failures):
-            ratios[cloud] = successes[cloud]/(successes[cloud] + failures[cloud])
-            logger.info('Cloud %s has success ratio of %d', cloud, 100*ratios[cloud])
-
-        for cloud in successes:
-            if cloud not in ratios:
-                ratios[cloud] = 1.0
-
-        for cloud in failures:
-            if cloud not in ratios:
-                ratios[cloud] = 0.0
-
-        cloud_weights = {}
-        for cloud in clouds:
-            # TODO: this is not really correct!
-            # TODO: failed state can be overriden if dynamic quotas change
-            weight_failures = 0
-            if cloud in ratios:
-                weight_failures = 1000*ratios[cloud]
-
-            weight = ranking_regions[cloud] + ranking_sites[cloud] + weight_failures
-            cloud_weights[cloud] = weight
-
-        return sorted(cloud_weights, key=cloud_weights.__getitem__, reverse=True)
+            flavours = self.get_flavours(cloud)
+            if flavours:
+                flavour_classes[cloud] = flavour_planner.flavour_class(flavour_planner.order(flavours, self._requirements)[0])
+
+        instances = None
+        if self._requirements and 'resources' in self._requirements:
+            instances = self._requirements['resources'].get('instances')
+
+        return ranking.rank(clouds,
+                            history,
+                            time.time(),
+                            self._config,
+                            self._preferences,
+                            flavour_classes,
+                            instances,
+                            CONFIG.ranking.explore)
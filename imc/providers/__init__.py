@@ -0,0 +1,93 @@
+"""Registry of cloud providers, discovered from the imc.providers entry point group"""
+import importlib
+import logging
+import threading
+
+# Logging
+logger = logging.getLogger(__name__)
+
+# Entry point group which other packages can use to add providers, e.g.
+#   entry_points={'imc.providers': ['MyCloud = mypackage.provider:MyCloudProvider']}
+GROUP = 'imc.providers'
+
+# Providers included with IMC, used when IMC is run without being installed
+BUILTIN = {'OpenStack': 'imc.providers.openstack:OpenStackProvider',
+           'GCE': 'imc.providers.gce:GCEProvider'}
+
+# Provider classes are only imported, and instances only created, when first needed
+ENTRY_POINTS = None
+PROVIDERS = {}
+PROVIDERS_LOCK = threading.Lock()
+
+# Libcloud provider for each built-in type of cloud
+LIBCLOUD_PROVIDERS = {'OpenStack': 'OPENSTACK',
+                      'GCE': 'GCE'}
+
+# Libcloud drivers, which are only imported when first needed as libcloud is slow to
+# import and most processes never talk to clouds directly
+DRIVERS = {}
+DRIVERS_LOCK = threading.Lock()
+
+def discover():
+    """
+    Find all available providers, returning a dict of cloud type to a loader function
+    """
+    found = {}
+    for (name, target) in BUILTIN.items():
+        found[name] = lambda target=target: load(target)
+
+    try:
+        from importlib.metadata import entry_points
+        points = entry_points()
+        if hasattr(points, 'select'):
+            points = points.select(group=GROUP)
+        else:
+            points = points.get(GROUP, [])
+    except Exception as err:
+        logger.warning('Unable to discover cloud providers from entry points: %s', err)
+        points = []
+
+    for point in points:
+        found[point.name] = point.load
+
+    return found
+
+def load(target):
+    """
+    Import a provider class given as module:class
+    """
+    (module, name) = target.split(':')
+    return getattr(importlib.import_module(module), name)
+
+def get_provider(cloud_type):
+    """
+    Return the provider for a type of cloud, or None if the type is not supported
+    """
+    global ENTRY_POINTS
+    with PROVIDERS_LOCK:
+        if cloud_type in PROVIDERS:
+            return PROVIDERS[cloud_type]
+
+        if ENTRY_POINTS is None:
+            ENTRY_POINTS = discover()
+
+        provider = None
+        if cloud_type in ENTRY_POINTS:
+            try:
+                provider = ENTRY_POINTS[cloud_type]()()
+            except Exception as err:
+                logger.critical('Unable to load provider for cloud type %s due to: %s', cloud_type, err)
+
+        PROVIDERS[cloud_type] = provider
+        return provider
+
+def get_driver(cloud_type):
+    """
+    Return the libcloud driver class for a type of cloud
+    """
+    with DRIVERS_LOCK:
+        if cloud_type not in DRIVERS:
+            from libcloud.compute.types import Provider
+            from libcloud.compute.providers import get_driver as get_libcloud_driver
+            DRIVERS[cloud_type] = get_libcloud_driver(getattr(Provider, LIBCLOUD_PROVIDERS[cloud_type]))
+        return DRIVERS[cloud_type]
@@ -0,0 +1,139 @@
+"""Base class for cloud providers"""
+import hashlib
+import json
+import logging
+import threading
+
+from imc import config
+from imc import utilities
+
+# Configuration
+CONFIG = config.get_config()
+
+# Logging
+logger = logging.getLogger(__name__)
+
+class ProviderError(Exception):
+    """
+    Unable to talk to a cloud
+    """
+
+class Provider(object):
+    """
+    A type of cloud. Each provider keeps its own pool of authenticated connections and
+    limits the number of requests made at once to clouds of its type. Subclasses implement
+    create_connection and the fetch_* and probe methods; callers use the public methods.
+    """
+    # Maximum number of concurrent requests to clouds of this type
+    concurrency = 8
+
+    def __init__(self):
+        self._connections = utilities.LRUCache(CONFIG.pool.connections,
+                                               CONFIG.pool.connections_max_age)
+        self._slots = threading.BoundedSemaphore(self.concurrency)
+
+    @staticmethod
+    def connection_key(cloud, config, token):
+        """
+        Generate the key identifying a connection to a cloud with specific credentials
+        """
+        fingerprint = hashlib.sha256()
+        fingerprint.update(json.dumps(config['credentials'], sort_keys=True).encode('utf-8'))
+        if token:
+            fingerprint.update(token.encode('utf-8'))
+        return (cloud, fingerprint.hexdigest())
+
+    def connect(self, cloud, config, token):
+        """
+        Return a connection to a cloud, reusing an existing connection if possible
+        """
+        key = self.connection_key(cloud, config, token)
+        conn = self._connections.get(key)
+        if conn:
+            return conn
+
+        try:
+            conn = self.create_connection(cloud, config, token)
+        except Exception as ex:
+            logger.critical('Unable to connect to cloud %s due to "%s"', cloud, ex)
+            return None
+
+        if conn:
+            self._connections.put(key, conn)
+        return conn
+
+    def discard(self, cloud, config, token):
+        """
+        Remove a connection to a cloud from the pool, e.g. after an authentication error
+        """
+        self._connections.pop(self.connection_key(cloud, config, token))
+
+    def call(self, function, cloud, config, token, *args):
+        """
+        Call a function with a connection to a cloud, discarding the connection on error
+        """
+        conn = self.connect(cloud, config, token)
+        if not conn:
+            raise ProviderError('unable to connect to cloud %s' % cloud)
+
+        with self._slots:
+            try:
+                return function(conn, cloud, config, *args)
+            except Exception:
+                self.discard(cloud, config, token)
+                raise
+
+    def list_images(self, cloud, config, token, match=None):
+        """
+        Return the images available on a cloud as a list of dicts with id & name. If a
+        match function is given only images with names it accepts are returned.
+        """
+        return self.call(self.fetch_images, cloud, config, token, match)
+
+    def list_flavours(self, cloud, config, token):
+        """
+        Return the flavours available on a cloud as a list of dicts with name, cpus,
+        ram (in MB) & disk
+        """
+        return self.call(self.fetch_flavours, cloud, config, token)
+
+    def get_quotas(self, cloud, config, token):
+        """
+        Return the quotas of a cloud, or an empty dict if they cannot be determined
+        """
+        return {}
+
+    def health_probe(self, cloud, config, token):
+        """
+        Check if a cloud is functional by making a lightweight authenticated request
+        """
+        try:
+            self.call(self.probe, cloud, config, token)
+        except Exception as ex:
+            logger.warning('Unable to check cloud %s due to %s', cloud, ex)
+            return False
+        return True
+
+    def create_connection(self, cloud, config, token):
+        """
+        Create a new connection to a cloud
+        """
+        raise NotImplementedError
+
+    def fetch_images(self, conn, cloud, config, match):
+        """
+        List images using a connection
+        """
+        raise NotImplementedError
+
+    def fetch_flavours(self, conn, cloud, config):
+        """
+        List flavours using a connection
+        """
+        raise NotImplementedError
+
+    def probe(self, conn, cloud, config):
+        """
+        Make a lightweight authenticated request using a connection
+        """
+        raise NotImplementedError
@@ -0,0 +1,39 @@
+"""Google Compute Engine clouds"""
+import logging
+
+from imc.providers import get_driver
+from imc.providers.base import Provider
+
+# Logging
+logger = logging.getLogger(__name__)
+
+class GCEProvider(Provider):
+    """
+    Google Compute Engine, using libcloud
+    """
+    concurrency = 4
+
+    def create_connection(self, cloud, config, token):
+        credentials = config['credentials']
+        details = {}
+        if 'project' in credentials:
+            details['project'] = credentials['project']
+        if 'datacenter' in credentials:
+            details['datacenter'] = credentials['datacenter']
+
+        return get_driver('GCE')(credentials['username'], credentials['password'], **details)
+
+    def fetch_images(self, conn, cloud, config, match):
+        return [{'id': image.id, 'name': image.name} for image in conn.list_images()
+                if not match or match(image.name)]
+
+    def fetch_flavours(self, conn, cloud, config):
+        # GCE sizes have no vcpus so, as before providers were added, no flavours are used
+        return [{'name': flavour.name,
+                 'cpus': getattr(flavour, 'vcpus', None),
+                 'ram': flavour.ram,
+                 'disk': flavour.disk} for flavour in conn.list_sizes()]
+
+    def probe(self, conn, cloud, config):
+        # Locations are quick to list
+        conn.list_locations()
@@ -0,0 +1,260 @@
+"""OpenStack clouds"""
+import hashlib
+import logging
+import time
+
+import requests
+
+from imc import config
+from imc import tokens
+from imc import utilities
+from imc.providers import get_driver
+from imc.providers.base import Provider
+
+# Configuration
+CONFIG = config.get_config()
+
+# Logging
+logger = logging.getLogger(__name__)
+
+# Credentials required for getting quotas
+QUOTAS_CREDENTIALS = ('password', 'project_id', 'project_domain_id', 'host', 'user_domain_name')
+
+# How long before trying again to get usage from a cloud which does not allow users to
+# get their own usage
+LIMITS_ONLY_RETRY = 24*60*60
+
+# Filters applied by Glance when listing images, unless overridden by image_filters in
+# the cloud's configuration
+IMAGE_FILTERS = {'status': 'active'}
+
+# Timeout for each request to Glance
+GLANCE_TIMEOUT = 30
+
+class OpenStackProvider(Provider):
+    """
+    OpenStack clouds, using libcloud for compute and novaclient for quotas
+    """
+    concurrency = 16
+
+    def __init__(self):
+        super(OpenStackProvider, self).__init__()
+        # Nova clients, reused while the cloud, project and token are unchanged
+        self._nova_clients = utilities.LRUCache(CONFIG.pool.connections,
+                                                CONFIG.pool.connections_max_age)
+        # Time when each cloud was found not to allow users to get their own usage
+        self._limits_only = {}
+
+    def create_connection(self, cloud, config, token):
+        credentials = config['credentials']
+        details = {}
+        details['ex_force_auth_url'] = credentials['host']
+        if 'auth_version' in credentials:
+            details['ex_force_auth_version'] = credentials['auth_version']
+        if 'tenant' in credentials:
+            details['ex_tenant_name'] = credentials['tenant']
+        if 'domain' in credentials:
+            details['ex_domain_name'] = credentials['domain']
+        if 'service_region' in credentials:
+            details['ex_force_service_region'] = credentials['service_region']
+        if 'project_domain_id' in credentials:
+            details['ex_tenant_domain_id'] = credentials['project_domain_id']
+
+        if credentials['auth_version'] == '3.x_password':
+            secret = credentials['password']
+        elif credentials['auth_version'] == '3.x_oidc_access_token':
+            if 'ex_force_base_url' in credentials:
+                details['ex_force_base_url'] = credentials['ex_force_base_url']
+            secret = token
+        else:
+            return None
+
+        return get_driver('OpenStack')(credentials['username'], secret, **details)
+
+    def fetch_images(self, conn, cloud, config, match):
+        try:
+            endpoint = self.image_endpoint(conn, config)
+        except Exception as ex:
+            logger.info('Unable to find image service for cloud %s, will use compute API: %s', cloud, ex)
+            return [{'id': image.id, 'name': image.name} for image in conn.list_images()
+                    if not match or match(image.name)]
+
+        return list(self.glance_images(conn, endpoint, config, match))
+
+    @staticmethod
+    def image_endpoint(conn, config):
+        """
+        Get the URL of the Glance API from the service catalog
+        """
+        catalog = conn.connection.get_service_catalog()
+        endpoint = catalog.get_endpoint(service_type='image',
+                                        region=config['credentials'].get('service_region'))
+        url = endpoint.url.rstrip('/')
+        if url.endswith('/v2'):
+            url = url[:-3]
+        return url
+
+    @staticmethod
+    def glance_images(conn, endpoint, config, match):
+        """
+        List images page by page using the Glance API, with filtering by status,
+        visibility & properties done by Glance
+        """
+        params = dict(IMAGE_FILTERS)
+        params.update(config.get('image_filters', {}))
+        params['limit'] = CONFIG.updates.images_page_size
+        headers = {'X-Auth-Token': conn.connection.auth_token,
+                   'Accept': 'application/json'}
+
+        with requests.Session() as session:
+            while True:
+                response = session.get('%s/v2/images' % endpoint,
+                                       params=params,
+                                       headers=headers,
+                                       timeout=GLANCE_TIMEOUT)
+                response.raise_for_status()
+                data = response.json()
+
+                for image in data['images']:
+                    name = image.get('name') or ''
+                    if not match or match(name):
+                        yield {'id': image['id'], 'name': name}
+
+                if 'next' not in data or not data['images']:
+                    break
+                params['marker'] = data['images'][-1]['id']
+
+    def fetch_flavours(self, conn, cloud, config):
+        return [{'name': flavour.name,
+                 'cpus': flavour.vcpus,
+                 'ram': flavour.ram,
+                 'disk': flavour.disk} for flavour in conn.list_sizes()]
+
+    def probe(self, conn, cloud, config):
+        # Compute limits are quick to get
+        conn.connection.request('/limits')
+
+    def get_nova_client(self, cloud, credentials, token):
+        """
+        Return a Nova client, reusing an existing client and its Keystone session if the
+        project and token are unchanged
+        """
+        # The OpenStack clients are slow to import, so are only imported when first needed
+        from keystoneauth1 import session
+        from keystoneauth1.identity import generic
+        from novaclient import client
+
+        if not token and not credentials.get('password'):
+            logger.critical('Neither a token nor a password is available for cloud %s', cloud)
+            return (None, None)
+
+        fingerprint = hashlib.sha256((token or credentials['password']).encode('utf-8')).hexdigest()
+        key = (cloud, credentials['project_id'], fingerprint)
+        nova = self._nova_clients.get(key)
+        if nova:
+            return (key, nova)
+
+        if token:
+            # Exchange the access token for an unscoped Keystone token, which the session
+            # scopes to the project and reuses when the scoped token expires
+            try:
+                unscoped_token = tokens.get_unscoped_token(credentials['host'],
+                                                           token,
+                                                           credentials['username'],
+                                                           credentials['tenant'])
+            except Exception as ex:
+                logger.critical('Unable to get an unscoped token from Keystone for cloud %s due to "%s"', cloud, ex)
+                return (key, None)
+
+            if not unscoped_token:
+                logger.critical('Unable to get an unscoped token from Keystone for cloud %s', cloud)
+                return (key, None)
+
+            auth = generic.Token(auth_url=credentials['host'],
+                                 token=unscoped_token,
+                                 project_id=credentials['project_id'],
+                                 project_domain_id=credentials['project_domain_id'])
+        else:
+            auth = generic.Password(auth_url=credentials['host'],
+                                    username=credentials['username'],
+                                    password=credentials['password'],
+                                    user_domain_name=credentials['user_domain_name'],
+                                    project_id=credentials['project_id'],
+                                    project_domain_id=credentials['project_domain_id'])
+
+        nova = client.Client(2, session=session.Session(auth=auth, timeout=10))
+        self._nova_clients.put(key, nova)
+
+        return (key, nova)
+
+    def get_quotas(self, cloud, config, token):
+        credentials = config['credentials']
+        for item in QUOTAS_CREDENTIALS:
+            if item not in credentials:
+                logger.critical('%s is not in the credentials file', item)
+                return {}
+
+        with self._slots:
+            return self.get_quotas_nova(cloud, credentials, token)
+
+    def get_quotas_nova(self, cloud, credentials, token):
+        """
+        Get quotas remaining using the Nova API
+        """
+        from novaclient import exceptions as nova_exceptions
+
+        (key, nova) = self.get_nova_client(cloud, credentials, token)
+        if not nova:
+            return {}
+
+        quotas = {}
+
+        # Get limits & usage together unless the cloud is known not to allow users to get
+        # their own usage info (why??)
+        if time.time() - self._limits_only.get(cloud, 0) > LIMITS_ONLY_RETRY:
+            try:
+                os_quotas = nova.quotas.get(credentials['tenant_id'], detail=True)
+            except nova_exceptions.Unauthorized as ex:
+                logger.warning('Unable to get quotas from cloud %s due to "%s"', cloud, str(ex).encode('utf-8'))
+                self._nova_clients.pop(key)
+                return quotas
+            except nova_exceptions.Forbidden as ex:
+                logger.info('Unable to get quota usage from cloud %s due to "%s", will only get limits', cloud, str(ex).encode('utf-8'))
+                self._limits_only[cloud] = time.time()
+            except Exception as ex:
+                logger.warning('Unable to get quotas from cloud %s due to "%s"', cloud, str(ex).encode('utf-8'))
+                self._nova_clients.pop(key)
+                return quotas
+            else:
+                os_quotas_dict = os_quotas.to_dict()
+
+                quotas['cpu-limit'] = os_quotas_dict['cores']['limit']
+                quotas['memory-limit'] = int(os_quotas_dict['ram']['limit']/1024)
+                quotas['instances-limit'] = os_quotas_dict['instances']['limit']
+
+                quotas['cpu-used'] = os_quotas_dict['cores']['in_use'] + os_quotas_dict['cores']['reserved']
+                quotas['memory-used'] = int(os_quotas_dict['ram']['in_use'] + os_quotas_dict['ram']['reserved'])/1024
+                quotas['instances-used'] = os_quotas_dict['instances']['in_use'] + os_quotas_dict['instances']['reserved']
+
+                logger.info('Got limits cpu=%d, memory=%d, instances=%d', int(quotas['cpu-limit']), quotas['memory-limit'], int(quotas['instances-limit']))
+                logger.info('Got usage cpu=%d, memory=%d, instances=%d', int(quotas['cpu-used']), quotas['memory-used'], int(quotas['instances-used']))
+
+                return quotas
+
+        # Get limits only
+        try:
+            os_quotas = nova.quotas.get(credentials['tenant_id'], detail=False)
+        except Exception as ex:
+            logger.warning('Unable to get quotas from cloud %s due to "%s"', cloud, str(ex).encode('utf-8'))
+            self._nova_clients.pop(key)
+            return quotas
+
+        os_quotas_dict = os_quotas.to_dict()
+
+        quotas['cpu-limit'] = os_quotas_dict['cores']
+        quotas['memory-limit'] = int(os_quotas_dict['ram']/1024)
+        quotas['instances-limit'] = os_quotas_dict['instances']
+
+        logger.info('Got limits cpu=%d, memory=%d, instances=%d', int(quotas['cpu-limit']), quotas['memory-limit'], int(quotas['instances-limit']))
+
+        return quotas
@@ -1,5 +1,6 @@
 from __future__ import print_function
-from string import Template
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import copy
 import time
 from random import shuffle
 import logging
@@ -8,6 +9,8 @@ from imc import cloud_deploy
 from imc import cloud_utils
 from imc import im_utils
 from imc import config
+from imc import database
+from imc import flavour_planner
 from imc import utilities
 from imc import cloud_quotas
 from imc import policies
@@ -18,19 +21,35 @@ CONFIG = config.get_config()
 # Logging
 logger = logging.getLogger(__name__)
 
-def deploy_job(db, unique_id):
+# Decoded descriptions of infrastructures being deployed, keyed by infrastructure ID
+SPECS = utilities.LRUCache(CONFIG.pool.descriptions)
+
+def get_deployment_spec(db, unique_id):
     """
-    Find an appropriate resource to deploy infrastructure
+    Return the decoded description of an infrastructure: its identity, identifier,
+    parsed RADL, requirements, preferences & requested hedging. Descriptions never change
+    once an infrastructure has been created, so are only read from the DB and decoded once.
+    Returns None if the description is invalid or False if it could not be read.
     """
-    # Get JSON description & identity from the DB
+    spec = SPECS.get(unique_id)
+    if spec:
+        return spec
+
     (description, identity, identifier) = db.deployment_get_json(unique_id)
-    logger.info('Deploying infrastructure %s with identifier %s', unique_id, identifier)
+    if not description:
+        logger.critical('Unable to get description of infrastructure %s', unique_id)
+        return False
 
-    # Get RADL
+    # Get RADL, parsed once for all clouds & flavours
     radl_contents = im_utils.get_radl(description)
     if not radl_contents:
-        logging.critical('RADL must be provided')
-        db.deployment_update_status(unique_id, 'unable')
+        logger.critical('RADL must be provided')
+        return None
+
+    try:
+        parsed_radl = im_utils.parse_radl(radl_contents)
+    except ValueError as err:
+        logger.critical('Invalid RADL: %s', err)
         return None
 
     # Get requirements & preferences
@@ -38,15 +57,208 @@ def deploy_job(db, unique_id):
     preferences = {}
     if 'requirements' in description:
         requirements = description['requirements']
-    if 'prefereneces' in description:
+    if 'preferences' in description:
         preferences = description['preferences']
 
-    job_want = description['want']
-
     # Count number of instances
-    instances = im_utils.get_num_instances(radl_contents)
+    requirements['resources']['instances'] = parsed_radl.instances
+
+    spec = {'identity': identity,
+            'identifier': identifier,
+            'radl': parsed_radl,
+            'requirements': requirements,
+            'preferences': preferences}
+    if 'hedge' in description:
+        spec['hedge'] = description['hedge']
+
+    SPECS.put(unique_id, spec)
+    return spec
+
+def hedge_clouds(description):
+    """
+    Return the number of clouds to deploy on at once, which can be set per request up to
+    a maximum
+    """
+    clouds = CONFIG.deployment.hedge
+    if 'hedge' in description:
+        try:
+            clouds = int(description['hedge'])
+        except (TypeError, ValueError):
+            logger.warning('Ignoring invalid hedge value %s', description['hedge'])
+    return max(1, min(clouds, CONFIG.deployment.hedge_max))
+
+def prepare_cloud(db, policy, cloud, parsed_radl, requirements, clouds_info_list):
+    """
+    Return the resource type of a cloud and the list of flavours (name, cpus, memory,
+    rendered RADL, class) to try deploying with, which is empty if the cloud should be
+    skipped
+    """
+    resource_type = None
+    region = None
+    groups = []
+    cloud_config = None
+    for cloud_info in clouds_info_list:
+        if cloud_info['name'] == cloud:
+            cloud_config = cloud_info
+            resource_type = cloud_info['type']
+            region = cloud_info['region']
+            if 'supported_groups' in cloud_info:
+                groups = cloud_info['supported_groups']
+
+    if resource_type:
+        logger.info('Resource %s is of type %s', cloud, resource_type)
+    else:
+        logger.info('Skipping because no resource type could be determined for resource %s', cloud)
+        return (None, [])
+
+    # Get image
+    (image_name, image_url) = policy.get_image(cloud)
+
+    # If no image meets the requirements we should skip the current cloud
+    if not image_name:
+        logger.info('Skipping because no image could be determined')
+        return (resource_type, [])
+
+    # Get flavours
+    flavours = policy.get_flavours(cloud)
+
+    # If no flavour meets the requirements we should skip the current cloud
+    if not flavours:
+        logger.info('Skipping because no flavour could be determined')
+        return (resource_type, [])
+
+    # Choose the best flavour of each class - one class might have no more available
+    # hypervisors but another is fine - skipping classes which recently had no capacity
+    failed_classes = db.get_capacity_failures(cloud, flavour_planner.CAPACITY_FAILURES, CONFIG.flavours.capacity_backoff)
+    flavours = flavour_planner.plan(flavours, requirements, cloud_config, failed_classes)
+    if not flavours:
+        logger.info('Skipping because all suitable flavour classes recently had no capacity')
+        return (resource_type, [])
+
+    # Create complete RADL content for each flavour
+    attempts = []
+    for flavour in flavours:
+        (flavour_name, flavour_cpus, flavour_memory, _) = flavour
+        radl = parsed_radl.render(instance=flavour_name,
+                                  image=image_url,
+                                  cloud=cloud,
+                                  allow_groups=utilities.groups_start_expr(groups),
+                                  region=region)
+        attempts.append((flavour_name, flavour_cpus, flavour_memory, radl, flavour_planner.flavour_class(flavour)))
+
+    logger.info('Will try deploying on cloud %s with image %s', cloud, image_url)
+    return (resource_type, attempts)
+
+def deploy_on_cloud(db, unique_id, identity, cloud, attempts, instances, time_begin, hedge=None):
+    """
+    Try deploying on a cloud with each flavour in turn, returning the IM infrastructure
+    ID, the reason for failure and the CPUs & memory used
+    """
+    reason = None
+    for (flavour_name, flavour_cpus, flavour_memory, radl, flavour_class) in attempts:
+        if hedge and hedge.cancelled.is_set():
+            break
+
+        # Infrastructure being deployed as part of a hedge group has no cloud of its own yet,
+        # so its resources are recorded separately to be included in usage of the cloud
+        if hedge:
+            db.deployment_reserve_resources(unique_id, cloud, instances, flavour_cpus*instances, flavour_memory*instances)
+
+        logger.info('Attempting to deploy on cloud %s with flavour %s', cloud, flavour_name)
+        (infra_id, reason) = cloud_deploy.deploy(radl,
+                                                 cloud,
+                                                 time_begin,
+                                                 unique_id,
+                                                 identity,
+                                                 db,
+                                                 instances,
+                                                 flavour_cpus*instances,
+                                                 flavour_memory*instances,
+                                                 hedge,
+                                                 flavour_class)
+        if infra_id:
+            return (infra_id, None, flavour_cpus*instances, flavour_memory*instances)
+
+    return (None, reason, 0, 0)
+
+def hedge_worker(hedge, unique_id, identity, cloud, attempts, instances, time_begin):
+    """
+    Deploy on one cloud of a hedge group using its own DB connection. Unless its
+    infrastructure is kept, the resources recorded for the cloud are released once the
+    attempt has failed or its infrastructure has been destroyed.
+    """
+    db = database.get_db()
+    if not db.connect():
+        logger.critical('Unable to connect to DB for deploying on cloud %s', cloud)
+        return (None, None, 0, 0)
+
+    result = (None, None, 0, 0)
+    try:
+        result = deploy_on_cloud(db, unique_id, identity, cloud, attempts, instances, time_begin, hedge)
+    except Exception as err:
+        logger.critical('Got exception deploying on cloud %s: %s', cloud, err)
+    finally:
+        if not result[0]:
+            db.deployment_release_resources(unique_id, cloud)
+        db.close()
+    return result
+
+def deploy_hedged(unique_id, identity, candidates, instances, time_begin):
+    """
+    Deploy on several clouds at once, keeping the first infrastructure to be configured.
+    The others destroy their own infrastructure in the background once it has been claimed.
+    """
+    logger.info('Deploying on clouds [%s] at once', ','.join([candidate[0] for candidate in candidates]))
+    hedge = cloud_deploy.HedgeGroup()
+    executor = ThreadPoolExecutor(len(candidates))
+    futures = {}
+    for (cloud, resource_type, attempts) in candidates:
+        future = executor.submit(hedge_worker, hedge, unique_id, identity, cloud, attempts, instances, time_begin)
+        futures[future] = (cloud, resource_type)
+
+    result = (None, None, None, None, 0, 0)
+    for future in as_completed(futures):
+        (infra_id, reason, cpus, memory) = future.result()
+        (cloud, resource_type) = futures[future]
+        if infra_id:
+            result = (cloud, resource_type, infra_id, None, cpus, memory)
+            break
+        if reason:
+            result = (None, None, None, reason, 0, 0)
+
+    executor.shutdown(wait=False)
+    return result
+
+def deployment_deleted(db, unique_id):
+    """
+    Check if deletion of the infrastructure has been requested
+    """
+    (_, infra_status_new, _, _, _) = db.deployment_get_im_infra_id(unique_id)
+    if infra_status_new in ('deletion-requested', 'deleted', 'deletion-failed', 'deleting'):
+        logger.info('Deletion requested of infrastructure, aborting deployment')
+        return True
+    return False
+
+def deploy_job(db, unique_id):
+    """
+    Find an appropriate resource to deploy infrastructure
+    """
+    # Get the decoded description & identity
+    spec = get_deployment_spec(db, unique_id)
+    if spec is False:
+        return False
+    if not spec:
+        db.deployment_update_status(unique_id, 'unable')
+        return None
+
+    identity = spec['identity']
+    logger.info('Deploying infrastructure %s with identifier %s', unique_id, spec['identifier'])
+
+    parsed_radl = spec['radl']
+    requirements = copy.deepcopy(spec['requirements'])
+    preferences = spec['preferences']
+    instances = parsed_radl.instances
     logger.info('Found %d instances to deploy', instances)
-    requirements['resources']['instances'] = instances
 
     # Get full list of cloud info
     logger.info('Getting list of clouds from DB')
@@ -65,10 +277,8 @@ def deploy_job(db, unique_id):
         db.deployment_update_status_reason(unique_id, 'NoMatchingResources')
         return None
 
-    # Update quotas if necessary
-    # TODO: move this so it's done once per identity, not multiple times
-    logger.info('Updating cloud quotas if necessary')
-    cloud_quotas.set_quotas(requirements, db, identity, clouds_info_list)
+    # Request a background refresh of quotas if necessary, deployment uses the current values
+    cloud_quotas.request_update(identity)
 
     # Get list of clouds meeting the specified requirements
     clouds = policy.statisfies_requirements()
@@ -93,121 +303,85 @@ def deploy_job(db, unique_id):
         return False
 
     # Check if we should stop
-    (_, infra_status_new, _, _, _) = db.deployment_get_im_infra_id(unique_id)
-    if infra_status_new in ('deletion-requested', 'deleted', 'deletion-failed', 'deleting'):
-        logger.info('Deletion requested of infrastructure, aborting deployment')
+    if deployment_deleted(db, unique_id):
         return False
 
     # Try to create infrastructure, exiting on the first successful attempt
     time_begin = time.time()
     success = False
     reason = None
+    infra_id = None
+    instances = int(requirements['resources']['instances'])
 
+    # Prepare deployments on all clouds up-front so that the best ones can be tried at once
+    prepared = []
     for cloud in clouds_ranked:
-        # If we have already successfully deployed infrastructure we don't need to continue
-        if success:
-            break
-
-        infra_id = None
-        resource_type = None
-        region = None
-        groups = []
-        for cloud_info in clouds_info_list:
-            if cloud_info['name'] == cloud:
-                resource_type = cloud_info['type']
-                region = cloud_info['region']
-                if 'supported_groups' in cloud_info:
-                    groups = cloud_info['supported_groups']
-
-        if resource_type:
-            logger.info('Resource %s is of type %s', cloud, resource_type)
-        else:
-            logger.info('Skipping because no resource type could be determined for resource %s', cloud)
-            continue
-        
-        # Get image
         try:
-            (image_name, image_url) = policy.get_image(cloud)
+            (resource_type, attempts) = prepare_cloud(db, policy, cloud, parsed_radl, requirements, clouds_info_list)
         except Exception as err:
-            logger.critical('Unable to get image due to %s', err)
+            logger.critical('Unable to prepare deployment on cloud %s due to %s', cloud, err)
             return False
+        if attempts:
+            prepared.append((cloud, resource_type, attempts))
+
+    # Optionally deploy on the top ranked clouds at once, limiting the extra CPUs which may
+    # be used on clouds other than the first
+    hedge = hedge_clouds(spec)
+    candidates = []
+    extra_cpus = 0
+    for (cloud, resource_type, attempts) in prepared:
+        if len(candidates) == hedge:
+            break
+        cpus = attempts[0][1]*instances
+        if candidates:
+            if extra_cpus + cpus > CONFIG.deployment.hedge_extra_cpus:
+                continue
+            extra_cpus += cpus
+        candidates.append((cloud, resource_type, attempts))
+
+    if len(candidates) > 1:
+        (cloud, resource_type, infra_id, reason, cpus, memory) = deploy_hedged(unique_id, identity, candidates, instances, time_begin)
+        if infra_id:
+            success = True
+            db.deployment_update_resources(unique_id, instances, cpus, memory)
+        else:
+            # Try the remaining clouds one at a time
+            tried = [candidate[0] for candidate in candidates]
+            prepared = [candidate for candidate in prepared if candidate[0] not in tried]
 
-        # If no image meets the requirements we should skip the current cloud
-        if not image_name:
-            logger.info('Skipping because no image could be determined')
-            continue
+    for (cloud, resource_type, attempts) in prepared:
+        # If we have already successfully deployed infrastructure we don't need to continue
+        if success:
+            break
 
-        # Get flavours
-        try:
-            flavours = policy.get_flavours(cloud)
-        except Exception as err:
-            logger.critical('Unable to get flavours due to %s', err)
+        logger.info('Attempting to deploy on cloud %s', cloud)
+
+        # Check if we should stop
+        if deployment_deleted(db, unique_id):
             return False
 
-        # If no flavour meets the requirements we should skip the current cloud
-        if not flavours:
-            logger.info('Skipping because no flavour could be determined')
-            continue
+        (infra_id, reason, _, _) = deploy_on_cloud(db, unique_id, identity, cloud, attempts, instances, time_begin)
+        if infra_id:
+            success = True
 
-        # Generate list of flavours with unique classs - one class might have no
-        # more available hypervisors but another is fine. When maximum resources
-        # are specified all flavours will be considered.
-        flavours = utilities.create_flavour_list(flavours, requirements)
+    if infra_id:
+        # Set cloud and IM infra id
+        db.deployment_update_status(unique_id, None, cloud, infra_id, resource_type)
 
-        logger.info('Attempting to deploy on cloud %s', cloud)
- 
-        # Check if we should stop
-        (_, infra_status_new, _, _, _) = db.deployment_get_im_infra_id(unique_id)
-        if infra_status_new in ('deletion-requested', 'deleted', 'deletion-failed', 'deleting'):
-            logger.info('Deletion requested of infrastructure, aborting deployment')
+        # Resources recorded while deploying on several clouds at once are now included in
+        # those of the infrastructure
+        if len(candidates) > 1:
+            db.deployment_release_resources(unique_id, cloud)
+
+        # Final check if we should delete the infrastructure
+        if deployment_deleted(db, unique_id):
             return False
 
-        # Loop over flavours
-        for flavour in flavours:
-            flavour_name = flavour[0]
-            flavour_cpus = flavour[1]
-            flavour_memory = flavour[2]
-
-            logger.info('Attempting to deploy on cloud %s with image %s and flavour %s', cloud, image_url, flavour_name)
-
-            # Create complete RADL content
-            try:
-                radl = Template(str(radl_contents)).substitute(instance=flavour_name,
-                                                               image=image_url,
-                                                               cloud=cloud,
-                                                               allow_groups=utilities.groups_start_expr(groups),
-                                                               region=region)
-            except Exception as ex:
-                logger.critical('Error creating RADL from template due to %s', ex)
-                return False
-
-            # Deploy infrastructure
-            reason = None
-            (infra_id, reason) = cloud_deploy.deploy(radl,
-                                                     cloud,
-                                                     time_begin,
-                                                     unique_id,
-                                                     identity,
-                                                     db,
-                                                     int(requirements['resources']['instances']),
-                                                     flavour_cpus*int(requirements['resources']['instances']),
-                                                     flavour_memory*int(requirements['resources']['instances']))
-
-
-            if infra_id:
-                success = True
-                # Set cloud and IM infra id
-                db.deployment_update_status(unique_id, None, cloud, infra_id, resource_type)
-
-                # Final check if we should delete the infrastructure
-                (_, infra_status_new, _, _, _) = db.deployment_get_im_infra_id(unique_id)
-                if infra_status_new in ('deletion-requested', 'deleted', 'deletion-failed', 'deleting'):
-                    logger.info('Deletion requested of infrastructure, aborting deployment')
-                    return False
-                else:
-                    # Set status
-                    db.deployment_update_status(unique_id, 'configured')
-                break # Leave loop over flavours
+        # Set status
+        db.deployment_update_status(unique_id, 'configured')
+
+        # The description is no longer needed
+        SPECS.pop(unique_id)
 
     if unique_id and not infra_id:
         logger.info('Setting status to waiting with reason DeploymentFailed')
@@ -218,4 +392,3 @@ def deploy_job(db, unique_id):
             db.deployment_update_status_reason(unique_id, 'DeploymentFailed')
 
     return success
-
@@ -0,0 +1,235 @@
+"""Rank clouds by expected time until infrastructure is ready, learned from past deployments"""
+from collections import deque
+import logging
+import math
+import random
+
+from imc import config
+
+# Configuration
+CONFIG = config.get_config()
+
+# Logging
+logger = logging.getLogger(__name__)
+
+class Outcomes(object):
+    """
+    Time-decayed counts of successful & failed deployments together with their durations
+    """
+    def __init__(self):
+        self.successes = 0.0
+        self.failures = 0.0
+        self._timed = [0.0, 0.0]
+        self._durations = [0.0, 0.0]
+
+    def add(self, success, duration, weight=1.0):
+        """
+        Add the outcome of a deployment
+        """
+        if success:
+            self.successes += weight
+        else:
+            self.failures += weight
+
+        if duration is not None and duration >= 0:
+            self._timed[success] += weight
+            self._durations[success] += weight*duration
+
+    def decay(self, factor):
+        """
+        Reduce the weight of all outcomes added so far
+        """
+        self.successes *= factor
+        self.failures *= factor
+        self._timed = [value*factor for value in self._timed]
+        self._durations = [value*factor for value in self._durations]
+
+    def total(self):
+        """
+        Return the weight of all outcomes
+        """
+        return self.successes + self.failures
+
+    def time_success(self):
+        """
+        Return the mean time taken by successful deployments
+        """
+        if self._timed[True] > 0:
+            return self._durations[True]/self._timed[True]
+        return CONFIG.ranking.time_success
+
+    def time_failure(self):
+        """
+        Return the mean time wasted by failed deployments
+        """
+        if self._timed[False] > 0:
+            return self._durations[False]/self._timed[False]
+        return CONFIG.ranking.time_failure
+
+    def probability(self, explore=False):
+        """
+        Return the probability of success, either the mean of the Beta posterior or, to
+        explore clouds with few or old outcomes, a sample from it
+        """
+        alpha = 1 + self.successes
+        beta = 1 + self.failures
+        if explore:
+            return random.betavariate(alpha, beta)
+        return alpha/(alpha + beta)
+
+    def expected_time(self, probability):
+        """
+        Return the expected time until infrastructure is ready if deployments on this
+        cloud are retried until one succeeds
+        """
+        return self.time_success() + self.time_failure()*(1 - probability)/max(probability, 1e-6)
+
+def instances_bucket(instances):
+    """
+    Group numbers of instances into buckets 1, 2-3, 4-7, etc, with 0 for unknown
+    """
+    if instances is None or instances < 1:
+        return 0
+    return int(instances).bit_length()
+
+def keys(cloud, flavour_class, instances):
+    """
+    Return the model keys an outcome contributes to, from most to least specific
+    """
+    return ((cloud, flavour_class, instances_bucket(instances)), (cloud, None, None))
+
+def add_outcome(model, row, weight=1.0):
+    """
+    Add a deployment outcome from the deployment_failures table to a model
+    """
+    for key in keys(row['cloud'], row['flavour_class'], row['instances']):
+        if key not in model:
+            model[key] = Outcomes()
+        model[key].add(row['reason'] == 0, row['duration'], weight)
+
+def decay_factor(interval):
+    """
+    Return the factor by which the weight of outcomes decreases over a time interval
+    """
+    return 0.5**(max(interval, 0)/float(CONFIG.ranking.half_life))
+
+def build_model(history, now):
+    """
+    Create a model from deployment history, with older outcomes given less weight so
+    that clouds which have recovered are tried again
+    """
+    model = {}
+    for row in history:
+        add_outcome(model, row, decay_factor(now - row['time']))
+    return model
+
+def get_outcomes(model, cloud, flavour_class, instances):
+    """
+    Return the outcomes most specific to a deployment which have enough weight, falling
+    back to all outcomes for the cloud
+    """
+    for key in keys(cloud, flavour_class, instances):
+        if key in model and model[key].total() >= CONFIG.ranking.min_weight:
+            return model[key]
+    return model.get((cloud, None, None), Outcomes())
+
+def score(outcomes, explore=False):
+    """
+    Return the probability of success and the expected successes per second spent on a
+    cloud. Trying clouds in decreasing order of the latter minimises the expected time
+    until infrastructure is ready.
+    """
+    probability = outcomes.probability(explore)
+    cost = probability*outcomes.time_success() + (1 - probability)*outcomes.time_failure()
+    return (probability, probability/max(cost, 1))
+
+def preference_ranks(clouds, clouds_config, preferences):
+    """
+    Return the rank of each cloud from the preferred regions & sites, higher is better
+    """
+    ranks = {}
+    for cloud in clouds:
+        ranks[cloud] = 0
+        if not preferences:
+            continue
+        for name in ('regions', 'sites'):
+            if name not in preferences:
+                continue
+            value = clouds_config[cloud]['region'] if name == 'regions' else cloud
+            if value in preferences[name]:
+                ranks[cloud] += len(preferences[name]) - list(preferences[name]).index(value)
+    return ranks
+
+def rank(clouds, history, now, clouds_config, preferences, flavour_classes, instances, explore=True):
+    """
+    Returns list of clouds ranked by expected successes per second spent on each, using
+    Thompson sampling to explore, with a bonus for preferred regions & sites
+    """
+    model = build_model(history, now)
+    ranks = preference_ranks(clouds, clouds_config, preferences)
+
+    weights = {}
+    for cloud in clouds:
+        outcomes = get_outcomes(model, cloud, flavour_classes.get(cloud), instances)
+        (probability, weight) = score(outcomes, explore)
+        weights[cloud] = weight*(1 + CONFIG.ranking.preference_bonus)**ranks[cloud]
+        logger.info('Cloud %s has estimated success probability %.2f and expected time to ready %d secs',
+                    cloud, probability, outcomes.expected_time(probability))
+
+    return sorted(clouds, key=weights.__getitem__, reverse=True)
+
+def replay(history, baseline_window=2*60*60):
+    """
+    Evaluate the model offline by replaying deployment history in time order, predicting
+    each outcome from those before it. Returns the Brier score & log loss of the model and
+    of the success ratio over a recent window used previously, and the mean absolute error
+    of the predicted time taken by successful deployments.
+    """
+    model = {}
+    recent = deque()
+    recent_counts = {}
+    previous = None
+    metrics = {'events': 0,
+               'model_brier': 0.0, 'model_log_loss': 0.0,
+               'baseline_brier': 0.0, 'baseline_log_loss': 0.0,
+               'time_abs_error': 0.0, 'timed_events': 0}
+
+    for row in history:
+        if previous is not None:
+            factor = decay_factor(row['time'] - previous)
+            for outcomes in model.values():
+                outcomes.decay(factor)
+        previous = row['time']
+
+        while recent and recent[0]['time'] < row['time'] - baseline_window:
+            old = recent.popleft()
+            recent_counts[old['cloud']][old['reason'] == 0] -= 1
+
+        outcome = 1.0 if row['reason'] == 0 else 0.0
+        outcomes = get_outcomes(model, row['cloud'], row['flavour_class'], row['instances'])
+        probability = outcomes.probability()
+
+        (failures, successes) = recent_counts.get(row['cloud'], [0, 0])
+        baseline = successes/float(successes + failures) if successes + failures else 0.5
+
+        for (name, predicted) in (('model', probability), ('baseline', baseline)):
+            predicted = min(max(predicted, 1e-6), 1 - 1e-6)
+            metrics['%s_brier' % name] += (predicted - outcome)**2
+            metrics['%s_log_loss' % name] -= math.log(predicted if outcome else 1 - predicted)
+
+        if outcome and row['duration'] is not None and row['duration'] >= 0:
+            metrics['time_abs_error'] += abs(outcomes.time_success() - row['duration'])
+            metrics['timed_events'] += 1
+
+        metrics['events'] += 1
+        add_outcome(model, row)
+        recent.append(row)
+        recent_counts.setdefault(row['cloud'], [0, 0])[row['reason'] == 0] += 1
+
+    if metrics['events']:
+        for name in ('model_brier', 'model_log_loss', 'baseline_brier', 'baseline_log_loss'):
+            metrics[name] /= metrics['events']
+    if metrics['timed_events']:
+        metrics['time_abs_error'] /= metrics['timed_events']
+
+    return metrics
@@ -1,6 +1,12 @@
+"""Find which clouds could run infrastructure without deploying it"""
+import hashlib
+import json
 import logging
 
 from imc import config
+from imc import cloud_utils
+from imc import database
+from imc import im_utils
 from imc import policies
 from imc import utilities
 
@@ -10,37 +16,87 @@ CONFIG = config.get_config()
 # Logging
 logger = logging.getLogger(__name__)
 
+# Cloud catalogue of each identity together with its version, briefly reused between requests
+CATALOGUES = utilities.LRUCache(CONFIG.dryrun.catalogues, CONFIG.dryrun.catalogue_ttl)
+
+# Suitable clouds, keyed by identity, requirements hash & catalogue version
+RESULTS = utilities.LRUCache(CONFIG.dryrun.results)
+
+def get_catalogue(db, identity):
+    """
+    Return the list of clouds available to an identity and the version of their status,
+    quotas, images & flavours
+    """
+    catalogue = CATALOGUES.get(identity)
+    if catalogue:
+        return catalogue
+
+    version = db.get_catalogue_version(identity)
+    if version is None:
+        return (None, None)
+
+    catalogue = (cloud_utils.create_clouds_list(db, identity), version)
+    CATALOGUES.put(identity, catalogue)
+    return catalogue
+
+def requirements_hash(requirements):
+    """
+    Return a hash of requirements which is the same for equal requirements
+    """
+    return hashlib.sha256(json.dumps(requirements, sort_keys=True).encode('utf8')).hexdigest()
+
 def return_sites(description):
     """
     Find appropriate resources to deploy infrastructure, but don't do anything
     """
+    identity = description.get('identity')
+
     # Get RADL
-    radl_contents = utilities.get_radl(description)
+    radl_contents = im_utils.get_radl(description)
     if not radl_contents:
-        logging.critical('RADL must be provided')
+        logger.critical('RADL must be provided')
+        return None
+
+    try:
+        parsed_radl = im_utils.parse_radl(radl_contents)
+    except ValueError as err:
+        logger.critical('Invalid RADL: %s', err)
         return None
 
     # Get requirements & preferences
     (requirements, preferences) = utilities.get_reqs_and_prefs(description)
 
     # Count number of instances
-    instances = utilities.get_num_instances(radl_contents)
-    logger.info('Found %d instances to deploy', instances)
-    requirements['resources']['instances'] = instances
+    logger.info('Found %d instances to deploy', parsed_radl.instances)
+    requirements.setdefault('resources', {})['instances'] = parsed_radl.instances
+
+    db = database.get_db()
+    if not db.connect():
+        logger.critical('Unable to connect to DB for finding suitable resources')
+        return None
+
+    (clouds_info_list, version) = get_catalogue(db, identity)
+    if clouds_info_list is None:
+        db.close()
+        return None
+
+    key = (identity, requirements_hash(requirements), version)
+    clouds = RESULTS.get(key)
+    if clouds is not None:
+        db.close()
+        logger.info('Suitable resources = [%s] (cached)', ','.join(clouds))
+        return clouds
 
     # Setup policy engine
     logger.info('Setting up policies')
-    policy = policies.PolicyEngine(clouds_info_list,
-                                   {'requirements':requirements,
-                                    'preferences':preferences,
-                                    'ignore_usage': True},
-                                   db,
-                                   identity)
+    policy = policies.PolicyEngine(clouds_info_list, requirements, preferences, db, identity)
 
     # Check if deployment could be possible, ignoring current quotas/usage
     logger.info('Checking if job requirements will match any clouds')
-    clouds = policy.statisfies_requirements(ignore_usage=True)
+    clouds = sorted(policy.statisfies_requirements(ignore_usage=True))
+    db.close()
 
+    RESULTS.put(key, clouds)
     logger.info('Suitable resources = [%s]', ','.join(clouds))
 
     return clouds
@@ -52,18 +52,18 @@ def get_token(cloud, identity, db, config):
         else:
             logger.info('Getting EGI Federated Cloud credentials for cloud %s', cloud)
             user_token = True
-            client_id = CONFIG.get('egi.credentials', 'client_id')
-            client_secret = CONFIG.get('egi.credentials', 'client_secret')
-            scope = CONFIG.get('egi.credentials', 'scope')
-            url = CONFIG.get('egi.credentials', 'url')
+            client_id = CONFIG.egi_credentials.client_id
+            client_secret = CONFIG.egi_credentials.client_secret
+            scope = CONFIG.egi_credentials.scope
+            url = CONFIG.egi_credentials.url
 
     else:
         logger.info('Getting EGI Federated Cloud credentials')
         user_token = True
-        client_id = CONFIG.get('egi.credentials', 'client_id')
-        client_secret = CONFIG.get('egi.credentials', 'client_secret')
-        scope = CONFIG.get('egi.credentials', 'scope')
-        url = CONFIG.get('egi.credentials', 'url')
+        client_id = CONFIG.egi_credentials.client_id
+        client_secret = CONFIG.egi_credentials.client_secret
+        scope = CONFIG.egi_credentials.scope
+        url = CONFIG.egi_credentials.url
 
     # Try to obtain an existing token from the DB
     logger.info('Try to get an existing token from the DB')
@@ -1,8 +1,12 @@
 """Miscellaneous functions"""
 
 from __future__ import print_function
+from collections import OrderedDict
+import copy
 import logging
 import re
+import threading
+import time
 
 from imc import config
 
@@ -12,6 +16,60 @@ CONFIG = config.get_config()
 # Logging
 logger = logging.getLogger(__name__)
 
+class LRUCache(object):
+    """
+    Thread-safe least recently used cache, with optional expiry of entries
+    """
+    def __init__(self, maxsize, max_age=None):
+        self._maxsize = maxsize
+        self._max_age = max_age
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def get(self, key, default=None):
+        """
+        Return the value for the given key, if it exists and has not expired
+        """
+        with self._lock:
+            if key not in self._items:
+                return default
+            (value, created) = self._items[key]
+            if self._max_age and time.time() - created > self._max_age:
+                del self._items[key]
+                return default
+            self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """
+        Add or replace an entry, evicting the least recently used entries if necessary
+        """
+        with self._lock:
+            self._items[key] = (value, time.time())
+            self._items.move_to_end(key)
+            while len(self._items) > self._maxsize:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """
+        Remove an entry, returning its value
+        """
+        with self._lock:
+            if key not in self._items:
+                return default
+            return self._items.pop(key)[0]
+
+    def clear(self):
+        """
+        Remove all entries
+        """
+        with self._lock:
+            self._items.clear()
+
 def valid_uuid(uuid):
     """
     Check if the given string is a valid uuid
@@ -22,62 +80,10 @@ def valid_uuid(uuid):
 
 def get_reqs_and_prefs(description):
     """
-    Extract the requirements & preferences from the input JSON description
+    Extract the requirements & preferences from the input JSON description, without
+    modifying it
     """
-    if 'preferences' in description:
-        preferences_new = {}
-        # Generate list of weighted regions if necessary
-        if 'regions' in description['preferences']:
-            preferences_new['regions'] = {}
-            for i in range(0, len(description['preferences']['regions'])):
-                preferences_new['regions'][description['preferences']['regions'][i]] = len(description['preferences']['regions']) - i
-        # Generate list of weighted sites if necessary
-        if 'sites' in description['preferences']:
-            preferences_new['sites'] = {}
-            for i in range(0, len(description['preferences']['sites'])):
-                preferences_new['sites'][description['preferences']['sites'][i]] = len(description['preferences']['sites']) - i
-        description['preferences'] = preferences_new
-    else:
-        preferences = {}
+    requirements = copy.deepcopy(description.get('requirements', {}))
+    preferences = copy.deepcopy(description.get('preferences', {}))
 
-    if 'requirements' in description:
-        requirements = description['requirements']
-        preferences = description['preferences']
-    else:
-        requirements = {}
-    
     return (requirements, preferences)
-
-def create_flavour_list(flavours, requirements):
-    """
-    Given a list of flavours, create a new list containing only those 
-    flavours with unique first characters
-    """
-    if 'coresMax' in requirements['resources'] and 'memoryMax' in requirements['resources'] and 'diskMax' in requirements['resources']:
-        logger.info('Fully constrained resources specified, will consider all matching flavours')
-        return flavours
-
-    new_flavours = [flavours[0]]
-    new_flavours_names = [flavours[0][0]]
-    old_flavours_names = [flavours[0][0]]
-    first_chars = [flavours[0][0][0]]
-
-    for flavour in flavours:
-        if flavour in new_flavours:
-            continue
-
-        old_flavours_names.append(flavour[0])
-
-        found = False
-        for first_char in first_chars:
-            if flavour[0].startswith(first_char):
-                found = True
-
-        if not found:
-            new_flavours.append(flavour)
-            new_flavours_names.append(flavour[0])
-            first_chars.append(flavour[0][0])
-
-    logger.info('Flavours matching job from unique classes: %s', ','.join(new_flavours_names))
-
-    return new_flavours
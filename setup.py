@@ -15,8 +15,11 @@ setuptools.setup(
     url="https://prominence-eosc.github.io/docs",
     platforms=["any"],
     install_requires=["requests", "paramiko", "psycopg2-binary", "psutil", "flask", "xmltodict", "defusedxml", "apache-libcloud", "python-openstackclient"],
+    extras_require={'gevent': ["gevent", "psycogreen"]},
     package_dir={'': '.'},
-    scripts=["bin/imc-cleaner", "bin/imc-manager", "bin/imc-restapi.py"],
-    packages=['imc'],
+    scripts=["bin/imc-cleaner", "bin/imc-manager", "bin/imc-restapi.py", "bin/imc-ranking-replay.py"],
+    packages=['imc', 'imc.database', 'imc.providers'],
+    entry_points={'imc.providers': ['OpenStack = imc.providers.openstack:OpenStackProvider',
+                                    'GCE = imc.providers.gce:GCEProvider']},
     package_data={"": ["README.md"]},
 )
@@ -0,0 +1,65 @@
+"""Check that heavy cloud client libraries are only imported when first needed"""
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules which must not be imported until a cloud is actually used
+HEAVY = ('libcloud', 'novaclient', 'keystoneauth1')
+
+# Modules used by the REST API, cleaner & quota updates
+MODULES = ('imc.cloud_utils',
+           'imc.cloud_quotas',
+           'imc.database',
+           'imc.imclient',
+           'imc.return_sites',
+           'imc.tokens',
+           'imc.utilities',
+           'imc.health',
+           'imc.listener')
+
+def import_modules(modules):
+    """
+    Import modules in a new interpreter, returning the top-level packages imported
+    according to sys.modules and to -X importtime
+    """
+    code = ('import sys\n'
+            'for module in %r:\n'
+            '    __import__(module)\n'
+            'print(",".join(sorted(set(name.split(".")[0] for name in sys.modules))))\n' % (modules,))
+    env = dict(os.environ, PROMINENCE_IMC_CONFIG_DIR=ROOT)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            cwd=ROOT, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise AssertionError('importing %s failed:\n%s' % (', '.join(modules), result.stderr))
+
+    loaded = set(result.stdout.strip().split(','))
+    timed = set()
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            timed.add(line.rsplit('|', 1)[1].strip().split('.')[0])
+    return (loaded, timed)
+
+class TestLazyImports(unittest.TestCase):
+    """
+    Cloud client libraries are slow to import, so must not be imported by modules which
+    do not use them
+    """
+    def test_modules(self):
+        for module in MODULES:
+            with self.subTest(module=module):
+                (loaded, timed) = import_modules((module,))
+                for heavy in HEAVY:
+                    self.assertNotIn(heavy, loaded)
+                    self.assertNotIn(heavy, timed)
+
+    def test_rest_api_modules(self):
+        (loaded, timed) = import_modules(MODULES)
+        for heavy in HEAVY:
+            self.assertNotIn(heavy, loaded)
+            self.assertNotIn(heavy, timed)
+
+if __name__ == '__main__':
+    unittest.main()